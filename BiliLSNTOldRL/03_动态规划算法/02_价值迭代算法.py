@@ -1,6 +1,7 @@
 """
 动态规划算法：对于环境是完全已知的，有模型的算法
 """
+import heapq
 import numpy as np
 from IPython import display
 import time
@@ -11,6 +12,8 @@ values = np.zeros([4, 12])
 # 4个 12行4列 的矩阵，12行4列 中的4列代表的是每个格子的进行上下左右四个方向动作，
 # 所以 [4, 12, 4] 代表的就是 4行12列 的格子地图的每个格子的每个方向的概率
 pi = np.ones([4, 12, 4]) * 0.25
+# 贝尔曼备份(计算一个格子的最大动作分数)的次数
+num_backups = 0
 
 
 # 获取一个格子的状态
@@ -87,6 +90,66 @@ def get_values():
     return new_values
 
 
+# 对一个格子做一次贝尔曼备份,返回该格子下所有动作的最大分数
+def backup(row, col):
+    global num_backups
+    num_backups += 1
+    return max(get_qsa(row, col, action) for action in range(4))
+
+
+# 原地(Gauss-Seidel)更新的策略评估,直接修改values,
+# 后面的格子会用到前面格子刚更新的分数,返回这一轮分数的最大变化
+def get_values_in_place():
+    max_diff = 0
+    for row in range(4):
+        for col in range(12):
+            value = backup(row, col)
+            max_diff = max(max_diff, abs(value - values[row, col]))
+            values[row, col] = value
+    return max_diff
+
+
+# 每个格子的前驱格子: 执行某个动作后能走到该格子的所有格子
+def get_predecessors():
+    predecessors = {}
+    for row in range(4):
+        for col in range(12):
+            for action in range(4):
+                next_row, next_col, _ = move(row, col, action)
+                # 下一个格子是终点或者陷阱时不会用到它的分数
+                if get_state(next_row, next_col) in ['trap', 'terminal']:
+                    continue
+                predecessors.setdefault((next_row, next_col), set()).add((row, col))
+    return predecessors
+
+
+# 优先扫描: 只更新分数变化大于theta的格子,变化越大越先更新
+def get_values_prioritized(theta=1e-3):
+    predecessors = get_predecessors()
+    # 每个格子在队列中的优先级,0表示不在队列中
+    priority = np.zeros([4, 12])
+    heap = []
+    for row in range(4):
+        for col in range(12):
+            diff = abs(backup(row, col) - values[row, col])
+            if diff > theta:
+                priority[row, col] = diff
+                heapq.heappush(heap, (-diff, row, col))
+    while heap:
+        diff, row, col = heapq.heappop(heap)
+        # 过期的队列元素,这个格子已经以更大的优先级出队过
+        if -diff != priority[row, col]:
+            continue
+        priority[row, col] = 0
+        values[row, col] = backup(row, col)
+        # 只有前驱格子的分数会因为这个格子的分数改变而改变
+        for pre_row, pre_col in predecessors.get((row, col), []):
+            diff = abs(backup(pre_row, pre_col) - values[pre_row, pre_col])
+            if diff > theta and diff > priority[pre_row, pre_col]:
+                priority[pre_row, pre_col] = diff
+                heapq.heappush(heap, (-diff, pre_row, pre_col))
+
+
 # 策略提升
 def get_pi():
     # 重新初始化每个格子下采用动作的概率,重新评估
@@ -169,5 +232,36 @@ def main():
         print(line)
 
 
+# 比较三种更新方式收敛到theta需要的贝尔曼备份次数
+def main_backup_count(theta=1e-3):
+    global values
+    global num_backups
+
+    # 同步更新,每轮都新建一个values
+    values = np.zeros([4, 12])
+    num_backups = 0
+    while 1:
+        new_values = get_values()
+        num_backups += 4 * 12
+        max_diff = np.abs(new_values - values).max()
+        values = new_values
+        if max_diff < theta:
+            break
+    print('同步更新:', num_backups)
+    sync_values = values
+
+    values = np.zeros([4, 12])
+    num_backups = 0
+    while get_values_in_place() >= theta:
+        pass
+    print('原地更新:', num_backups, np.abs(values - sync_values).max())
+
+    values = np.zeros([4, 12])
+    num_backups = 0
+    get_values_prioritized(theta)
+    print('优先扫描:', num_backups, np.abs(values - sync_values).max())
+
+
 if __name__ == '__main__':
     main()
+    # main_backup_count()
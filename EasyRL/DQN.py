@@ -1,3 +1,4 @@
+import copy
 import torch.nn as nn
 import torch.nn.functional as functional
 from collections import deque
@@ -81,13 +82,27 @@ class DQN:
         self.epsilon_decay = cfg['epsilon_decay']
         self.batch_size = cfg['batch_size']
         self.policy_net = model.to(self.device)
-        self.target_net = model.to(self.device)
-        # 复制参数到目标网络
-        for target_param, param in zip(self.target_net.parameters(), self.policy_net.parameters()):
-            target_param.data.copy_(param.data)
+        # 目标网络需要是单独的副本:model.to()返回的是model本身,直接赋值会让目标网络就是策略网络
+        self.target_net = copy.deepcopy(self.policy_net)
+        # 同步时需要拷贝的张量:参数和缓冲区(例如BatchNorm的running_mean)
+        self.policy_tensors = list(self.policy_net.parameters()) + list(self.policy_net.buffers())
+        self.target_tensors = list(self.target_net.parameters()) + list(self.target_net.buffers())
+        self.sync_target()  # 复制参数到目标网络
         self.optimizer = optim.Adam(self.policy_net.parameters(), lr=cfg['lr'])  # 优化器
         self.memory = memory  # 经验回放
 
+    @torch.no_grad()
+    def sync_target(self):
+        """
+        硬更新目标网络,原地拷贝所有参数和缓冲区,代替target_net.load_state_dict(policy_net.state_dict())
+        :return:
+        """
+        if hasattr(torch, '_foreach_copy_'):
+            torch._foreach_copy_(self.target_tensors, self.policy_tensors)  # 一次多张量拷贝
+        else:
+            for target_tensor, tensor in zip(self.target_tensors, self.policy_tensors):
+                target_tensor.copy_(tensor)
+
     def sample_action(self, state):
         """
         采样动作
@@ -172,7 +187,7 @@ def train(cfg, env, agent):
             if done:
                 break
         if (i_ep + 1) % cfg['target_update'] == 0:  # 智能体目标网络更新
-            agent.target_net.load_state_dict(agent.policy_net.state_dict())
+            agent.sync_target()
         steps.append(ep_step)
         rewards.append(ep_reward)
         if (i_ep + 1) % 10 == 0:
@@ -0,0 +1,155 @@
+"""
+并行、增量地把仓库中ALE支持的ROM导入到atari_py的ROM目录,代替逐个文件处理的python -m atari_py.import_roms:
+    python -m Gym.import_roms [target_dir]
+"""
+import os
+import hashlib
+import shutil
+import argparse
+import functools
+import multiprocessing as mp
+from Gym.rom_catalog import ROM_DIRS, DEFAULT_INDEX_PATH, REPO_ROOT, build_catalog, hash_rom, load_ale_md5_table
+
+# 文件数量少于这个值时不启动进程池,进程启动的开销比计算哈希还大
+MIN_PARALLEL_FILES = 64
+# Linux上btrfs/xfs等文件系统的FICLONE ioctl,新文件与原文件共享数据块(reflink)
+FICLONE = 0x40049409
+# ALE中的road_runner.bin不容易找到,atari_py.import_roms把下面这个版本按delta修改后使用
+ROAD_RUNNER_MD5 = 'ce5cc62608be2cd3ed8abd844efb8919'
+ROAD_RUNNER_DELTA = {4090: 216, 4091: 111, 4092: 216, 4093: 111, 4094: 216, 4095: 111, 8186: 18, 8187: 43,
+                     8188: -216, 8189: 49, 8190: -216, 8191: 49, 12281: 234, 12282: 18, 12283: 11, 12284: -216,
+                     12285: 17, 12286: -216, 12287: 17, 16378: 18, 16379: -21, 16380: -216, 16381: -15,
+                     16382: -216, 16383: -15}
+
+
+def parallel_hash(paths, processes=None, chunksize=32):
+    """
+    用进程池计算paths中所有文件的(md5, sha1),返回与paths对应的列表
+    """
+    if len(paths) < MIN_PARALLEL_FILES or processes == 1:
+        return [hash_rom(path) for path in paths]
+    with mp.Pool(processes) as pool:
+        return pool.map(hash_rom, paths, chunksize)
+
+
+def _clone_file(src, dst):
+    import fcntl  # 只有类Unix系统有fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def materialize(src, dst, link=True):
+    """
+    把src放到dst,返回使用的方式:'link'(硬链接)、'reflink'或'copy'。
+    link=True时依次尝试硬链接和reflink,都不支持(例如跨文件系统)时才复制;
+    先写入临时文件再替换dst,已有的dst在替换完成之前一直可用
+    """
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    method = 'copy'
+    if link:
+        try:
+            os.link(src, tmp)
+            method = 'link'
+        except OSError:
+            try:
+                _clone_file(src, tmp)
+                method = 'reflink'
+            except (OSError, ImportError):
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+    if method == 'copy':
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return method
+
+
+def _patch_road_runner(path):
+    with open(path, 'rb') as f:
+        data = bytearray(f.read())
+    for index, offset in ROAD_RUNNER_DELTA.items():
+        data[index] += offset
+    return bytes(data)
+
+
+def import_roms(target_dir=None, rom_dirs=ROM_DIRS, index_path=DEFAULT_INDEX_PATH, md5_table=None,
+                processes=None, link=True, dry_run=False):
+    """
+    1. 用进程池计算rom_dirs下所有ROM的哈希,更新ROM索引(build_catalog,大小和修改时间没变的文件不再读取);
+    2. 按md5从去重后的ROM中选出ALE支持的ROM,每个ROM只处理一次;
+    3. target_dir中已有且内容哈希一致的ROM直接跳过,其余的用硬链接/reflink放到target_dir,不支持时才复制。
+    target_dir和md5_table为None时使用已安装的atari_py的ROM目录和md5.txt。
+    返回{'link': [...], 'reflink': [...], 'copy': [...], 'skipped': [...], 'missing': [...]},元素是ALE中的ROM文件名
+    """
+    hash_fn = functools.partial(parallel_hash, processes=processes)
+    catalog = build_catalog(rom_dirs, index_path, hash_fn=hash_fn)
+    if md5_table is None:
+        md5_table = load_ale_md5_table()
+    if target_dir is None:
+        import atari_py
+        target_dir = atari_py.get_games_dir()
+
+    # ALE中的ROM文件名 -> (期望的md5, 仓库中的源文件, 是否需要修改内容)
+    wanted = {}
+    for md5, name in md5_table.items():
+        rom = catalog.get(md5)
+        if rom is not None:
+            wanted[name] = (md5, os.path.join(REPO_ROOT, rom['paths'][0]), False)
+    road_runner = catalog.get(ROAD_RUNNER_MD5)
+    names = {name: md5 for md5, name in md5_table.items()}
+    if 'road_runner.bin' in names and 'road_runner.bin' not in wanted and road_runner is not None:
+        wanted['road_runner.bin'] = (names['road_runner.bin'], os.path.join(REPO_ROOT, road_runner['paths'][0]), True)
+    result = {'link': [], 'reflink': [], 'copy': [], 'skipped': [],
+              'missing': sorted(set(md5_table.values()) - set(wanted))}
+
+    # 增量导入:目标目录中已有的ROM同样并行计算哈希,内容一致的跳过
+    existing = [name for name in sorted(wanted) if os.path.isfile(os.path.join(target_dir, name))]
+    installed = dict(zip(existing, hash_fn([os.path.join(target_dir, name) for name in existing])))
+    if not dry_run:
+        os.makedirs(target_dir, exist_ok=True)
+    for name in sorted(wanted):
+        md5, src, patch = wanted[name]
+        if name in installed and installed[name][0] == md5:
+            result['skipped'].append(name)
+            continue
+        dst = os.path.join(target_dir, name)
+        if patch:
+            data = _patch_road_runner(src)
+            if hashlib.md5(data).hexdigest() != md5:
+                result['missing'].append(name)
+                continue
+            if not dry_run:
+                with open(dst + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(dst + '.tmp', dst)
+            result['copy'].append(name)
+        elif dry_run:
+            result['link' if link else 'copy'].append(name)
+        else:
+            result[materialize(src, dst, link)].append(name)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('target_dir', nargs='?', default=None, help='ROM的目标目录,默认为atari_py的ROM目录')
+    parser.add_argument('--md5', default=None, help='ALE的md5.txt,默认使用atari_py自带的')
+    parser.add_argument('--processes', type=int, default=None, help='计算哈希的进程数,默认为CPU核数')
+    parser.add_argument('--copy', action='store_true', help='复制文件,不使用硬链接/reflink')
+    parser.add_argument('--dry-run', action='store_true', help='只显示将要导入的ROM')
+    args = parser.parse_args()
+    md5_table = None if args.md5 is None else load_ale_md5_table(args.md5)
+    result = import_roms(args.target_dir, md5_table=md5_table, processes=args.processes,
+                         link=not args.copy, dry_run=args.dry_run)
+    for key in ('link', 'reflink', 'copy'):
+        for name in result[key]:
+            print('%s %s' % (key, name))
+    print('导入%d个ROM(硬链接%d,reflink %d,复制%d),跳过%d个已导入的ROM,缺少%d个ROM: %s' % (
+        len(result['link']) + len(result['reflink']) + len(result['copy']), len(result['link']),
+        len(result['reflink']), len(result['copy']), len(result['skipped']), len(result['missing']),
+        ' '.join(result['missing'])))
+
+
+if __name__ == '__main__':
+    main()
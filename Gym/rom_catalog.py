@@ -0,0 +1,311 @@
+import os
+import re
+import json
+import hashlib
+
+# ROMS/和HC ROMS/所在的目录(仓库根目录)
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROM_DIRS = ('ROMS', 'HC ROMS')
+ROM_EXTENSIONS = ('.bin', '.a26')
+DEFAULT_INDEX_PATH = os.path.join(REPO_ROOT, 'data', 'rom_index.json')
+INDEX_VERSION = 1
+
+REGIONS = ('NTSC', 'PAL', 'PAL60', 'SECAM')
+# 文件名中表示版本状态或所需控制器的标记
+STATUS_TAGS = ('Prototype', 'Preview', 'Hack', 'Demo', 'Beta')
+CONTROLLER_TAGS = ('Paddle', 'Paddles', 'Driving Controller', 'Light Gun', "Kid's Controller", 'Keyboard Controller',
+                   'Joystick', 'Booster Grip', 'Trak-Ball', 'Mindlink', 'CompuMate')
+# (1983)、(08-09-1983)、(198x)这样的日期,以及表示日期和发行商都未知的(Unknown)
+DATE_PATTERN = re.compile(r'^(?:(\d\d)-(\d\d)-)?((?:19|20)[\dx]{2})$')
+GROUP_PATTERN = re.compile(r'\(([^()]*(?:\([^()]*\)[^()]*)*)\)|\[([^\[\]]*)\]')
+# ALE/gym的环境名,例如ALE/MontezumaRevenge-v5、PongNoFrameskip-v4、Breakout-ramDeterministic-v4
+ENV_ID_PATTERN = re.compile(r'^(?:ALE/)?([A-Za-z0-9]+?)(?:-ram)?(?:NoFrameskip|Deterministic)?-v\d+$')
+
+
+def hash_rom(path):
+    """
+    返回ROM文件内容的(md5, sha1),ALE的支持列表(atari_py的md5.txt)按md5识别ROM
+    """
+    with open(path, 'rb') as f:
+        data = f.read()  # Atari 2600的ROM最大只有几百KB,直接一次读入
+    return hashlib.md5(data).hexdigest(), hashlib.sha1(data).hexdigest()
+
+
+def title_key(title):
+    # 用于查找的标题:去掉结尾的", The"和开头的"The ",去掉所有格的"'s",只保留小写字母和数字
+    title = title.lower().replace("'s ", ' ')
+    if title.endswith(', the'):
+        title = title[:-5]
+    if title.startswith('the '):
+        title = title[4:]
+    return re.sub(r'[^a-z0-9]', '', title)
+
+
+def main_title(title):
+    # 去掉" - "之后的副标题,例如Breakout - Breakaway IV -> Breakout
+    return title.split(' - ')[0]
+
+
+def ale_rom_name(name):
+    """
+    把ALE的环境名或ROM名转换为ALE中的ROM文件名,例如ALE/MontezumaRevenge-v5、montezuma_revenge -> montezuma_revenge.bin;
+    与atari_py由ROM名生成环境名(按下划线分词后首字母大写)的规则相反,不是这两种格式时返回None
+    """
+    match = ENV_ID_PATTERN.match(name)
+    if match:
+        # UpNDown -> up_n_down
+        return re.sub(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])', '_', match.group(1)).lower() + '.bin'
+    name = name[:-4] if name.endswith('.bin') else name
+    if re.match(r'^[a-z0-9_]+$', name):
+        return name + '.bin'
+    return None
+
+
+def parse_rom_name(filename, dirpath=''):
+    """
+    从文件名解析ROM的元数据,例如
+    Joust (08-09-1983) (Atari - GCC, Michael Feinstein) (CX2691) (Prototype) (PAL) [a1] ~.bin
+    标题之后、日期之前的括号是别名(AKA)或控制器,日期之后的第一个括号是"发行商, 作者",
+    其余的括号是地区、版本状态等标记或目录编号;文件名中没有日期时,第一个无法识别的括号作为发行商。
+    dirpath是相对于仓库根目录的所在目录,HC ROMS中按公司/PAL整理的目录可以补充文件名中缺少的信息
+    """
+    stem = os.path.splitext(filename)[0].strip()
+    tilde = stem.endswith('~')
+    stem = stem.rstrip('~ ')
+    match = GROUP_PATTERN.search(stem)
+    title = (stem[:match.start()] if match else stem).strip()
+    info = {'title': title, 'aliases': [], 'year': None, 'date': None, 'publisher': None, 'authors': [],
+            'region': None, 'tags': [], 'codes': []}
+    groups = GROUP_PATTERN.findall(stem)
+    has_date = any(DATE_PATTERN.match(paren) or paren == 'Unknown' for paren, _ in groups)
+    seen_date = False
+    expect_publisher = not has_date
+    for paren, bracket in groups:
+        if not paren:
+            # 方括号:[a]、[a1]是另一个dump版本,[fixed]是修正了bug的正式版本,其余是说明
+            if re.match(r'^a\d*$', bracket):
+                info['tags'].append('alternate')
+            elif bracket == 'fixed':
+                info['tags'].append('fixed')
+            else:
+                info['codes'].append(bracket)
+            continue
+        date = DATE_PATTERN.match(paren)
+        if not seen_date and (date or paren == 'Unknown'):
+            seen_date = True
+            expect_publisher = True
+            if date:
+                info['year'] = int(date.group(3)) if 'x' not in date.group(3) else None
+                info['date'] = paren
+        elif paren in REGIONS:
+            info['region'] = paren
+        elif paren in STATUS_TAGS or paren in CONTROLLER_TAGS:
+            info['tags'].append(paren)
+        elif paren.startswith('AKA '):
+            info['aliases'].append(paren[4:])
+        elif expect_publisher:
+            expect_publisher = False
+            names = [name.strip() for name in paren.split(',')]
+            info['publisher'] = names[0]
+            info['authors'] = names[1:]
+        elif not seen_date:
+            info['aliases'].append(paren[4:] if paren.startswith('AKA ') else paren)
+        else:
+            info['codes'].append(paren)
+    if tilde:
+        info['tags'].append('~')
+
+    # 目录名提供的信息只在文件名中没有时使用
+    parts = dirpath.replace('\\', '/').split('/')
+    if info['region'] is None:
+        info['region'] = 'PAL' if any(part.startswith('PAL ') or part.endswith('(PAL)') for part in parts) else 'NTSC'
+    for i, part in enumerate(parts[:-1]):
+        if part.startswith('BY COMPANY') and info['publisher'] is None:
+            info['publisher'] = parts[i + 1]
+    return info
+
+
+def _info_score(info):
+    # 同一个ROM有多个文件名时,用信息最完整的那个作为元数据
+    return (info['year'] is not None, info['publisher'] is not None, len(info['authors']) + len(info['codes']))
+
+
+def _scan(rom_dirs):
+    for rom_dir in rom_dirs:
+        top = os.path.join(REPO_ROOT, rom_dir)
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames.sort()
+            rel_dir = os.path.relpath(dirpath, REPO_ROOT).replace(os.sep, '/')
+            for filename in sorted(filenames):
+                if filename.lower().endswith(ROM_EXTENSIONS):
+                    yield rel_dir, filename
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def build_catalog(rom_dirs=ROM_DIRS, index_path=DEFAULT_INDEX_PATH, rehash=False, hash_fn=None):
+    """
+    扫描rom_dirs下的所有ROM,按内容的md5去重后写入index_path(JSON),返回RomCatalog。
+    已有索引时,大小和修改时间都没有变化的文件直接沿用原来的哈希值,不再读取文件内容(rehash=True时全部重新计算)。
+    hash_fn(paths)可以替换默认的逐个计算,返回与paths对应的(md5, sha1)列表
+    """
+    old_files = {}
+    if not rehash and os.path.exists(index_path):
+        with open(index_path) as f:
+            old_files = json.load(f)['files']
+
+    files = {}
+    to_hash = []
+    for rel_dir, filename in _scan(rom_dirs):
+        rel_path = rel_dir + '/' + filename
+        size, mtime_ns = _stat_key(os.path.join(REPO_ROOT, rel_path))
+        old = old_files.get(rel_path)
+        if old is not None and old[0] == size and old[1] == mtime_ns:
+            files[rel_path] = old
+        else:
+            files[rel_path] = [size, mtime_ns, None, None]
+            to_hash.append(rel_path)
+    if hash_fn is None:
+        hashes = [hash_rom(os.path.join(REPO_ROOT, path)) for path in to_hash]
+    else:
+        hashes = hash_fn([os.path.join(REPO_ROOT, path) for path in to_hash])
+    for rel_path, (md5, sha1) in zip(to_hash, hashes):
+        files[rel_path][2:] = [md5, sha1]
+
+    # 按md5去重,每个ROM记录所有文件路径
+    roms = {}
+    for rel_path, (size, _, md5, sha1) in files.items():
+        rel_dir, filename = rel_path.rsplit('/', 1)
+        info = parse_rom_name(filename, rel_dir)
+        rom = roms.get(md5)
+        if rom is None:
+            rom = roms[md5] = dict(info, md5=md5, sha1=sha1, size=size, paths=[])
+        elif _info_score(info) > _info_score(rom):
+            rom.update(info)
+        rom['paths'].append(rel_path)
+
+    index = {'version': INDEX_VERSION, 'rom_dirs': list(rom_dirs), 'files': files, 'roms': roms}
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, index_path)  # 先写临时文件再替换,中断时不会留下不完整的索引
+    return RomCatalog(index)
+
+
+def load_ale_md5_table(path=None):
+    """
+    读取ALE支持的ROM列表,返回{md5: ALE中的ROM文件名(例如montezuma_revenge.bin)};
+    path为None时使用已安装的atari_py自带的md5.txt
+    """
+    if path is None:
+        import atari_py
+        path = os.path.join(os.path.dirname(atari_py.__file__), 'ale_interface', 'md5.txt')
+    table = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2 and re.match(r'^[0-9a-f]{32}$', fields[0]):
+                table[fields[0]] = fields[1]
+    return table
+
+
+class RomCatalog:
+    """
+    ROM索引,按md5/sha1/标题查找ROM,每个ROM是一个dict:
+    md5、sha1、size、title、aliases、year、date、publisher、authors、region、tags、codes、paths
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.roms = index['roms']
+        self.by_sha1 = {rom['sha1']: rom for rom in self.roms.values()}
+        # 标题、主标题和别名 -> ROM列表
+        self.by_title = {}
+        for rom in self.roms.values():
+            for key in set(self._title_keys(rom)):
+                self.by_title.setdefault(key, []).append(rom)
+        self.ale_md5_table = None  # find()第一次用到时再读取
+
+    @classmethod
+    def load(cls, index_path=DEFAULT_INDEX_PATH):
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') != INDEX_VERSION:
+            raise ValueError('不支持的ROM索引版本: %s' % index.get('version'))
+        return cls(index)
+
+    def __len__(self):
+        return len(self.roms)
+
+    def get(self, digest):
+        # 按md5或sha1查找
+        return self.roms.get(digest) or self.by_sha1.get(digest)
+
+    def find(self, name, region='NTSC', include_hacks=False, md5_table=None):
+        """
+        查找ROM,返回ROM的列表,最可能需要的排在最前面。
+        name是ALE的环境名或ROM名时(例如ALE/MontezumaRevenge-v5、PongNoFrameskip-v4、montezuma_revenge),
+        先转换为ALE中的ROM文件名,再按ALE支持列表中的md5找到ALE实际使用的那个ROM,只返回这一个;
+        md5_table为None时使用已安装的atari_py自带的md5.txt,没有安装atari_py或者列表中没有这个ROM时按标题查找:
+        返回标题、去掉副标题后的主标题或别名以name开头的所有ROM,依次按
+        标题是否完全匹配、是否是原版发行商(完全匹配的ROM中年份最早的发行商,其余多是翻版)、
+        标题是否不带副标题、地区、是否正式发行、是否修改版排序
+        """
+        rom_name = ale_rom_name(name)
+        if rom_name is not None:
+            if md5_table is None:
+                if self.ale_md5_table is None:
+                    try:
+                        self.ale_md5_table = load_ale_md5_table()
+                    except ImportError:  # 没有安装atari_py,只能按标题查找
+                        self.ale_md5_table = {}
+                md5_table = self.ale_md5_table
+            for md5, ale_name in md5_table.items():
+                if ale_name == rom_name and md5 in self.roms:
+                    return [self.roms[md5]]
+
+        name = re.sub(r'^ALE/|(-ram)?(NoFrameskip|Deterministic)?-v\d+$|\.bin$', '', name)
+        key = title_key(name)
+        matches = {}
+        for title, roms in self.by_title.items():
+            if title.startswith(key):
+                for rom in roms:
+                    if include_hacks or 'Hack' not in rom['tags']:
+                        matches[rom['md5']] = rom
+        exact = [rom for rom in matches.values() if key in self._title_keys(rom)]
+        dated = [rom for rom in exact if rom['year'] is not None]
+        original = min(dated, key=lambda rom: rom['year'])['publisher'] if dated else None
+        return sorted(matches.values(), key=lambda rom: (
+            key not in self._title_keys(rom), rom['publisher'] != original, title_key(rom['title']) != key,
+            rom['region'] != region, 'Prototype' in rom['tags'], 'Hack' in rom['tags'],
+            'alternate' in rom['tags'], rom['title']))
+
+    @staticmethod
+    def _title_keys(rom):
+        return [title_key(title) for title in [rom['title'], main_title(rom['title'])] + rom['aliases']]
+
+    def duplicates(self):
+        # 内容相同但有多个文件的ROM
+        return [rom for rom in self.roms.values() if len(rom['paths']) > 1]
+
+    def supported(self, md5_table=None):
+        # ALE支持的ROM:{ALE中的ROM文件名: ROM}
+        if md5_table is None:
+            md5_table = load_ale_md5_table()
+        return {name: self.roms[md5] for md5, name in md5_table.items() if md5 in self.roms}
+
+
+def main():
+    catalog = build_catalog()
+    num_files = len(catalog.index['files'])
+    print('%d个文件,去重后%d个ROM,其中%d个ROM有多个文件' % (num_files, len(catalog), len(catalog.duplicates())))
+    for rom in catalog.find('ALE/MontezumaRevenge-v5')[:3]:
+        print(rom['md5'], rom['title'], rom['year'], rom['publisher'], rom['region'], rom['paths'][0])
+
+
+if __name__ == '__main__':
+    main()
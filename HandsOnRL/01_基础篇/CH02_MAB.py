@@ -86,13 +86,21 @@ class EpsilonGreedy(Solver):
         return k
 
 
-def plot_results(solvers, solver_names):
+def plot_results(solvers, solver_names, quantiles=(0.05, 0.95)):
     """
     生成累积懊悔随时间变化的图像。输入solvers是一个列表,
     列表中的每个元素是一种特定的策略。
-    而solver_names也是一个列表,存储每个策略的名称
+    而solver_names也是一个列表,存储每个策略的名称。
+    批量运行的策略(BatchSolver)画出多次运行的平均累积懊悔,
+    并用阴影表示quantiles给出的分位数区间
     """
     for idx, solver in enumerate(solvers):
+        if isinstance(solver, BatchSolver):
+            time_list = range(solver.regrets.shape[1])
+            line, = plt.plot(time_list, solver.mean_regrets(), label=solver_names[idx])
+            low, high = solver.quantile_regrets(quantiles)
+            plt.fill_between(time_list, low, high, color=line.get_color(), alpha=0.2)
+            continue
         time_list = range(len(solver.regrets))
         plt.plot(time_list, solver.regrets, label=solver_names[idx])
     plt.xlabel('Time steps')
@@ -245,6 +253,133 @@ def main_thompson_sampling():
     plot_results([thompson_sampling_solver], ["ThompsonSampling"])
 
 
+class BatchSolver:
+    """
+    多臂老虎机算法的批量版本,用numpy同时推进num_runs次独立运行,
+    所有运行使用同一个老虎机。counts和estimates等都是(num_runs, k)的数组
+    """
+
+    def __init__(self, bandit, num_runs):
+        self.bandit = bandit
+        self.num_runs = num_runs
+        self.counts = np.zeros((num_runs, self.bandit.k))  # 每次运行中每根拉杆的尝试次数
+        self.regrets = None  # (num_runs, num_steps)的数组,记录每次运行每一步的累积懊悔
+        self.total_count = 0
+        self._runs = np.arange(num_runs)
+
+    def step(self, actions):
+        # 同时拉动每次运行选择的拉杆,返回每次运行的奖励
+        return (np.random.rand(self.num_runs) < self.bandit.probs[actions]).astype(np.float64)
+
+    def run_one_step(self):
+        # 返回每次运行的动作,形状为(num_runs,),由每个具体的策略实现
+        raise NotImplementedError
+
+    def run(self, num_steps):
+        self.regrets = np.empty((self.num_runs, num_steps))  # 预先分配懊悔数组
+        for t in range(num_steps):
+            self.total_count += 1
+            actions = self.run_one_step()
+            self.counts[self._runs, actions] += 1
+            self.regrets[:, t] = self.bandit.best_prob - self.bandit.probs[actions]
+        np.cumsum(self.regrets, axis=1, out=self.regrets)  # 原地计算累积懊悔
+
+    @property
+    def regret(self):  # 每次运行最终的累积懊悔
+        return self.regrets[:, -1]
+
+    def mean_regrets(self):  # 多次运行的平均累积懊悔曲线
+        return self.regrets.mean(axis=0)
+
+    def quantile_regrets(self, q):  # 多次运行累积懊悔曲线的分位数,形状为(len(q), num_steps)
+        return np.quantile(self.regrets, q, axis=0)
+
+
+class BatchEpsilonGreedy(BatchSolver):
+    """ 批量的epsilon贪婪算法 """
+
+    def __init__(self, bandit, num_runs, epsilon=0.01, init_prob=1.0):
+        super(BatchEpsilonGreedy, self).__init__(bandit, num_runs)
+        self.epsilon = epsilon
+        self.estimates = np.full((num_runs, self.bandit.k), init_prob)
+
+    def get_epsilon(self):
+        return self.epsilon
+
+    def run_one_step(self):
+        actions = np.argmax(self.estimates, axis=1)
+        explore = np.random.random(self.num_runs) < self.get_epsilon()
+        actions[explore] = np.random.randint(0, self.bandit.k, size=explore.sum())
+        r = self.step(actions)
+        counts = self.counts[self._runs, actions]
+        self.estimates[self._runs, actions] += 1. / (counts + 1) * (r - self.estimates[self._runs, actions])
+        return actions
+
+
+class BatchDecayingEpsilonGreedy(BatchEpsilonGreedy):
+    """ 批量的epsilon值随时间衰减的epsilon-贪婪算法 """
+
+    def __init__(self, bandit, num_runs, init_prob=1.0):
+        super(BatchDecayingEpsilonGreedy, self).__init__(bandit, num_runs, init_prob=init_prob)
+
+    def get_epsilon(self):
+        return 1 / self.total_count
+
+
+class BatchUCB(BatchSolver):
+    """ 批量的UCB算法 """
+
+    def __init__(self, bandit, num_runs, coef, init_prob=1.0):
+        super(BatchUCB, self).__init__(bandit, num_runs)
+        self.estimates = np.full((num_runs, self.bandit.k), init_prob)
+        self.coef = coef
+
+    def run_one_step(self):
+        ucb = self.estimates + self.coef * np.sqrt(
+            np.log(self.total_count) / (2 * (self.counts + 1)))  # 计算上置信界
+        actions = np.argmax(ucb, axis=1)
+        r = self.step(actions)
+        counts = self.counts[self._runs, actions]
+        self.estimates[self._runs, actions] += 1. / (counts + 1) * (r - self.estimates[self._runs, actions])
+        return actions
+
+
+class BatchThompsonSampling(BatchSolver):
+    """ 批量的汤普森采样算法 """
+
+    def __init__(self, bandit, num_runs):
+        super(BatchThompsonSampling, self).__init__(bandit, num_runs)
+        self._a = np.ones((num_runs, self.bandit.k))  # 每次运行中每根拉杆奖励为1的次数
+        self._b = np.ones((num_runs, self.bandit.k))  # 每次运行中每根拉杆奖励为0的次数
+
+    def run_one_step(self):
+        samples = np.random.beta(self._a, self._b)
+        actions = np.argmax(samples, axis=1)
+        r = self.step(actions)
+        self._a[self._runs, actions] += r
+        self._b[self._runs, actions] += (1 - r)
+        return actions
+
+
+def main_batch():
+    # 每种算法独立运行1000次,画出平均累积懊悔以及5%~95%分位数区间
+    np.random.seed(1)
+    k = 10
+    bandit_10_arm = BernoulliBandit(k)
+    np.random.seed(0)
+    num_runs = 1000
+    num_steps = 5000
+    solvers = [BatchEpsilonGreedy(bandit_10_arm, num_runs, epsilon=0.01),
+               BatchDecayingEpsilonGreedy(bandit_10_arm, num_runs),
+               BatchUCB(bandit_10_arm, num_runs, coef=1),
+               BatchThompsonSampling(bandit_10_arm, num_runs)]
+    solver_names = ["EpsilonGreedy", "DecayingEpsilonGreedy", "UCB", "ThompsonSampling"]
+    for solver, name in zip(solvers, solver_names):
+        solver.run(num_steps)
+        print('%s的平均累积懊悔为：%.2f' % (name, solver.regret.mean()))
+    plot_results(solvers, solver_names)
+
+
 if __name__ == '__main__':
     # main_bandit()
     # main_epsilon_greedy()
@@ -252,3 +387,4 @@ if __name__ == '__main__':
     # main_decaying_epsilon_greedy()
     # main_ucb()
     main_thompson_sampling()
+    # main_batch()
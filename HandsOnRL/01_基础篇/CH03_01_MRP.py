@@ -2,6 +2,8 @@
 Markov Reward Process, MRP
 """
 import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
 
 np.random.seed(0)
 # 定义状态转移概率矩阵P
@@ -48,12 +50,16 @@ def main_return():
 
 def compute(p, _rewards, _gamma, states_num):
     """
-    利用贝尔曼方程的矩阵形式计算解析解,states_num是MRP的状态数
+    利用贝尔曼方程的矩阵形式计算解析解,states_num是MRP的状态数。
+    p可以是numpy数组,也可以是scipy的稀疏矩阵
     """
     # 将rewards写成列向量形式
-    _rewards = np.array(_rewards).reshape((-1, 1))
-    value = np.dot(np.linalg.inv(
-        np.eye(states_num, states_num) - _gamma * p), _rewards)
+    _rewards = np.array(_rewards, dtype=float).reshape((-1, 1))
+    # 直接解线性方程组(I - gamma * P)V = R,不需要先求逆矩阵
+    if sparse.issparse(p):
+        a = sparse.identity(states_num, format='csc') - _gamma * p
+        return sparse_linalg.spsolve(a.tocsc(), _rewards).reshape((-1, 1))
+    value = np.linalg.solve(np.eye(states_num, states_num) - _gamma * p, _rewards)
     return value
 
 
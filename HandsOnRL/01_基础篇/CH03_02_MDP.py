@@ -2,6 +2,7 @@
 Markov Decision Process, MDP
 """
 import numpy as np
+from scipy import sparse
 from CH03_01_MRP import compute
 
 S = ["s1", "s2", "s3", "s4", "s5"]  # 状态集合
@@ -62,17 +63,69 @@ def join(str1, str2):
     return str1 + '-' + str2
 
 
+def mdp_to_arrays(mdp, sparse_format=False):
+    """
+    把用"s-a-s'"字符串作为键的MDP转换成以整数下标表示的数组,S[i]、A[j]是下标对应的名字。
+    返回p, r: p[s, a, s']是状态转移概率, r[s, a]是奖励。
+    sparse_format为True时p是形状为(|S|*|A|, |S|)的稀疏矩阵,第s*|A|+a行对应(s, a)
+    """
+    _s, _a, _p, _r, _gamma = mdp
+    s_index = {s: i for i, s in enumerate(_s)}
+    a_index = {a: i for i, a in enumerate(_a)}
+    rows, cols, probs = [], [], []
+    for key, prob in _p.items():
+        s, a, s_next = key.split('-')
+        rows.append(s_index[s] * len(_a) + a_index[a])
+        cols.append(s_index[s_next])
+        probs.append(prob)
+    p = sparse.csr_matrix((probs, (rows, cols)), shape=(len(_s) * len(_a), len(_s)))
+    if not sparse_format:
+        p = p.toarray().reshape((len(_s), len(_a), len(_s)))
+    r = np.zeros((len(_s), len(_a)))
+    for key, reward in _r.items():
+        s, a = key.split('-')
+        r[s_index[s], a_index[a]] = reward
+    return p, r
+
+
+def policy_to_array(pi, _s, _a):
+    """
+    把用"s-a"字符串作为键的策略转换成形状为(|S|, |A|)的数组,pi[s, a]是在状态s下选择动作a的概率
+    """
+    s_index = {s: i for i, s in enumerate(_s)}
+    a_index = {a: i for i, a in enumerate(_a)}
+    policy = np.zeros((len(_s), len(_a)))
+    for key, prob in pi.items():
+        s, a = key.split('-')
+        policy[s_index[s], a_index[a]] = prob
+    return policy
+
+
+def mdp_to_mrp(mdp, pi, sparse_format=False):
+    """
+    给定策略把MDP转化为MRP,返回MRP的状态转移矩阵和奖励函数:
+    P'(s'|s) = sum_a pi(a|s)P(s'|s,a), r'(s) = sum_a pi(a|s)r(s,a)。
+    没有可选动作的状态(例如终止状态s5)作为吸收态,以概率1转移到自身
+    """
+    _s, _a = mdp[0], mdp[1]
+    p, r = mdp_to_arrays(mdp, sparse_format)
+    policy = policy_to_array(pi, _s, _a)
+    absorbing = (policy.sum(axis=1) == 0).astype(float)
+    if sparse_format:
+        # weight[s, s*|A|+a] = pi(a|s),左乘p就是对每个状态的所有动作加权求和
+        weight = sparse.csr_matrix(
+            (policy.reshape(-1), (np.repeat(np.arange(len(_s)), len(_a)), np.arange(len(_s) * len(_a)))),
+            shape=(len(_s), len(_s) * len(_a)))
+        p_mrp = (weight @ p + sparse.diags(absorbing)).tocsr()
+    else:
+        p_mrp = np.einsum('sa,sat->st', policy, p) + np.diag(absorbing)
+    r_mrp = (policy * r).sum(axis=1)
+    return p_mrp, r_mrp
+
+
 gamma = 0.5
-# 转化后的MRP的状态转移矩阵
-P_from_mdp_to_mrp = [
-    [0.5, 0.5, 0.0, 0.0, 0.0],
-    [0.5, 0.0, 0.5, 0.0, 0.0],
-    [0.0, 0.0, 0.0, 0.5, 0.5],
-    [0.0, 0.1, 0.2, 0.2, 0.5],
-    [0.0, 0.0, 0.0, 0.0, 1.0],
-]
-P_from_mdp_to_mrp = np.array(P_from_mdp_to_mrp)
-R_from_mdp_to_mrp = [-0.5, -1.5, -1.0, 5.5, 0]
+# 转化后的MRP的状态转移矩阵和奖励函数,由策略1自动计算
+P_from_mdp_to_mrp, R_from_mdp_to_mrp = mdp_to_mrp(MDP, Pi_1)
 
 V = compute(P_from_mdp_to_mrp, R_from_mdp_to_mrp, gamma, 5)
 print("MDP中每个状态价值分别为\n", V)
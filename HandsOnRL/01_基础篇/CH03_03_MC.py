@@ -4,49 +4,110 @@ Monte-Carlo methods
 from CH03_02_MDP import *
 
 
+def cumulative_probs(probs):
+    """
+    沿最后一维计算累积概率表,并归一化使每行最后一个值恰好为1,
+    之后用searchsorted就能找到第一个累积概率大于随机数的下标
+    """
+    cum = np.cumsum(probs, axis=-1)
+    total = cum[..., -1:]
+    return np.divide(cum, total, out=np.zeros_like(cum), where=total > 0)
+
+
 def sample(mdp, pi, _timestep_max, number):
     """
-    采样函数,策略Pi,限制最长时间步timestep_max,总共采样序列数number
+    采样函数,策略Pi,限制最长时间步timestep_max,总共采样序列数number。
+    序列中的状态和动作都是整数下标,S[s]、A[a]是对应的名字
     """
     _s, _a, _p, _r, _gamma = mdp
+    p, r = mdp_to_arrays(mdp)
+    policy = policy_to_array(pi, _s, _a)
+    pi_cum = cumulative_probs(policy)
+    p_cum = cumulative_probs(p)
+    terminal = policy.sum(axis=1) == 0  # 没有可选动作的状态是终止状态
+    starts = np.flatnonzero(~terminal)
     _episodes = []
     for _ in range(number):
         episode = []
         timestep = 0
-        s = _s[np.random.randint(4)]  # 随机选择一个除s5以外的状态s作为起点
+        s = starts[np.random.randint(len(starts))]  # 随机选择一个非终止状态s作为起点
         # 当前状态为终止状态或者时间步太长时,一次采样结束
-        while s != "s5" and timestep <= _timestep_max:
+        while not terminal[s] and timestep <= _timestep_max:
             timestep += 1
-            rand, temp = np.random.rand(), 0
-            a = None
-            r = None
             # 在状态s下根据策略选择动作
-            for a_opt in _a:
-                temp += pi.get(join(s, a_opt), 0)
-                if temp > rand:
-                    a = a_opt
-                    r = _r.get(join(s, a), 0)
-                    break
-            rand, temp = np.random.rand(), 0
-
-            s_next = None
+            a = int(np.searchsorted(pi_cum[s], np.random.rand(), side='right'))
             # 根据状态转移概率得到下一个状态s_next
-            for s_opt in _s:
-                temp += _p.get(join(join(s, a), s_opt), 0)
-                if temp > rand:
-                    s_next = s_opt
-                    break
-            episode.append((s, a, r, s_next))  # 把（s,a,r,s_next）元组放入序列中
+            s_next = int(np.searchsorted(p_cum[s, a], np.random.rand(), side='right'))
+            episode.append((int(s), a, r[s, a], s_next))  # 把（s,a,r,s_next）元组放入序列中
             s = s_next  # s_next变成当前状态,开始接下来的循环
         _episodes.append(episode)
     return _episodes
 
 
+def batch_searchsorted(cum, rows, u):
+    """
+    对cum的rows行分别做searchsorted: 返回每行中第一个累积概率大于u的下标。
+    每行的累积概率都在[0, 1]之间,给第i行加上i后整个表就是有序的,一次searchsorted就能完成
+    """
+    n = cum.shape[-1]
+    cum = cum.reshape(-1, n)
+    offset = np.arange(len(cum))[:, None]
+    flat = (cum + offset).reshape(-1)
+    return np.searchsorted(flat, rows + u, side='right') - rows * n
+
+
+def sample_batch(mdp, pi, _timestep_max, number):
+    """
+    批量采样函数,所有序列并行推进,每一步只需要几次数组运算。
+    返回填充后的数组states, actions, rewards, next_states(形状都是(number, 最长序列长度)),
+    以及每条序列的长度lengths和有效位置的掩码mask
+    """
+    _s, _a, _p, _r, _gamma = mdp
+    p, r = mdp_to_arrays(mdp)
+    policy = policy_to_array(pi, _s, _a)
+    pi_cum = cumulative_probs(policy)
+    p_cum = cumulative_probs(p)
+    terminal = policy.sum(axis=1) == 0  # 没有可选动作的状态是终止状态
+    starts = np.flatnonzero(~terminal)
+
+    max_len = _timestep_max + 1  # 和sample一样,最多采样timestep_max+1步
+    # 按时间步为第一维存储,每一步写入的是连续内存,最后再转置
+    states = np.zeros((max_len, number), dtype=np.int64)
+    actions = np.zeros((max_len, number), dtype=np.int64)
+    next_states = np.zeros((max_len, number), dtype=np.int64)
+    rewards = np.zeros((max_len, number))
+    lengths = np.zeros(number, dtype=np.int64)
+    s = starts[np.random.randint(len(starts), size=number)]  # 随机选择非终止状态作为起点
+    active = np.flatnonzero(~terminal[s])  # 还没有结束的序列
+    for t in range(max_len):
+        if len(active) == 0:
+            break
+        cur = s[active]
+        a = batch_searchsorted(pi_cum, cur, np.random.rand(len(active)))
+        s_next = batch_searchsorted(p_cum, cur * len(_a) + a, np.random.rand(len(active)))
+        states[t, active] = cur
+        actions[t, active] = a
+        rewards[t, active] = r[cur, a]
+        next_states[t, active] = s_next
+        lengths[active] += 1
+        s[active] = s_next
+        active = active[~terminal[s_next]]
+    width = lengths.max()
+    mask = np.arange(width) < lengths[:, None]
+    return (states[:width].T.copy(), actions[:width].T.copy(), rewards[:width].T.copy(),
+            next_states[:width].T.copy(), lengths, mask)
+
+
+def episode_names(episode, _s, _a):
+    # 把序列中的状态和动作下标换成名字,方便打印
+    return [(_s[s], _a[a], float(r), _s[s_next]) for s, a, r, s_next in episode]
+
+
 # 采样5次,每个序列最长不超过20步
 episodes = sample(MDP, Pi_1, 20, 5)
-print('第一条序列\n', episodes[0])
-print('第二条序列\n', episodes[1])
-print('第五条序列\n', episodes[4])
+print('第一条序列\n', episode_names(episodes[0], S, A))
+print('第二条序列\n', episode_names(episodes[1], S, A))
+print('第五条序列\n', episode_names(episodes[4], S, A))
 
 
 # 对所有采样序列计算所有状态的价值
@@ -64,7 +125,7 @@ timestep_max = 20
 # 采样1000次,可以自行修改
 episodes = sample(MDP, Pi_1, timestep_max, 1000)
 gamma = 0.5
-V = {"s1": 0, "s2": 0, "s3": 0, "s4": 0, "s5": 0}
-N = {"s1": 0, "s2": 0, "s3": 0, "s4": 0, "s5": 0}
+V = np.zeros(len(S))
+N = np.zeros(len(S))
 monte_carlo(episodes, V, N, gamma)
-print("使用蒙特卡洛方法计算MDP的状态价值为\n", V)
+print("使用蒙特卡洛方法计算MDP的状态价值为\n", dict(zip(S, V.tolist())))
@@ -20,11 +20,31 @@ def occupancy(_episodes, s, a, _timestep_max, _gamma):
     return (1 - _gamma) * rho
 
 
+def occupancy_all(batch, num_states, num_actions, _gamma):
+    """
+    用sample_batch得到的填充数组一次计算所有状态动作对的占用度量,返回形状为(|S|, |A|)的数组。
+    和occupancy一样,时间步t的频率是(s_t,a_t)=(s,a)的次数除以长度超过t的序列数
+    """
+    states, actions, rewards, next_states, lengths, mask = batch
+    total_times = mask.sum(axis=0)  # 每个时间步t各被经历过几次
+    weights = _gamma ** np.arange(mask.shape[1]) / np.maximum(total_times, 1)
+    weights = np.broadcast_to(weights, mask.shape)[mask]
+    rho = np.bincount(states[mask] * num_actions + actions[mask], weights=weights,
+                      minlength=num_states * num_actions)
+    return (1 - _gamma) * rho.reshape(num_states, num_actions)
+
+
 gamma = 0.5
 timestep_max = 1000
 
 episodes_1 = sample(MDP, Pi_1, timestep_max, 1000)
 episodes_2 = sample(MDP, Pi_2, timestep_max, 1000)
-rho_1 = occupancy(episodes_1, "s4", "概率前往", timestep_max, gamma)
-rho_2 = occupancy(episodes_2, "s4", "概率前往", timestep_max, gamma)
+# 序列中的状态和动作都是整数下标
+rho_1 = occupancy(episodes_1, S.index("s4"), A.index("概率前往"), timestep_max, gamma)
+rho_2 = occupancy(episodes_2, S.index("s4"), A.index("概率前往"), timestep_max, gamma)
 print(rho_1, rho_2)
+
+# 批量采样,并一次计算所有状态动作对的占用度量
+rho_all_1 = occupancy_all(sample_batch(MDP, Pi_1, timestep_max, 1000), len(S), len(A), gamma)
+rho_all_2 = occupancy_all(sample_batch(MDP, Pi_2, timestep_max, 1000), len(S), len(A), gamma)
+print(rho_all_1[S.index("s4"), A.index("概率前往")], rho_all_2[S.index("s4"), A.index("概率前往")])
@@ -1,8 +1,12 @@
 """
 动态规划（dynamic programming）
 """
-import copy
+import heapq
+import time
 import gym
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
 
 
 class CliffWalkingEnv:
@@ -95,7 +99,8 @@ class PolicyIteration:
     def policy_iteration(self):  # 策略迭代
         while 1:
             self.policy_evaluation()
-            old_pi = copy.deepcopy(self.pi)  # 将列表进行深拷贝,方便接下来进行比较
+            # policy_improvement会给每个状态赋值新的列表而不是修改原列表,所以浅拷贝就足够比较
+            old_pi = list(self.pi)
             new_pi = self.policy_improvement()
             if old_pi == new_pi:
                 break
@@ -137,38 +142,88 @@ def main_policy_iteration():
 
 
 class ValueIteration:
-    """ 价值迭代算法 """
-
-    def __init__(self, env, theta, gamma):
+    """
+    价值迭代算法,mode选择更新价值的方式:
+    'sync': 同步更新,每轮用上一轮的价值计算所有状态的新价值
+    'gauss_seidel': 原地更新,计算后面的状态时直接用到前面状态刚更新的价值
+    'prioritized': 优先扫描,只更新贝尔曼残差大于theta的状态,残差越大越先更新
+    """
+
+    def __init__(self, env, theta, gamma, mode='sync'):
         self.env = env
         self.v = [0] * self.env.ncol * self.env.nrow  # 初始化价值为0
         self.theta = theta  # 价值收敛阈值
         self.gamma = gamma
+        self.mode = mode
+        self.num_backups = 0  # 贝尔曼备份(计算一个状态的max_a Q(s,a))的次数
         # 价值迭代结束后得到的策略
         self.pi = [None for i in range(self.env.ncol * self.env.nrow)]
 
+    def backup(self, s):  # 对状态s做一次贝尔曼最优备份
+        self.num_backups += 1
+        qsa_list = []  # 开始计算状态s下的所有Q(s,a)价值
+        for a in range(4):
+            qsa = 0
+            for res in self.env.P[s][a]:
+                p, next_state, r, done = res
+                qsa += p * (r + self.gamma * self.v[next_state] * (1 - done))
+            qsa_list.append(qsa)  # 这一行和下一行代码是价值迭代和策略迭代的主要区别
+        return max(qsa_list)
+
     def value_iteration(self):
-        cnt = 0
-        while 1:
-            max_diff = 0
-            new_v = [0] * self.env.ncol * self.env.nrow
-            for s in range(self.env.ncol * self.env.nrow):
-                qsa_list = []  # 开始计算状态s下的所有Q(s,a)价值
-                for a in range(4):
-                    qsa = 0
-                    for res in self.env.P[s][a]:
-                        p, next_state, r, done = res
-                        qsa += p * (r + self.gamma * self.v[next_state] * (1 - done))
-                    qsa_list.append(qsa)  # 这一行和下一行代码是价值迭代和策略迭代的主要区别
-                new_v[s] = max(qsa_list)
-                max_diff = max(max_diff, abs(new_v[s] - self.v[s]))
-            self.v = new_v
-            if max_diff < self.theta:
-                break  # 满足收敛条件,退出评估迭代
-            cnt += 1
-        print("价值迭代一共进行%d轮" % cnt)
+        if self.mode == 'prioritized':
+            self.prioritized_sweeping()
+        else:
+            cnt = 0
+            while 1:
+                max_diff = 0
+                # 原地更新时直接修改self.v,不需要每轮新建一个列表
+                new_v = self.v if self.mode == 'gauss_seidel' else [0] * self.env.ncol * self.env.nrow
+                for s in range(self.env.ncol * self.env.nrow):
+                    v = self.backup(s)
+                    max_diff = max(max_diff, abs(v - self.v[s]))
+                    new_v[s] = v
+                self.v = new_v
+                if max_diff < self.theta:
+                    break  # 满足收敛条件,退出评估迭代
+                cnt += 1
+            print("价值迭代一共进行%d轮" % cnt)
+        print("一共进行%d次贝尔曼备份" % self.num_backups)
         self.get_policy()
 
+    def get_predecessors(self):  # 前驱状态: predecessors[s']是能够一步转移到s'的所有状态
+        predecessors = [set() for _ in range(self.env.ncol * self.env.nrow)]
+        for s in range(self.env.ncol * self.env.nrow):
+            for a in range(4):
+                for p, next_state, r, done in self.env.P[s][a]:
+                    if p > 0 and not done:  # 终止时不会用到下一个状态的价值
+                        predecessors[next_state].add(s)
+        return predecessors
+
+    def prioritized_sweeping(self):
+        predecessors = self.get_predecessors()
+        # priority[s]是状态s在队列中的残差,0表示不在队列中
+        priority = [0] * self.env.ncol * self.env.nrow
+        heap = []
+        for s in range(self.env.ncol * self.env.nrow):
+            residual = abs(self.backup(s) - self.v[s])
+            if residual > self.theta:
+                priority[s] = residual
+                heap.append((-residual, s))
+        heapq.heapify(heap)
+        while heap:
+            residual, s = heapq.heappop(heap)
+            if -residual != priority[s]:
+                continue  # 过期的队列元素,状态s已经以更大的残差出队过
+            priority[s] = 0
+            self.v[s] = self.backup(s)
+            # 只有s的前驱状态的残差会因为s的价值改变而改变
+            for pre in predecessors[s]:
+                residual = abs(self.backup(pre) - self.v[pre])
+                if residual > self.theta and residual > priority[pre]:
+                    priority[pre] = residual
+                    heapq.heappush(heap, (-residual, pre))
+
     def get_policy(self):  # 根据价值函数导出一个贪婪策略
         for s in range(self.env.nrow * self.env.ncol):
             qsa_list = []
@@ -194,6 +249,226 @@ def main_value_iteration():
     print_agent(agent, action_meaning, list(range(37, 47)), [47])
 
 
+def main_value_iteration_modes():
+    # 比较三种价值迭代方式需要的贝尔曼备份次数,冰湖环境只有到达目标才有奖励
+    from gym.envs.toy_text.frozen_lake import generate_random_map
+    np.random.seed(0)
+    env = gym.make("FrozenLake-v0", desc=generate_random_map(size=30)).unwrapped
+    theta = 1e-5
+    gamma = 0.9
+    for mode in ['sync', 'gauss_seidel', 'prioritized']:
+        start = time.perf_counter()
+        agent = ValueIteration(env, theta, gamma, mode=mode)
+        agent.value_iteration()
+        print("%s: %d次贝尔曼备份, 用时%.3fs" % (mode, agent.num_backups, time.perf_counter() - start))
+
+
+class CompiledModel:
+    """
+    把P[state][action] = [(p, next_state, reward, done)]一次性转换成稀疏矩阵,
+    之后的贝尔曼备份都变成稀疏矩阵和向量的乘法
+    """
+
+    def __init__(self, P):
+        self.num_states = len(P)
+        self.num_actions = len(P[0])
+        rows, cols, probs, rewards, dones = [], [], [], [], []
+        for s in range(self.num_states):
+            for a in range(self.num_actions):
+                row = a * self.num_states + s  # 第a*S+s行对应状态动作对(s,a)
+                for p, next_state, r, done in P[s][a]:
+                    rows.append(row)
+                    cols.append(next_state)
+                    probs.append(p)
+                    rewards.append(r)
+                    dones.append(done)
+        rows = np.array(rows, dtype=np.int64)
+        probs = np.array(probs, dtype=np.float64)
+        # 终止转移不再累加下一个状态的价值,所以直接把(1 - done)乘到转移概率上
+        self.trans = sparse.csr_matrix(
+            (probs * (1 - np.array(dones, dtype=np.float64)), (rows, np.array(cols, dtype=np.int64))),
+            shape=(self.num_states * self.num_actions, self.num_states))
+        # R(s,a) = sum_s' p(s'|s,a) * r
+        self.rewards = np.bincount(rows, weights=probs * np.array(rewards, dtype=np.float64),
+                                   minlength=self.num_states * self.num_actions)
+
+    def q_values(self, v, gamma):
+        # Q(s,a) = R(s,a) + gamma * sum_s' p(s'|s,a) * (1 - done) * V(s')
+        # 按动作优先存储,转置后得到形状为(S, A)的Q值,对动作取最大值时是连续内存上的逐元素运算
+        return (self.rewards + gamma * (self.trans @ v)).reshape(self.num_actions, self.num_states).T
+
+    def policy_model(self, pi):
+        # 按照策略pi对动作求期望,得到MRP的转移矩阵P_pi和奖励R_pi
+        weights = sparse.csr_matrix(
+            (pi.T.reshape(-1), (np.tile(np.arange(self.num_states), self.num_actions),
+                                np.arange(self.num_states * self.num_actions))),
+            shape=(self.num_states, self.num_states * self.num_actions))
+        return (weights @ self.trans).tocsr(), weights @ self.rewards
+
+
+def greedy_policy(q, atol=1e-9):
+    # 有几个动作得到了最大的Q值,就让这些动作均分概率
+    best = np.isclose(q, q.max(axis=1, keepdims=True), rtol=0, atol=atol)
+    return best / best.sum(axis=1, keepdims=True)
+
+
+class SparsePolicyIteration:
+    """
+    基于稀疏矩阵的策略迭代算法,evaluation选择策略评估的方式:
+    'sweep': 反复迭代直到价值变化小于theta(和PolicyIteration相同)
+    'exact': 直接求解线性方程组(I - gamma * P_pi) V = R_pi
+    'iterative': 用BiCGSTAB迭代求解上面的方程组,适合状态数很多的情况
+    'modified': 修正策略迭代,每次只迭代k轮
+    """
+
+    def __init__(self, env, theta, gamma, model=None, evaluation='sweep', k=5):
+        self.env = env
+        self.model = model if model is not None else CompiledModel(env.P)
+        self.v = np.zeros(self.model.num_states)  # 初始化价值为0
+        # 初始化为均匀随机策略
+        self.pi = np.full((self.model.num_states, self.model.num_actions), 1 / self.model.num_actions)
+        self.actions = None  # 贪婪策略选择的动作,用整型数组判断策略是否收敛
+        self.theta = theta  # 策略评估收敛阈值
+        self.gamma = gamma  # 折扣因子
+        self.evaluation = evaluation
+        self.k = k  # 修正策略迭代中每次策略评估迭代的轮数
+        self.max_diff = 0.0  # 最后一轮策略评估中价值的最大变化
+
+    def policy_evaluation(self):  # 策略评估
+        p_pi, r_pi = self.model.policy_model(self.pi)
+        if self.evaluation in ('exact', 'iterative'):
+            a = sparse.identity(self.model.num_states, format='csr') - self.gamma * p_pi
+            if self.evaluation == 'exact':
+                new_v = sparse_linalg.spsolve(a.tocsc(), r_pi)
+            else:
+                # 残差的2范数不超过theta*(1-gamma)时,价值的误差不超过theta
+                try:
+                    new_v, info = sparse_linalg.bicgstab(a, r_pi, x0=self.v, rtol=0,
+                                                         atol=self.theta * (1 - self.gamma))
+                except TypeError:  # 旧版本scipy中的参数名为tol
+                    new_v, info = sparse_linalg.bicgstab(a, r_pi, x0=self.v, tol=0,
+                                                         atol=self.theta * (1 - self.gamma))
+                if info != 0:  # 没有在最大迭代次数内收敛(info>0)或者求解失败(info<0),改为直接求解
+                    print("BiCGSTAB未收敛(info=%d),改用直接求解" % info)
+                    new_v = sparse_linalg.spsolve(a.tocsc(), r_pi)
+            self.max_diff = np.abs(new_v - self.v).max()
+            self.v = new_v
+            print("策略评估完成")
+            return
+        cnt = 1  # 计数器
+        while 1:
+            new_v = r_pi + self.gamma * (p_pi @ self.v)
+            self.max_diff = np.abs(new_v - self.v).max()
+            self.v = new_v
+            if self.max_diff < self.theta or (self.evaluation == 'modified' and cnt >= self.k):
+                break  # 满足收敛条件,退出评估迭代
+            cnt += 1
+        print("策略评估进行%d轮后完成" % cnt)
+
+    def policy_improvement(self):  # 策略提升
+        q = self.model.q_values(self.v, self.gamma)
+        actions = q.argmax(axis=1)
+        if self.actions is not None:
+            # 原来的动作和最优动作的价值相差不到theta时保持不变,
+            # 否则价值几乎相同的动作会因为评估误差来回切换,策略迭代无法停止
+            states = np.arange(self.model.num_states)
+            keep = q[states, self.actions] >= q[states, actions] - self.theta
+            actions = np.where(keep, self.actions, actions)
+        self.actions = actions
+        # 策略由self.actions决定,保证策略评估使用的策略和判断收敛的动作一致
+        self.pi = np.zeros((self.model.num_states, self.model.num_actions))
+        self.pi[np.arange(self.model.num_states), actions] = 1
+        print("策略提升完成")
+        return self.pi
+
+    def policy_iteration(self):  # 策略迭代
+        cnt = 0
+        while 1:
+            self.policy_evaluation()
+            old_actions = self.actions
+            self.policy_improvement()
+            cnt += 1
+            stable = old_actions is not None and np.array_equal(old_actions, self.actions)
+            # 修正策略迭代的价值还没有收敛,需要等价值也稳定下来
+            if stable and (self.evaluation != 'modified' or self.max_diff < self.theta):
+                break
+        print("策略迭代一共进行%d轮" % cnt)
+
+
+class SparseValueIteration:
+    """ 基于稀疏矩阵的价值迭代算法 """
+
+    def __init__(self, env, theta, gamma, model=None):
+        self.env = env
+        self.model = model if model is not None else CompiledModel(env.P)
+        self.v = np.zeros(self.model.num_states)  # 初始化价值为0
+        self.theta = theta  # 价值收敛阈值
+        self.gamma = gamma
+        self.pi = None  # 价值迭代结束后得到的策略
+
+    def value_iteration(self):
+        cnt = 0
+        while 1:
+            new_v = self.model.q_values(self.v, self.gamma).max(axis=1)
+            max_diff = np.abs(new_v - self.v).max()
+            self.v = new_v
+            if max_diff < self.theta:
+                break  # 满足收敛条件,退出评估迭代
+            cnt += 1
+        print("价值迭代一共进行%d轮" % cnt)
+        self.get_policy()
+
+    def get_policy(self):  # 根据价值函数导出一个贪婪策略
+        self.pi = greedy_policy(self.model.q_values(self.v, self.gamma))
+
+
+def main_sparse_value_iteration():
+    env = CliffWalkingEnv()
+    action_meaning = ['^', 'v', '<', '>']
+    theta = 0.001
+    gamma = 0.9
+    agent = SparseValueIteration(env, theta, gamma)
+    agent.value_iteration()
+    print_agent(agent, action_meaning, list(range(37, 47)), [47])
+
+
+def main_large_cliff_walking():
+    # 10^6个状态的悬崖漫步环境,只比较求解时间,不打印策略
+    start = time.perf_counter()
+    env = CliffWalkingEnv(ncol=1000, nrow=1000)
+    print("构建P用时%.2fs" % (time.perf_counter() - start))
+    start = time.perf_counter()
+    model = CompiledModel(env.P)
+    print("转换为稀疏矩阵用时%.2fs" % (time.perf_counter() - start))
+    theta = 0.001
+    gamma = 0.9
+
+    start = time.perf_counter()
+    agent = SparseValueIteration(env, theta, gamma, model)
+    agent.value_iteration()
+    print("稀疏价值迭代用时%.2fs" % (time.perf_counter() - start))
+
+    start = time.perf_counter()
+    agent = SparsePolicyIteration(env, theta, gamma, model)
+    agent.policy_iteration()
+    print("稀疏策略迭代用时%.2fs" % (time.perf_counter() - start))
+
+
+def main_policy_evaluation_backends():
+    # 在大的随机冰湖地图上比较不同的策略评估方式
+    from gym.envs.toy_text.frozen_lake import generate_random_map
+    np.random.seed(0)
+    env = gym.make("FrozenLake-v0", desc=generate_random_map(size=100)).unwrapped
+    model = CompiledModel(env.P)
+    theta = 1e-5
+    gamma = 0.9
+    for evaluation in ['sweep', 'modified', 'iterative', 'exact']:
+        start = time.perf_counter()
+        agent = SparsePolicyIteration(env, theta, gamma, model, evaluation=evaluation)
+        agent.policy_iteration()
+        print("%s: 用时%.3fs" % (evaluation, time.perf_counter() - start))
+
+
 def create_env_frozen_lake():
     env = gym.make("FrozenLake-v0")  # 创建环境
     env = env.unwrapped  # 解封装才能访问状态转移矩阵P
@@ -239,8 +514,23 @@ def frozen_lake_value_iteration():
     print_agent(agent, action_meaning, [5, 7, 11, 12], [15])
 
 
+def frozen_lake_sparse_policy_iteration():
+    env = create_env_frozen_lake()
+    action_meaning = ['<', 'v', '>', '^']
+    theta = 1e-5
+    gamma = 0.9
+    agent = SparsePolicyIteration(env, theta, gamma)
+    agent.policy_iteration()
+    print_agent(agent, action_meaning, [5, 7, 11, 12], [15])
+
+
 if __name__ == '__main__':
     # main_policy_iteration()
     # main_value_iteration()
     # frozen_lake_policy_iteration()
     frozen_lake_value_iteration()
+    # main_sparse_value_iteration()
+    # frozen_lake_sparse_policy_iteration()
+    # main_large_cliff_walking()
+    # main_policy_evaluation_backends()
+    # main_value_iteration_modes()
@@ -1,11 +1,14 @@
 import random
+import time
+from collections import deque
 import gym
 import numpy as np
 from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
-from HandsOnRL.rl_utils import ReplayBuffer, moving_average
+from HandsOnRL.rl_utils import ReplayBuffer, FrameStackReplayBuffer, StateBuffer, SoftUpdater, moving_average, \
+    update_from_buffer, train_off_policy_agent
 
 
 class QNet(torch.nn.Module):
@@ -43,20 +46,20 @@ class DQN:
         self.target_update = target_update  # 目标网络更新频率
         self.count = 0  # 计数器,记录更新次数
         self.device = device
+        self.state_buffer = StateBuffer(device)  # 选取动作时的输入缓冲区
+        # 目标网络的同步,hard_update()对整块参数内存做一次原地拷贝
+        self.target_sync = SoftUpdater(self.q_net, self.target_q_net)
 
     def take_action(self, state):  # epsilon-贪婪策略采取动作
-        # 探索
-        if np.random.random() < self.epsilon:
-            action = np.random.randint(self.action_dim)
-        # 利用
-        else:
-            # UserWarning: Creating a tensor from a list of numpy.ndarrays is extremely slow.
-            # Please consider converting the list to a single numpy.ndarray with
-            # numpy.array() before converting to a tensor.
-            # [state] ---> np.array([state])
-            state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-            action = self.q_net(state).argmax().item()
-        return action
+        return self.act_batch(np.array([state]))[0].item()
+
+    def act_batch(self, states):  # 批量选取动作,每个状态独立地进行epsilon-贪婪探索,可用于多个并行环境
+        with torch.inference_mode():
+            actions = self.q_net(self.state_buffer(states)).argmax(dim=1).cpu().numpy()
+        explore = np.random.random(len(actions)) < self.epsilon
+        if explore.any():
+            actions[explore] = np.random.randint(self.action_dim, size=explore.sum())
+        return actions
 
     def update(self, transition_dict):
         states = torch.tensor(transition_dict['states'], dtype=torch.float).to(self.device)
@@ -70,14 +73,20 @@ class DQN:
         max_next_q_values = self.target_q_net(next_states).max(1)[0].view(-1, 1)
         # TD误差目标
         q_targets = rewards + self.gamma * max_next_q_values * (1 - dones)
-        dqn_loss = torch.mean(F.mse_loss(q_values, q_targets))  # 均方误差损失函数
+        if 'weights' in transition_dict:  # 优先经验回放,用重要性采样权重修正损失
+            weights = torch.tensor(transition_dict['weights'], dtype=torch.float).view(-1, 1).to(self.device)
+            dqn_loss = torch.mean(weights * (q_values - q_targets) ** 2)
+        else:
+            dqn_loss = torch.mean(F.mse_loss(q_values, q_targets))  # 均方误差损失函数
         self.optimizer.zero_grad()  # PyTorch中默认梯度会累积,这里需要显式将梯度置为0
         dqn_loss.backward()  # 反向传播更新参数
         self.optimizer.step()
 
         if self.count % self.target_update == 0:
-            self.target_q_net.load_state_dict(self.q_net.state_dict())  # 更新目标网络
+            self.target_sync.hard_update()  # 更新目标网络
         self.count += 1
+        if 'weights' in transition_dict:  # 返回TD误差,用于更新回放池中的优先级
+            return (q_targets - q_values).detach().cpu().numpy()
 
 
 def main():
@@ -130,15 +139,7 @@ def main():
                     episode_return += reward
                     # 当buffer数据的数量超过一定值后,才进行Q网络训练
                     if replay_buffer.size() > minimal_size:
-                        b_s, b_a, b_r, b_ns, b_d = replay_buffer.sample(batch_size)
-                        transition_dict = {
-                            'states': b_s,
-                            'actions': b_a,
-                            'next_states': b_ns,
-                            'rewards': b_r,
-                            'dones': b_d
-                        }
-                        agent.update(transition_dict)
+                        update_from_buffer(agent, replay_buffer, batch_size)
                 return_list.append(episode_return)
                 if (i_episode + 1) % 10 == 0:
                     pbar.set_postfix({
@@ -184,9 +185,176 @@ class ConvolutionalQnet(torch.nn.Module):
         x = F.relu(self.conv1(x))
         x = F.relu(self.conv2(x))
         x = F.relu(self.conv3(x))
-        x = F.relu(self.fc4(x))
+        x = F.relu(self.fc4(x.flatten(1)))
         return self.head(x)
 
 
+def _area_resize_matrix(in_size, out_size):
+    # 区域插值(与cv2.INTER_AREA相同)的权重矩阵,输出的每个像素是它覆盖的输入像素按覆盖长度的加权平均
+    scale = in_size / out_size
+    edges = np.arange(out_size + 1) * scale
+    pixels = np.arange(in_size)
+    overlap = (np.minimum(edges[1:, None], pixels + 1) - np.maximum(edges[:-1, None], pixels)).clip(0)
+    return (overlap / scale).astype(np.float32)
+
+
+class AtariPreprocessing(gym.Wrapper):
+    """
+    Atari画面的预处理:reset时随机执行若干次no-op,每个动作重复frame_skip帧并累加奖励,
+    对最后两帧逐像素取最大值(消除闪烁),转为灰度图并缩放到screen_size x screen_size,返回uint8的单帧画面。
+    env需要不自带跳帧,例如PongNoFrameskip-v4
+    """
+
+    def __init__(self, env, noop_max=30, frame_skip=4, screen_size=84):
+        super(AtariPreprocessing, self).__init__(env)
+        self.noop_max = noop_max
+        self.frame_skip = frame_skip
+        self.screen_size = screen_size
+        height, width = env.observation_space.shape[:2]
+        # 最后两帧的灰度画面
+        self.frame_buffer = np.zeros((2, height, width), dtype=np.uint8)
+        self.resize_h = _area_resize_matrix(height, screen_size)
+        self.resize_w = _area_resize_matrix(width, screen_size).T.copy()
+        self.observation_space = gym.spaces.Box(low=0, high=255, shape=(screen_size, screen_size), dtype=np.uint8)
+
+    def _grayscale(self, obs, out):
+        ale = getattr(self.env.unwrapped, 'ale', None)
+        if ale is not None:
+            ale.getScreenGrayscale(out)  # 直接从模拟器读取灰度画面,写入out
+        else:
+            out[...] = (obs @ np.array([0.299, 0.587, 0.114], dtype=np.float32)).round()
+
+    def _frame(self):
+        frame = np.maximum(self.frame_buffer[0], self.frame_buffer[1])
+        frame = self.resize_h @ frame.astype(np.float32) @ self.resize_w
+        return frame.round().astype(np.uint8)
+
+    def step(self, action):
+        total_reward = 0.0
+        done = False
+        info = {}
+        for t in range(self.frame_skip):
+            obs, reward, done, info = self.env.step(action)
+            total_reward += reward
+            if done:  # 回合提前结束时只用最后一帧
+                self._grayscale(obs, self.frame_buffer[0])
+                self.frame_buffer[1] = self.frame_buffer[0]
+                break
+            if t >= self.frame_skip - 2:
+                self._grayscale(obs, self.frame_buffer[t - self.frame_skip + 2])
+        return self._frame(), total_reward, done, info
+
+    def reset(self, **kwargs):
+        obs = self.env.reset(**kwargs)
+        for _ in range(np.random.randint(self.noop_max + 1)):
+            obs, _, done, _ = self.env.step(0)
+            if done:
+                obs = self.env.reset(**kwargs)
+        self._grayscale(obs, self.frame_buffer[0])
+        self.frame_buffer[1] = self.frame_buffer[0]
+        return self._frame()
+
+
+class FrameStack(gym.Wrapper):
+    """
+    把最近num_stack帧叠成一个状态,形状为(num_stack, H, W);reset时第一帧重复num_stack次
+    """
+
+    def __init__(self, env, num_stack=4):
+        super(FrameStack, self).__init__(env)
+        self.num_stack = num_stack
+        self.frames = deque(maxlen=num_stack)
+        shape = (num_stack,) + env.observation_space.shape
+        self.observation_space = gym.spaces.Box(low=0, high=255, shape=shape, dtype=np.uint8)
+
+    def step(self, action):
+        frame, reward, done, info = self.env.step(action)
+        self.frames.append(frame)
+        return np.stack(self.frames), reward, done, info
+
+    def reset(self, **kwargs):
+        frame = self.env.reset(**kwargs)
+        for _ in range(self.num_stack):
+            self.frames.append(frame)
+        return np.stack(self.frames)
+
+
+class ConvolutionalDQN(DQN):
+    """
+    使用卷积Q网络的DQN,输入为FrameStack叠成的num_stack x 84 x 84的uint8画面
+    """
+
+    def __init__(self, action_dim, learning_rate, gamma, epsilon, target_update, device, num_stack=4):
+        self.action_dim = action_dim
+        self.q_net = ConvolutionalQnet(action_dim, num_stack).to(device)
+        self.target_q_net = ConvolutionalQnet(action_dim, num_stack).to(device)
+        self.optimizer = torch.optim.Adam(self.q_net.parameters(), lr=learning_rate)
+        self.gamma = gamma
+        self.epsilon = epsilon
+        self.target_update = target_update
+        self.count = 0
+        self.device = device
+        self.state_buffer = StateBuffer(device)
+        self.target_sync = SoftUpdater(self.q_net, self.target_q_net)
+        self.target_sync.hard_update()
+
+
+def main_atari():
+    lr = 1e-4
+    num_episodes = 500
+    gamma = 0.99
+    epsilon = 0.05
+    target_update = 1000
+    buffer_size = 100000  # 每条数据只保存一帧84x84的uint8画面,约0.7GB
+    minimal_size = 10000
+    batch_size = 32
+    num_stack = 4
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    env_name = "PongNoFrameskip-v4"
+    env = FrameStack(AtariPreprocessing(gym.make(env_name)), num_stack)
+    random.seed(0)
+    np.random.seed(0)
+    env.seed(0)
+    torch.manual_seed(0)
+
+    replay_buffer = FrameStackReplayBuffer(buffer_size, num_stack)
+    agent = ConvolutionalDQN(env.action_space.n, lr, gamma, epsilon, target_update, device, num_stack)
+    return_list = train_off_policy_agent(env, agent, num_episodes, replay_buffer, minimal_size, batch_size)
+
+    episodes_list = list(range(len(return_list)))
+    plt.plot(episodes_list, moving_average(return_list, 9))
+    plt.xlabel('Episodes')
+    plt.ylabel('Returns')
+    plt.title('DQN on {}'.format(env_name))
+    plt.show()
+
+
+def main_benchmark_target_sync():
+    # 比较load_state_dict(state_dict())和SoftUpdater.hard_update()同步目标网络的耗时
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    num_iters = 1000
+
+    def timeit(fn):
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / num_iters * 1e6
+
+    for name, make_net in [('QNet', lambda: QNet(4, 128, 2)), ('ConvolutionalQnet', lambda: ConvolutionalQnet(6))]:
+        q_net, target_q_net = make_net().to(device), make_net().to(device)
+        time_state_dict = timeit(lambda: target_q_net.load_state_dict(q_net.state_dict()))
+        target_sync = SoftUpdater(q_net, target_q_net)
+        time_flat = timeit(target_sync.hard_update)
+        print(f"{name}: load_state_dict {time_state_dict:.1f} us, flat copy_ {time_flat:.1f} us")
+
+
 if __name__ == '__main__':
     main()
+    # main_atari()
+    # main_benchmark_target_sync()
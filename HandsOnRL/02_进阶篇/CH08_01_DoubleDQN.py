@@ -40,14 +40,20 @@ class DQN:
         self.count = 0
         self.dqn_type = dqn_type
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
+        # 目标网络的同步,hard_update()对整块参数内存做一次原地拷贝
+        self.target_sync = rl_utils.SoftUpdater(self.q_net, self.target_q_net)
 
-    def take_action(self, state):
-        if np.random.random() < self.epsilon:
-            action = np.random.randint(self.action_dim)
-        else:
-            state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-            action = self.q_net(state).argmax().item()
-        return action
+    def take_action(self, state):  # epsilon-贪婪策略采取动作
+        return self.act_batch(np.array([state]))[0].item()
+
+    def act_batch(self, states):  # 批量选取动作,每个状态独立地进行epsilon-贪婪探索,可用于多个并行环境
+        with torch.inference_mode():
+            actions = self.q_net(self.state_buffer(states)).argmax(dim=1).cpu().numpy()
+        explore = np.random.random(len(actions)) < self.epsilon
+        if explore.any():
+            actions[explore] = np.random.randint(self.action_dim, size=explore.sum())
+        return actions
 
     def max_q_value(self, state):
         state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
@@ -60,22 +66,35 @@ class DQN:
         next_states = torch.tensor(transition_dict['next_states'], dtype=torch.float).to(self.device)
         dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(self.device)
 
-        q_values = self.q_net(states).gather(1, actions)  # Q值
-        # 下个状态的最大Q值
+        batch_size = states.shape[0]
         if self.dqn_type == "DoubleDQN":  # DQN与Double DQN的区别
-            max_action = self.q_net(next_states).max(1)[1].view(-1, 1)
-            max_next_q_values = self.target_q_net(next_states).gather(1, max_action)
-        else:  # DQN的情况
-            max_next_q_values = self.target_q_net(next_states).max(1)[0].view(-1, 1)
+            # 当前状态和下一个状态拼成一批,在线网络只做一次前向传播,同时得到Q值和下个状态的最优动作
+            q_all = self.q_net(torch.cat([states, next_states]))
+            q_values = q_all[:batch_size].gather(1, actions)  # Q值
+            max_action = q_all[batch_size:].detach().argmax(dim=1, keepdim=True)
+        else:
+            q_values = self.q_net(states).gather(1, actions)  # Q值
+        # 下个状态的最大Q值,目标网络不需要计算梯度
+        with torch.no_grad():
+            if self.dqn_type == "DoubleDQN":
+                max_next_q_values = self.target_q_net(next_states).gather(1, max_action)
+            else:  # DQN的情况
+                max_next_q_values = self.target_q_net(next_states).max(1)[0].view(-1, 1)
         q_targets = rewards + self.gamma * max_next_q_values * (1 - dones)  # TD误差目标
-        dqn_loss = torch.mean(F.mse_loss(q_values, q_targets))  # 均方误差损失函数
+        if 'weights' in transition_dict:  # 优先经验回放,用重要性采样权重修正损失
+            weights = torch.tensor(transition_dict['weights'], dtype=torch.float).view(-1, 1).to(self.device)
+            dqn_loss = torch.mean(weights * (q_values - q_targets) ** 2)
+        else:
+            dqn_loss = torch.mean(F.mse_loss(q_values, q_targets))  # 均方误差损失函数
         self.optimizer.zero_grad()  # PyTorch中默认梯度会累积,这里需要显式将梯度置为0
         dqn_loss.backward()  # 反向传播更新参数
         self.optimizer.step()
 
         if self.count % self.target_update == 0:
-            self.target_q_net.load_state_dict(self.q_net.state_dict())  # 更新目标网络
+            self.target_sync.hard_update()  # 更新目标网络
         self.count += 1
+        if 'weights' in transition_dict:  # 返回TD误差,用于更新回放池中的优先级
+            return (q_targets - q_values).detach().cpu().numpy()
 
 
 def dis_to_con(discrete_action, env, action_dim):  # 离散动作转回连续的函数
@@ -105,15 +124,7 @@ def train_dqn(agent, env, num_episodes, replay_buffer, minimal_size, batch_size)
                     state = next_state
                     episode_return += reward
                     if replay_buffer.size() > minimal_size:
-                        b_s, b_a, b_r, b_ns, b_d = replay_buffer.sample(batch_size)
-                        transition_dict = {
-                            'states': b_s,
-                            'actions': b_a,
-                            'next_states': b_ns,
-                            'rewards': b_r,
-                            'dones': b_d
-                        }
-                        agent.update(transition_dict)
+                        rl_utils.update_from_buffer(agent, replay_buffer, batch_size)
                 return_list.append(episode_return)
                 if (i_episode + 1) % 10 == 0:
                     pbar.set_postfix({
@@ -203,8 +214,32 @@ def main():
         plt.title('Double DQN on {}'.format(env_name))
         plt.show()
 
+    def main_prioritized_double_dqn():
+        random.seed(0)
+        np.random.seed(0)
+        env.seed(0)
+        torch.manual_seed(0)
+        # 优先经验回放,按TD误差的大小成比例地采样
+        replay_buffer = rl_utils.PrioritizedReplayBuffer(buffer_size)
+        agent = DQN(
+            state_dim, hidden_dim, action_dim, lr, gamma, epsilon, target_update, device, 'DoubleDQN')
+        return_list, max_q_value_list = train_dqn(
+            agent, env, num_episodes, replay_buffer, minimal_size, batch_size)
+
+        print("---------------------")
+        print(f"mean_PrioritizedDoubleDQN = {np.mean(return_list)}")
+
+        episodes_list = list(range(len(return_list)))
+        mv_return = rl_utils.moving_average(return_list, 5)
+        plt.plot(episodes_list, mv_return)
+        plt.xlabel('Episodes')
+        plt.ylabel('Returns')
+        plt.title('Prioritized Double DQN on {}'.format(env_name))
+        plt.show()
+
     main_dqn()
     # main_double_dqn()
+    # main_prioritized_double_dqn()
 
 
 if __name__ == '__main__':
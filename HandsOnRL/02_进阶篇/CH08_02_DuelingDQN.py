@@ -1,4 +1,5 @@
 import random
+import time
 import gym
 import numpy as np
 import torch
@@ -20,8 +21,9 @@ class VAnet(torch.nn.Module):
         self.fc_V = torch.nn.Linear(hidden_dim, 1)
 
     def forward(self, x):
-        a = self.fc_A(F.relu(self.fc1(x)))
-        v = self.fc_V(F.relu(self.fc1(x)))
+        h = F.relu(self.fc1(x))  # 共享部分只计算一次,A和V都使用它的输出
+        a = self.fc_A(h)
+        v = self.fc_V(h)
         q = v + a - a.mean(1).view(-1, 1)  # Q值由V值和A值计算得到
         return q
 
@@ -47,14 +49,20 @@ class DQN:
         self.count = 0
         self.dqn_type = dqn_type
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
+        # 目标网络的同步,hard_update()对整块参数内存做一次原地拷贝
+        self.target_sync = rl_utils.SoftUpdater(self.q_net, self.target_q_net)
 
-    def take_action(self, state):
-        if np.random.random() < self.epsilon:
-            action = np.random.randint(self.action_dim)
-        else:
-            state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-            action = self.q_net(state).argmax().item()
-        return action
+    def take_action(self, state):  # epsilon-贪婪策略采取动作
+        return self.act_batch(np.array([state]))[0].item()
+
+    def act_batch(self, states):  # 批量选取动作,每个状态独立地进行epsilon-贪婪探索,可用于多个并行环境
+        with torch.inference_mode():
+            actions = self.q_net(self.state_buffer(states)).argmax(dim=1).cpu().numpy()
+        explore = np.random.random(len(actions)) < self.epsilon
+        if explore.any():
+            actions[explore] = np.random.randint(self.action_dim, size=explore.sum())
+        return actions
 
     def max_q_value(self, state):
         state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
@@ -67,21 +75,35 @@ class DQN:
         next_states = torch.tensor(transition_dict['next_states'], dtype=torch.float).to(self.device)
         dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(self.device)
 
-        q_values = self.q_net(states).gather(1, actions)
-        if self.dqn_type == 'DoubleDQN':
-            max_action = self.q_net(next_states).max(1)[1].view(-1, 1)
-            max_next_q_values = self.target_q_net(next_states).gather(1, max_action)
+        batch_size = states.shape[0]
+        if self.dqn_type == 'DoubleDQN':  # DQN与Double DQN的区别
+            # 当前状态和下一个状态拼成一批,在线网络只做一次前向传播,同时得到Q值和下个状态的最优动作
+            q_all = self.q_net(torch.cat([states, next_states]))
+            q_values = q_all[:batch_size].gather(1, actions)  # Q值
+            max_action = q_all[batch_size:].detach().argmax(dim=1, keepdim=True)
         else:
-            max_next_q_values = self.target_q_net(next_states).max(1)[0].view(-1, 1)
+            q_values = self.q_net(states).gather(1, actions)  # Q值
+        # 下个状态的最大Q值,目标网络不需要计算梯度
+        with torch.no_grad():
+            if self.dqn_type == 'DoubleDQN':
+                max_next_q_values = self.target_q_net(next_states).gather(1, max_action)
+            else:  # DQN的情况
+                max_next_q_values = self.target_q_net(next_states).max(1)[0].view(-1, 1)
         q_targets = rewards + self.gamma * max_next_q_values * (1 - dones)
-        dqn_loss = torch.mean(F.mse_loss(q_values, q_targets))
+        if 'weights' in transition_dict:  # 优先经验回放,用重要性采样权重修正损失
+            weights = torch.tensor(transition_dict['weights'], dtype=torch.float).view(-1, 1).to(self.device)
+            dqn_loss = torch.mean(weights * (q_values - q_targets) ** 2)
+        else:
+            dqn_loss = torch.mean(F.mse_loss(q_values, q_targets))
         self.optimizer.zero_grad()
         dqn_loss.backward()
         self.optimizer.step()
 
         if self.count % self.target_update == 0:
-            self.target_q_net.load_state_dict(self.q_net.state_dict())
+            self.target_sync.hard_update()
         self.count += 1
+        if 'weights' in transition_dict:  # 返回TD误差,用于更新回放池中的优先级
+            return (q_targets - q_values).detach().cpu().numpy()
 
 
 def main():
@@ -129,5 +151,61 @@ def main():
     plt.show()
 
 
+def main_benchmark_update():
+    # 在CPU上比较原来的更新(在线网络对states和next_states分别前向传播,VAnet的共享部分计算两次)
+    # 和拼接成一批只前向传播一次的更新,每秒能完成的更新次数
+    device = torch.device("cpu")
+    state_dim, hidden_dim, action_dim = 3, 128, 11
+    num_iters = 300
+
+    def separate_forward(net, x):
+        if isinstance(net, VAnet):
+            a = net.fc_A(F.relu(net.fc1(x)))
+            v = net.fc_V(F.relu(net.fc1(x)))
+            return v + a - a.mean(1).view(-1, 1)
+        return net(x)
+
+    def separate_update(agent, transition_dict):
+        states = torch.tensor(transition_dict['states'], dtype=torch.float).to(device)
+        actions = torch.tensor(transition_dict['actions']).view(-1, 1).to(device)
+        rewards = torch.tensor(transition_dict['rewards'], dtype=torch.float).view(-1, 1).to(device)
+        next_states = torch.tensor(transition_dict['next_states'], dtype=torch.float).to(device)
+        dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(device)
+        q_values = separate_forward(agent.q_net, states).gather(1, actions)
+        if agent.dqn_type == 'DoubleDQN':
+            max_action = separate_forward(agent.q_net, next_states).max(1)[1].view(-1, 1)
+            max_next_q_values = separate_forward(agent.target_q_net, next_states).gather(1, max_action)
+        else:
+            max_next_q_values = separate_forward(agent.target_q_net, next_states).max(1)[0].view(-1, 1)
+        q_targets = rewards + agent.gamma * max_next_q_values * (1 - dones)
+        dqn_loss = torch.mean(F.mse_loss(q_values, q_targets))
+        agent.optimizer.zero_grad()
+        dqn_loss.backward()
+        agent.optimizer.step()
+
+    def updates_per_second(fn):
+        for _ in range(10):
+            fn()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            fn()
+        return num_iters / (time.perf_counter() - start)
+
+    for dqn_type in ['DoubleDQN', 'DuelingDQN']:
+        for batch_size in [64, 128, 256, 512, 1024]:
+            torch.manual_seed(0)
+            agent = DQN(state_dim, hidden_dim, action_dim, 1e-3, 0.98, 0.01, 50, device, dqn_type)
+            transition_dict = {'states': np.random.randn(batch_size, state_dim).astype(np.float32),
+                               'actions': np.random.randint(action_dim, size=batch_size),
+                               'rewards': np.random.randn(batch_size).astype(np.float32),
+                               'next_states': np.random.randn(batch_size, state_dim).astype(np.float32),
+                               'dones': np.zeros(batch_size, dtype=np.uint8)}
+            separate = updates_per_second(lambda: separate_update(agent, transition_dict))
+            fused = updates_per_second(lambda: agent.update(transition_dict))
+            print(f"{dqn_type} batch {batch_size}: separate {separate:.0f} updates/s, "
+                  f"fused {fused:.0f} updates/s ({fused / separate:.2f}x)")
+
+
 if __name__ == '__main__':
     main()
+    # main_benchmark_update()
@@ -1,3 +1,4 @@
+import time
 import gym
 import torch
 import torch.nn.functional as F
@@ -19,39 +20,68 @@ class PolicyNet(torch.nn.Module):
 
 
 class REINFORCE:
-    def __init__(self, state_dim, hidden_dim, action_dim, learning_rate, gamma, device):
+    def __init__(self, state_dim, hidden_dim, action_dim, learning_rate, gamma, device, baseline=False):
         self.policy_net = PolicyNet(state_dim, hidden_dim, action_dim).to(device)
         # 使用Adam优化器
         self.optimizer = torch.optim.Adam(self.policy_net.parameters(), lr=learning_rate)
         self.gamma = gamma  # 折扣因子
+        self.baseline = baseline  # 是否减去回报的平均值作为基线,以减小方差
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):  # 根据动作概率分布随机采样
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        probs = self.policy_net(state)
-        action_dist = torch.distributions.Categorical(probs)
-        action = action_dist.sample()
-        return action.item()
+        return self.act_batch(np.array([state]))[0].item()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            probs = self.policy_net(self.state_buffer(states))
+            actions = torch.distributions.Categorical(probs).sample()
+        return actions.cpu().numpy()
+
+    def policy_loss(self, transition_dict):
+        """
+        transition_dict中可以依次存放多条完整的序列,用dones划分。
+        一次性计算所有时间步的回报,再通过一次前向传播得到整批数据的损失
+        """
+        states = torch.tensor(np.array(transition_dict['states']), dtype=torch.float).to(self.device)
+        actions = torch.tensor(transition_dict['actions']).view(-1, 1).to(self.device)
+        rewards = torch.tensor(transition_dict['rewards'], dtype=torch.float).view(-1, 1).to(self.device)
+        dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(self.device)
+
+        # G_t = r_t + gamma * G_{t+1},就是lmbda=1时的反向折扣累加
+        returns = rl_utils.compute_advantage(self.gamma, 1.0, rewards, dones)
+        if self.baseline:
+            returns = returns - returns.mean()
+        log_probs = torch.log(self.policy_net(states).gather(1, actions))
+        num_episodes = max(dones.sum().item(), 1)
+        # 对每一步的损失求和,和逐步反向传播得到的梯度相同;多条序列时对序列数取平均
+        return -(log_probs * returns).sum() / num_episodes
 
     def update(self, transition_dict):
-        reward_list = transition_dict['rewards']
-        state_list = transition_dict['states']
-        action_list = transition_dict['actions']
-
-        g = 0
         self.optimizer.zero_grad()
-        for i in reversed(range(len(reward_list))):  # 从最后一步算起
-            reward = reward_list[i]
-            state = torch.tensor(np.array([state_list[i]]), dtype=torch.float).to(self.device)
-            action = torch.tensor([action_list[i]]).view(-1, 1).to(self.device)
-            log_prob = torch.log(self.policy_net(state).gather(1, action))
-            g = self.gamma * g + reward
-            loss = -log_prob * g  # 每一步的损失函数
-            loss.backward()  # 反向传播计算梯度
+        loss = self.policy_loss(transition_dict)
+        loss.backward()  # 反向传播计算梯度
         self.optimizer.step()  # 梯度下降
 
 
-def main():
+def update_loop(agent, transition_dict):
+    # 原来的实现:从最后一步算起,每一步单独前向传播和反向传播,只累加梯度,用作对比
+    reward_list = transition_dict['rewards']
+    state_list = transition_dict['states']
+    action_list = transition_dict['actions']
+
+    g = 0
+    for i in reversed(range(len(reward_list))):
+        reward = reward_list[i]
+        state = torch.tensor(np.array([state_list[i]]), dtype=torch.float).to(agent.device)
+        action = torch.tensor([action_list[i]]).view(-1, 1).to(agent.device)
+        log_prob = torch.log(agent.policy_net(state).gather(1, action))
+        g = agent.gamma * g + reward
+        loss = -log_prob * g
+        loss.backward()
+
+
+def main(episodes_per_update=1, baseline=False):
     learning_rate = 1e-3
     num_episodes = 1000
     hidden_dim = 128
@@ -64,20 +94,22 @@ def main():
     torch.manual_seed(0)
     state_dim = env.observation_space.shape[0]
     action_dim = env.action_space.n
-    agent = REINFORCE(state_dim, hidden_dim, action_dim, learning_rate, gamma, device)
+    agent = REINFORCE(state_dim, hidden_dim, action_dim, learning_rate, gamma, device, baseline)
 
     return_list = []
+    transition_dict = None
     for i in range(10):
         with tqdm(total=int(num_episodes / 10), desc='Iteration %d' % i) as pbar:
             for i_episode in range(int(num_episodes / 10)):
                 episode_return = 0
-                transition_dict = {
-                    'states': [],
-                    'actions': [],
-                    'next_states': [],
-                    'rewards': [],
-                    'dones': []
-                }
+                if transition_dict is None:
+                    transition_dict = {
+                        'states': [],
+                        'actions': [],
+                        'next_states': [],
+                        'rewards': [],
+                        'dones': []
+                    }
                 state = env.reset()
                 done = False
                 while not done:
@@ -92,7 +124,10 @@ def main():
                     state = next_state
                     episode_return += reward
                 return_list.append(episode_return)
-                agent.update(transition_dict)
+                # 累积episodes_per_update条序列后进行一次更新
+                if len(return_list) % episodes_per_update == 0:
+                    agent.update(transition_dict)
+                    transition_dict = None
                 if (i_episode + 1) % 10 == 0:
                     pbar.set_postfix({
                         'episode': '%d' % (num_episodes / 10 * i + i_episode + 1),
@@ -116,5 +151,53 @@ def main():
     plt.show()
 
 
+def main_benchmark_update():
+    # 在200步的CartPole序列上比较逐步反向传播和批量更新的梯度与用时
+    gamma = 0.98
+    repeat = 20
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    env = gym.make("CartPole-v0")
+    env.seed(0)
+    torch.manual_seed(0)
+    agent = REINFORCE(env.observation_space.shape[0], 128, env.action_space.n, 1e-3, gamma, device)
+    # 用随机动作收集200个真实状态,当作一条长度为200的序列
+    length = 200
+    transition_dict = {'states': [], 'actions': [], 'rewards': [], 'dones': []}
+    state = env.reset()
+    while len(transition_dict['states']) < length:
+        action = env.action_space.sample()
+        next_state, reward, done, _ = env.step(action)
+        transition_dict['states'].append(state)
+        transition_dict['actions'].append(action)
+        transition_dict['rewards'].append(reward)
+        transition_dict['dones'].append(len(transition_dict['states']) == length)
+        state = env.reset() if done else next_state
+
+    agent.optimizer.zero_grad()
+    update_loop(agent, transition_dict)
+    grads_loop = [param.grad.clone() for param in agent.policy_net.parameters()]
+    agent.optimizer.zero_grad()
+    agent.policy_loss(transition_dict).backward()
+    grads_batch = [param.grad.clone() for param in agent.policy_net.parameters()]
+    max_error = max((g1 - g2).abs().max().item() / (g1.abs().max().item() + 1e-12)
+                    for g1, g2 in zip(grads_loop, grads_batch))
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        agent.optimizer.zero_grad()
+        update_loop(agent, transition_dict)
+    time_loop = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        agent.optimizer.zero_grad()
+        agent.policy_loss(transition_dict).backward()
+    time_batch = (time.perf_counter() - start) / repeat
+    print(f"loop {time_loop * 1e3:.3f} ms, batched {time_batch * 1e3:.3f} ms, "
+          f"speedup {time_loop / time_batch:.1f}x, max relative grad error {max_error:.2e}")
+
+
 if __name__ == '__main__':
     main()
+    # 每10条序列更新一次,并使用基线
+    # main(episodes_per_update=10, baseline=True)
+    # main_benchmark_update()
@@ -40,13 +40,16 @@ class ActorCritic:
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=critic_lr)
         self.gamma = gamma
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        probs = self.actor(state)
-        action_dist = torch.distributions.Categorical(probs)
-        action = action_dist.sample()
-        return action.item()
+        return self.act_batch(np.array([state]))[0].item()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            probs = self.actor(self.state_buffer(states))
+            actions = torch.distributions.Categorical(probs).sample()
+        return actions.cpu().numpy()
 
     def update(self, transition_dict):
         states = torch.tensor(np.array(transition_dict['states']), dtype=torch.float).to(self.device)
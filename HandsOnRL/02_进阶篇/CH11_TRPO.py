@@ -1,10 +1,30 @@
+import time
 import torch
 import numpy as np
 import gym
 import matplotlib.pyplot as plt
 import torch.nn.functional as F
 import HandsOnRL.rl_utils as rl_utils
-import copy
+
+try:
+    from torch.func import functional_call, vmap
+except ImportError:  # torch 2.0之前没有torch.func,只能逐个步长计算
+    from torch.nn.utils.stateless import functional_call
+    vmap = None
+
+
+def vector_to_param_dict(vector, module):
+    """
+    把展平的参数向量按照module中各参数的形状切分成{参数名: 张量},供functional_call使用,
+    不需要复制模型。vector可以有额外的前导维度,表示一批候选参数
+    """
+    params = {}
+    offset = 0
+    for name, param in module.named_parameters():
+        numel = param.numel()
+        params[name] = vector[..., offset:offset + numel].reshape(vector.shape[:-1] + param.shape)
+        offset += numel
+    return params
 
 
 class PolicyNet(torch.nn.Module):
@@ -29,22 +49,12 @@ class ValueNet(torch.nn.Module):
         return self.fc2(x)
 
 
-def compute_advantage(gamma, lmbda, td_delta):
-    td_delta = td_delta.detach().numpy()
-    advantage_list = []
-    advantage = 0.0
-    for delta in td_delta[::-1]:
-        advantage = gamma * lmbda * advantage + delta
-        advantage_list.append(advantage)
-    advantage_list.reverse()
-    return torch.tensor(np.array(advantage_list), dtype=torch.float)
-
-
 class TRPO:
     """ TRPO算法 """
 
     def __init__(self, hidden_dim, state_space, action_space, lmbda,
-                 kl_constraint, alpha, critic_lr, gamma, device):
+                 kl_constraint, alpha, critic_lr, gamma, device, line_search_batch=1,
+                 damping=0.0, fvp_subsample=1.0):
         state_dim = state_space.shape[0]
         action_dim = action_space.n
         # 策略网络参数不需要优化器更新
@@ -55,14 +65,22 @@ class TRPO:
         self.lmbda = lmbda  # GAE参数
         self.kl_constraint = kl_constraint  # KL距离最大限制
         self.alpha = alpha  # 线性搜索参数
+        # 线性搜索时一次批量计算的步长个数,在GPU上每次调用开销较大时可以设为大于1
+        self.line_search_batch = line_search_batch
+        self.damping = damping  # 费舍尔矩阵的阻尼系数
+        self.fvp_subsample = fvp_subsample  # 估计费舍尔矩阵时使用的状态比例
+        self.cg_stats = {}  # 最近一次更新中共轭梯度法的残差和用时
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        probs = self.actor(state)
-        action_dist = torch.distributions.Categorical(probs)
-        action = action_dist.sample()
-        return action.item()
+        return self.act_batch(np.array([state]))[0].item()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            probs = self.actor(self.state_buffer(states))
+            actions = torch.distributions.Categorical(probs).sample()
+        return actions.cpu().numpy()
 
     def hessian_matrix_vector_product(self, states, old_action_dists, vector):
         # 计算黑塞矩阵和一个向量的乘积
@@ -78,13 +96,40 @@ class TRPO:
         grad2_vector = torch.cat([grad.view(-1) for grad in grad2])
         return grad2_vector
 
-    def conjugate_gradient(self, grad, states, old_action_dists):  # 共轭梯度法求解方程
+    def fisher_vector_product(self, states, old_action_dists):
+        """
+        返回计算费舍尔矩阵(平均KL距离的黑塞矩阵)与向量乘积的函数fvp(v) = Hv + damping * v。
+        KL距离的一阶梯度图只构建一次,共轭梯度的每次迭代只需要在这张图上做一次反向传播。
+        fvp_subsample小于1时只随机用这个比例的状态来估计费舍尔矩阵
+        """
+        if self.fvp_subsample < 1:
+            num = max(1, int(len(states) * self.fvp_subsample))
+            idx = torch.randperm(len(states), device=states.device)[:num]
+            states = states[idx]
+            old_action_dists = torch.distributions.Categorical(old_action_dists.probs[idx])
+        new_action_dists = torch.distributions.Categorical(self.actor(states))
+        # 计算平均KL距离
+        kl = torch.mean(torch.distributions.kl.kl_divergence(old_action_dists, new_action_dists))
+        params = list(self.actor.parameters())
+        kl_grad = torch.autograd.grad(kl, params, create_graph=True)
+        kl_grad_vector = torch.cat([grad.reshape(-1) for grad in kl_grad])
+
+        def fvp(vector):
+            # KL距离的梯度先和向量进行点积运算,再求一次梯度
+            grad2 = torch.autograd.grad(torch.dot(kl_grad_vector, vector), params, retain_graph=True)
+            return torch.cat([grad.reshape(-1) for grad in grad2]) + self.damping * vector
+        return fvp
+
+    def conjugate_gradient(self, grad, fvp):  # 共轭梯度法求解方程Hx = g, fvp(v)计算Hv
         x = torch.zeros_like(grad)
         r = grad.clone()
         p = grad.clone()
         rdotr = torch.dot(r, r)
+        fvp_times = []
         for i in range(10):  # 共轭梯度主循环
-            Hp = self.hessian_matrix_vector_product(states, old_action_dists, p)
+            start = time.perf_counter()
+            Hp = fvp(p)
+            fvp_times.append(time.perf_counter() - start)
             alpha = rdotr / torch.dot(p, Hp)
             x += alpha * p
             r -= alpha * Hp
@@ -94,6 +139,8 @@ class TRPO:
             beta = new_rdotr / rdotr
             p = r + beta * p
             rdotr = new_rdotr
+        # 记录迭代次数、最终残差的范数和每次迭代中费舍尔向量积的用时
+        self.cg_stats.update(iterations=i + 1, residual=new_rdotr.sqrt().item(), fvp_times=fvp_times)
         return x
 
     def compute_surrogate_obj(self, states, actions, advantage, old_log_probs, actor):  # 计算策略目标
@@ -101,34 +148,51 @@ class TRPO:
         ratio = torch.exp(log_probs - old_log_probs)
         return torch.mean(ratio * advantage)
 
+    def policy_stats(self, para, states, actions, advantage, old_log_probs, old_action_dists):
+        # 用参数向量para计算策略目标和与旧策略的平均KL距离,直接用公式计算以便vmap批量求值
+        probs = functional_call(self.actor, vector_to_param_dict(para, self.actor), (states,))
+        log_probs = torch.log(probs)
+        kl = torch.mean(torch.sum(old_action_dists.probs * (old_action_dists.logits - log_probs), dim=1))
+        ratio = torch.exp(log_probs.gather(1, actions) - old_log_probs)
+        return torch.mean(ratio * advantage), kl
+
     # 线性搜索
-    def line_search(self, states, actions, advantage, old_log_probs, old_action_dists, max_vec):
-        old_para = torch.nn.utils.convert_parameters.parameters_to_vector(self.actor.parameters())
-        old_obj = self.compute_surrogate_obj(states, actions, advantage, old_log_probs, self.actor)
-        for i in range(15):  # 线性搜索主循环
-            coef = self.alpha ** i
-            new_para = old_para + coef * max_vec
-            new_actor = copy.deepcopy(self.actor)
-            torch.nn.utils.convert_parameters.vector_to_parameters(new_para, new_actor.parameters())
-            new_action_dists = torch.distributions.Categorical(new_actor(states))
-            kl_div = torch.mean(torch.distributions.kl.kl_divergence(old_action_dists, new_action_dists))
-            new_obj = self.compute_surrogate_obj(states, actions, advantage, old_log_probs, new_actor)
-            if new_obj > old_obj and kl_div < self.kl_constraint:
-                return new_para
+    def line_search(self, states, actions, advantage, old_log_probs, old_action_dists, max_vec, old_obj):
+        old_para = torch.nn.utils.convert_parameters.parameters_to_vector(self.actor.parameters()).detach()
+        coefs = self.alpha ** torch.arange(15, dtype=torch.float, device=old_para.device)
+
+        def stats(para):
+            return self.policy_stats(para, states, actions, advantage, old_log_probs, old_action_dists)
+
+        with torch.no_grad():
+            # 每次同时计算line_search_batch个步长,取满足条件的最大步长
+            for coef in coefs.split(self.line_search_batch):
+                new_paras = old_para + coef.view(-1, 1) * max_vec
+                if vmap is not None:
+                    new_objs, kl_divs = vmap(stats)(new_paras)
+                else:
+                    new_objs, kl_divs = map(torch.stack, zip(*[stats(para) for para in new_paras]))
+                accepted = torch.nonzero((new_objs > old_obj) & (kl_divs < self.kl_constraint))
+                if len(accepted) > 0:
+                    return new_paras[accepted[0, 0]]
         return old_para
 
     def policy_learn(self, states, actions, old_action_dists, old_log_probs, advantage):  # 更新策略函数
         surrogate_obj = self.compute_surrogate_obj(states, actions, advantage, old_log_probs, self.actor)
         grads = torch.autograd.grad(surrogate_obj, self.actor.parameters())
         obj_grad = torch.cat([grad.view(-1) for grad in grads]).detach()
+        start = time.perf_counter()
+        fvp = self.fisher_vector_product(states, old_action_dists)
+        self.cg_stats = {'build_time': time.perf_counter() - start}
         # 用共轭梯度法计算x = H^(-1)g
-        descent_direction = self.conjugate_gradient(obj_grad, states, old_action_dists)
+        descent_direction = self.conjugate_gradient(obj_grad, fvp)
 
-        Hd = self.hessian_matrix_vector_product(states, old_action_dists, descent_direction)
+        Hd = fvp(descent_direction)
         max_coef = torch.sqrt(2 * self.kl_constraint / (torch.dot(descent_direction, Hd) + 1e-8))
         # 线性搜索
-        new_para = self.line_search(
-            states, actions, advantage, old_log_probs, old_action_dists, descent_direction * max_coef)
+        # 当前参数下的策略目标就是线性搜索要超过的旧目标,不需要重新计算
+        new_para = self.line_search(states, actions, advantage, old_log_probs, old_action_dists,
+                                    descent_direction * max_coef, surrogate_obj.detach())
         # 用线性搜索后的参数更新策略
         torch.nn.utils.convert_parameters.vector_to_parameters(new_para, self.actor.parameters())
 
@@ -140,7 +204,7 @@ class TRPO:
         dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(self.device)
         td_target = rewards + self.gamma * self.critic(next_states) * (1 - dones)
         td_delta = td_target - self.critic(states)
-        advantage = compute_advantage(self.gamma, self.lmbda, td_delta.cpu()).to(self.device)
+        advantage = rl_utils.compute_advantage(self.gamma, self.lmbda, td_delta, dones)
         old_log_probs = torch.log(self.actor(states).gather(1, actions)).detach()
         old_action_dists = torch.distributions.Categorical(self.actor(states).detach())
         critic_loss = torch.mean(F.mse_loss(self.critic(states), td_target.detach()))
@@ -203,7 +267,8 @@ class TRPOContinuous:
     """ 处理连续动作的TRPO算法 """
 
     def __init__(self, hidden_dim, state_space, action_space, lmbda,
-                 kl_constraint, alpha, critic_lr, gamma, device):
+                 kl_constraint, alpha, critic_lr, gamma, device, line_search_batch=1,
+                 damping=0.1, fvp_subsample=1.0):
         state_dim = state_space.shape[0]
         action_dim = action_space.shape[0]
         self.actor = PolicyNetContinuous(state_dim, hidden_dim, action_dim).to(device)
@@ -213,14 +278,21 @@ class TRPOContinuous:
         self.lmbda = lmbda
         self.kl_constraint = kl_constraint
         self.alpha = alpha
+        self.line_search_batch = line_search_batch
+        self.damping = damping  # 费舍尔矩阵的阻尼系数
+        self.fvp_subsample = fvp_subsample  # 估计费舍尔矩阵时使用的状态比例
+        self.cg_stats = {}  # 最近一次更新中共轭梯度法的残差和用时
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        mu, std = self.actor(state)
-        action_dist = torch.distributions.Normal(mu, std)
-        action = action_dist.sample()
-        return [action.item()]
+        return self.act_batch(np.array([state]))[0].tolist()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            mu, std = self.actor(self.state_buffer(states))
+            actions = torch.distributions.Normal(mu, std).sample()
+        return actions.cpu().numpy()
 
     def hessian_matrix_vector_product(self, states, old_action_dists, vector, damping=0.1):
         mu, std = self.actor(states)
@@ -233,14 +305,35 @@ class TRPOContinuous:
         grad2_vector = torch.cat([grad.contiguous().view(-1) for grad in grad2])
         return grad2_vector + damping * vector
 
-    def conjugate_gradient(self, grad, states, old_action_dists):
+    def fisher_vector_product(self, states, old_action_dists):
+        # 和离散动作的TRPO相同,只是策略是高斯分布
+        if self.fvp_subsample < 1:
+            num = max(1, int(len(states) * self.fvp_subsample))
+            idx = torch.randperm(len(states), device=states.device)[:num]
+            states = states[idx]
+            old_action_dists = torch.distributions.Normal(old_action_dists.loc[idx], old_action_dists.scale[idx])
+        mu, std = self.actor(states)
+        new_action_dists = torch.distributions.Normal(mu, std)
+        kl = torch.mean(torch.distributions.kl.kl_divergence(old_action_dists, new_action_dists))
+        params = list(self.actor.parameters())
+        kl_grad = torch.autograd.grad(kl, params, create_graph=True)
+        kl_grad_vector = torch.cat([grad.reshape(-1) for grad in kl_grad])
+
+        def fvp(vector):
+            grad2 = torch.autograd.grad(torch.dot(kl_grad_vector, vector), params, retain_graph=True)
+            return torch.cat([grad.reshape(-1) for grad in grad2]) + self.damping * vector
+        return fvp
+
+    def conjugate_gradient(self, grad, fvp):  # 共轭梯度法求解方程Hx = g, fvp(v)计算Hv
         x = torch.zeros_like(grad)
         r = grad.clone()
         p = grad.clone()
         rdotr = torch.dot(r, r)
+        fvp_times = []
         for i in range(10):
-            Hp = self.hessian_matrix_vector_product(states, old_action_dists,
-                                                    p)
+            start = time.perf_counter()
+            Hp = fvp(p)
+            fvp_times.append(time.perf_counter() - start)
             alpha = rdotr / torch.dot(p, Hp)
             x += alpha * p
             r -= alpha * Hp
@@ -250,6 +343,8 @@ class TRPOContinuous:
             beta = new_rdotr / rdotr
             p = r + beta * p
             rdotr = new_rdotr
+        # 记录迭代次数、最终残差的范数和每次迭代中费舍尔向量积的用时
+        self.cg_stats.update(iterations=i + 1, residual=new_rdotr.sqrt().item(), fvp_times=fvp_times)
         return x
 
     def compute_surrogate_obj(self, states, actions, advantage, old_log_probs, actor):
@@ -259,31 +354,46 @@ class TRPOContinuous:
         ratio = torch.exp(log_probs - old_log_probs)
         return torch.mean(ratio * advantage)
 
-    def line_search(self, states, actions, advantage, old_log_probs, old_action_dists, max_vec):
-        old_para = torch.nn.utils.convert_parameters.parameters_to_vector(self.actor.parameters())
-        old_obj = self.compute_surrogate_obj(states, actions, advantage, old_log_probs, self.actor)
-        for i in range(15):
-            coef = self.alpha ** i
-            new_para = old_para + coef * max_vec
-            new_actor = copy.deepcopy(self.actor)
-            torch.nn.utils.convert_parameters.vector_to_parameters(new_para, new_actor.parameters())
-            mu, std = new_actor(states)
-            new_action_dists = torch.distributions.Normal(mu, std)
-            kl_div = torch.mean(torch.distributions.kl.kl_divergence(old_action_dists, new_action_dists))
-            new_obj = self.compute_surrogate_obj(states, actions, advantage, old_log_probs, new_actor)
-            if new_obj > old_obj and kl_div < self.kl_constraint:
-                return new_para
+    def policy_stats(self, para, states, actions, advantage, old_log_probs, old_action_dists):
+        # 用参数向量para计算策略目标和与旧策略的平均KL距离,直接用高斯分布的公式计算以便vmap批量求值
+        mu, std = functional_call(self.actor, vector_to_param_dict(para, self.actor), (states,))
+        old_mu, old_std = old_action_dists.loc, old_action_dists.scale
+        kl = torch.log(std / old_std) + (old_std ** 2 + (old_mu - mu) ** 2) / (2 * std ** 2) - 0.5
+        log_probs = -((actions - mu) ** 2) / (2 * std ** 2) - torch.log(std) - 0.5 * np.log(2 * np.pi)
+        ratio = torch.exp(log_probs - old_log_probs)
+        return torch.mean(ratio * advantage), torch.mean(kl)
+
+    def line_search(self, states, actions, advantage, old_log_probs, old_action_dists, max_vec, old_obj):
+        old_para = torch.nn.utils.convert_parameters.parameters_to_vector(self.actor.parameters()).detach()
+        coefs = self.alpha ** torch.arange(15, dtype=torch.float, device=old_para.device)
+
+        def stats(para):
+            return self.policy_stats(para, states, actions, advantage, old_log_probs, old_action_dists)
+
+        with torch.no_grad():
+            for coef in coefs.split(self.line_search_batch):
+                new_paras = old_para + coef.view(-1, 1) * max_vec
+                if vmap is not None:
+                    new_objs, kl_divs = vmap(stats)(new_paras)
+                else:
+                    new_objs, kl_divs = map(torch.stack, zip(*[stats(para) for para in new_paras]))
+                accepted = torch.nonzero((new_objs > old_obj) & (kl_divs < self.kl_constraint))
+                if len(accepted) > 0:
+                    return new_paras[accepted[0, 0]]
         return old_para
 
     def policy_learn(self, states, actions, old_action_dists, old_log_probs, advantage):
         surrogate_obj = self.compute_surrogate_obj(states, actions, advantage, old_log_probs, self.actor)
         grads = torch.autograd.grad(surrogate_obj, self.actor.parameters())
         obj_grad = torch.cat([grad.view(-1) for grad in grads]).detach()
-        descent_direction = self.conjugate_gradient(obj_grad, states, old_action_dists)
-        Hd = self.hessian_matrix_vector_product(states, old_action_dists, descent_direction)
+        start = time.perf_counter()
+        fvp = self.fisher_vector_product(states, old_action_dists)
+        self.cg_stats = {'build_time': time.perf_counter() - start}
+        descent_direction = self.conjugate_gradient(obj_grad, fvp)
+        Hd = fvp(descent_direction)
         max_coef = torch.sqrt(2 * self.kl_constraint / (torch.dot(descent_direction, Hd) + 1e-8))
         new_para = self.line_search(states, actions, advantage, old_log_probs, old_action_dists,
-                                    descent_direction * max_coef)
+                                    descent_direction * max_coef, surrogate_obj.detach())
         torch.nn.utils.convert_parameters.vector_to_parameters(new_para, self.actor.parameters())
 
     def update(self, transition_dict):
@@ -295,7 +405,7 @@ class TRPOContinuous:
         rewards = (rewards + 8.0) / 8.0  # 对奖励进行修改,方便训练
         td_target = rewards + self.gamma * self.critic(next_states) * (1 - dones)
         td_delta = td_target - self.critic(states)
-        advantage = compute_advantage(self.gamma, self.lmbda, td_delta.cpu()).to(self.device)
+        advantage = rl_utils.compute_advantage(self.gamma, self.lmbda, td_delta, dones)
         mu, std = self.actor(states)
         old_action_dists = torch.distributions.Normal(mu.detach(), std.detach())
         old_log_probs = old_action_dists.log_prob(actions)
@@ -339,6 +449,44 @@ def main_two():
     plt.show()
 
 
+def main_benchmark_fvp():
+    # 比较每次迭代都重建KL图的黑塞向量积和只构建一次KL梯度图的费舍尔向量积
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    env = gym.make('CartPole-v0')
+    torch.manual_seed(0)
+    agent = TRPO(1024, env.observation_space, env.action_space, 0.95, 0.0005, 0.5, 1e-2, 0.98, device)
+    states = torch.randn(5000, env.observation_space.shape[0], device=device)
+    actions = torch.randint(env.action_space.n, (5000, 1), device=device)
+    advantage = torch.randn(5000, 1, device=device)
+    old_action_dists = torch.distributions.Categorical(agent.actor(states).detach())
+    old_log_probs = torch.log(old_action_dists.probs.gather(1, actions))
+    surrogate_obj = agent.compute_surrogate_obj(states, actions, advantage, old_log_probs, agent.actor)
+    obj_grad = torch.cat([grad.view(-1) for grad in torch.autograd.grad(surrogate_obj, agent.actor.parameters())])
+
+    def rebuild_fvp(vector):
+        return agent.hessian_matrix_vector_product(states, old_action_dists, vector)
+
+    start = time.perf_counter()
+    direction_rebuild = agent.conjugate_gradient(obj_grad, rebuild_fvp)
+    time_rebuild = time.perf_counter() - start
+    print(f"rebuild every iteration: {time_rebuild * 1e3:.1f} ms, {agent.cg_stats['iterations']} iterations, "
+          f"residual {agent.cg_stats['residual']:.2e}")
+    for subsample in [1.0, 0.25]:
+        agent.fvp_subsample = subsample
+        start = time.perf_counter()
+        fvp = agent.fisher_vector_product(states, old_action_dists)
+        agent.cg_stats = {'build_time': time.perf_counter() - start}
+        direction = agent.conjugate_gradient(obj_grad, fvp)
+        total = time.perf_counter() - start
+        error = ((direction - direction_rebuild).norm() / direction_rebuild.norm()).item()
+        print(f"build once (subsample {subsample}): {total * 1e3:.1f} ms "
+              f"(build {agent.cg_stats['build_time'] * 1e3:.1f} ms, "
+              f"fvp {np.mean(agent.cg_stats['fvp_times']) * 1e3:.2f} ms/iter), "
+              f"{agent.cg_stats['iterations']} iterations, residual {agent.cg_stats['residual']:.2e}, "
+              f"relative difference {error:.2e}")
+
+
 if __name__ == '__main__':
     # main_one()
     main_two()
+    # main_benchmark_fvp()
@@ -27,7 +27,7 @@ class PPO:
     """
 
     def __init__(self, state_dim, hidden_dim, action_dim, actor_lr,
-                 critic_lr, lmbda, epochs, eps, gamma, device):
+                 critic_lr, lmbda, epochs, eps, gamma, device, num_minibatches=1, target_kl=None):
         self.actor = PolicyNet(state_dim, hidden_dim, action_dim).to(device)
         self.critic = ValueNet(state_dim, hidden_dim).to(device)
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
@@ -36,45 +36,75 @@ class PPO:
         self.lmbda = lmbda
         self.epochs = epochs
         self.eps = eps
+        self.num_minibatches = num_minibatches  # 每轮训练把数据打乱后分成几个小批量
+        self.target_kl = target_kl  # 新旧策略的近似KL散度超过它时提前停止这次更新
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        mu, sigma = self.actor(state)
-        action_dist = torch.distributions.Normal(mu, sigma)
-        action = action_dist.sample()
-        return [action.item()]
+        return self.act_batch(np.array([state]))[0].tolist()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            mu, std = self.actor(self.state_buffer(states))
+            actions = torch.distributions.Normal(mu, std).sample()
+        return actions.cpu().numpy()
 
     def update(self, transition_dict):
-        states = torch.tensor(np.array(transition_dict['states']), dtype=torch.float).to(self.device)
-        actions = torch.tensor(transition_dict['actions'], dtype=torch.float).view(-1, 1).to(self.device)
-        rewards = torch.tensor(transition_dict['rewards'], dtype=torch.float).view(-1, 1).to(self.device)
-        next_states = torch.tensor(np.array(transition_dict['next_states']), dtype=torch.float).to(self.device)
-        dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(self.device)
+        """
+        transition_dict可以是一条序列(各字段的形状为(T, ...)),
+        也可以是多个并行环境的rollout(形状为(T, N, ...)),按环境分别计算优势后展平成一批数据
+        """
+        rewards = torch.tensor(np.asarray(transition_dict['rewards']), dtype=torch.float).to(self.device)
+        num_steps = rewards.shape[0]
+        rewards = rewards.view(num_steps, -1)
+        dones = torch.tensor(np.asarray(transition_dict['dones']), dtype=torch.float).to(self.device)
+        dones = dones.view(num_steps, -1)
+        states = torch.tensor(np.asarray(transition_dict['states']), dtype=torch.float).to(self.device)
+        states = states.view(rewards.numel(), -1)
+        next_states = torch.tensor(np.asarray(transition_dict['next_states']), dtype=torch.float).to(self.device)
+        next_states = next_states.view(rewards.numel(), -1)
+        actions = torch.tensor(np.asarray(transition_dict['actions']), dtype=torch.float).view(rewards.numel(), -1)
+        actions = actions.to(self.device)
         rewards = (rewards + 8.0) / 8.0  # 和TRPO一样,对奖励进行修改,方便训练
-        td_target = rewards + self.gamma * self.critic(next_states) * (1 - dones)
-        td_delta = td_target - self.critic(states)
-        advantage = rl_utils.compute_advantage(self.gamma, self.lmbda, td_delta.cpu()).to(self.device)
-        mu, std = self.actor(states)
-        action_dists = torch.distributions.Normal(mu.detach(), std.detach())
-        # 动作是正态分布
-        old_log_probs = action_dists.log_prob(actions)
 
-        for _ in range(self.epochs):
+        with torch.no_grad():
+            td_target = rewards + self.gamma * self.critic(next_states).view(num_steps, -1) * (1 - dones)
+            td_delta = td_target - self.critic(states).view(num_steps, -1)
+            advantage = rl_utils.compute_advantage(self.gamma, self.lmbda, td_delta, dones).view(-1, 1)
+            td_target = td_target.view(-1, 1)
             mu, std = self.actor(states)
-            action_dists = torch.distributions.Normal(mu, std)
-            log_probs = action_dists.log_prob(actions)
-            ratio = torch.exp(log_probs - old_log_probs)
-            surr1 = ratio * advantage
-            surr2 = torch.clamp(ratio, 1 - self.eps, 1 + self.eps) * advantage
-            actor_loss = torch.mean(-torch.min(surr1, surr2))
-            critic_loss = torch.mean(F.mse_loss(self.critic(states), td_target.detach()))
-            self.actor_optimizer.zero_grad()
-            self.critic_optimizer.zero_grad()
-            actor_loss.backward()
-            critic_loss.backward()
-            self.actor_optimizer.step()
-            self.critic_optimizer.step()
+            # 动作是正态分布
+            old_log_probs = torch.distributions.Normal(mu, std).log_prob(actions)
+
+        batch_size = len(states)
+        minibatch_size = -(-batch_size // self.num_minibatches)  # 向上取整
+        for _ in range(self.epochs):
+            stop = False
+            # 每轮把数据打乱后分成小批量,每个小批量只做一次前向和一次反向传播
+            for idx in torch.randperm(batch_size, device=self.device).split(minibatch_size):
+                mu, std = self.actor(states[idx])
+                log_probs = torch.distributions.Normal(mu, std).log_prob(actions[idx])
+                log_ratio = log_probs - old_log_probs[idx]
+                ratio = torch.exp(log_ratio)
+                if self.target_kl is not None:
+                    # 近似KL散度 E[(ratio - 1) - log(ratio)],偏离旧策略太远就停止更新
+                    approx_kl = torch.mean((ratio - 1) - log_ratio).item()
+                    if approx_kl > self.target_kl:
+                        stop = True
+                        break
+                surr1 = ratio * advantage[idx]
+                surr2 = torch.clamp(ratio, 1 - self.eps, 1 + self.eps) * advantage[idx]  # 截断
+                actor_loss = torch.mean(-torch.min(surr1, surr2))  # PPO损失函数
+                critic_loss = torch.mean(F.mse_loss(self.critic(states[idx]), td_target[idx]))
+                self.actor_optimizer.zero_grad()
+                self.critic_optimizer.zero_grad()
+                # 两个网络没有共享参数,把损失加起来做一次反向传播,梯度和分别反向传播相同
+                (actor_loss + critic_loss).backward()
+                self.actor_optimizer.step()
+                self.critic_optimizer.step()
+            if stop:
+                break
 
 
 def main():
@@ -1,3 +1,5 @@
+import functools
+import time
 import gym
 import torch
 import torch.nn.functional as F
@@ -34,7 +36,7 @@ class PPO:
     """
 
     def __init__(self, state_dim, hidden_dim, action_dim, actor_lr,
-                 critic_lr, lmbda, epochs, eps, gamma, device):
+                 critic_lr, lmbda, epochs, eps, gamma, device, num_minibatches=1, target_kl=None):
         self.actor = PolicyNet(state_dim, hidden_dim, action_dim).to(device)
         self.critic = ValueNet(state_dim, hidden_dim).to(device)
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
@@ -43,40 +45,70 @@ class PPO:
         self.lmbda = lmbda
         self.epochs = epochs  # 一条序列的数据用来训练轮数
         self.eps = eps  # PPO中截断范围的参数
+        self.num_minibatches = num_minibatches  # 每轮训练把数据打乱后分成几个小批量
+        self.target_kl = target_kl  # 新旧策略的近似KL散度超过它时提前停止这次更新
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        probs = self.actor(state)
-        action_dist = torch.distributions.Categorical(probs)
-        action = action_dist.sample()
-        return action.item()
+        return self.act_batch(np.array([state]))[0].item()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            probs = self.actor(self.state_buffer(states))
+            actions = torch.distributions.Categorical(probs).sample()
+        return actions.cpu().numpy()
 
     def update(self, transition_dict):
-        states = torch.tensor(np.array(transition_dict["states"]), dtype=torch.float).to(self.device)
-        actions = torch.tensor(transition_dict["actions"]).view(-1, 1).to(self.device)
-        rewards = torch.tensor(transition_dict["rewards"], dtype=torch.float).view(-1, 1).to(self.device)
-        next_states = torch.tensor(np.array(transition_dict["next_states"]), dtype=torch.float).to(self.device)
-        dones = torch.tensor(transition_dict["dones"], dtype=torch.float).view(-1, 1).to(self.device)
+        """
+        transition_dict可以是一条序列(各字段的形状为(T, ...)),
+        也可以是多个并行环境的rollout(形状为(T, N, ...)),按环境分别计算优势后展平成一批数据
+        """
+        rewards = torch.tensor(np.asarray(transition_dict["rewards"]), dtype=torch.float).to(self.device)
+        num_steps = rewards.shape[0]
+        rewards = rewards.view(num_steps, -1)
+        dones = torch.tensor(np.asarray(transition_dict["dones"]), dtype=torch.float).to(self.device)
+        dones = dones.view(num_steps, -1)
+        states = torch.tensor(np.asarray(transition_dict["states"]), dtype=torch.float).to(self.device)
+        states = states.view(rewards.numel(), -1)
+        next_states = torch.tensor(np.asarray(transition_dict["next_states"]), dtype=torch.float).to(self.device)
+        next_states = next_states.view(rewards.numel(), -1)
+        actions = torch.tensor(np.asarray(transition_dict["actions"])).view(-1, 1).to(self.device)
 
-        td_target = rewards + self.gamma * self.critic(next_states) * (1 - dones)
-        td_error = td_target - self.critic(states)
-        advantage = rl_utils.compute_advantage(self.gamma, self.lmbda, td_error.cpu()).to(self.device)
-        old_log_probs = torch.log(self.actor(states).gather(1, actions)).detach()
+        with torch.no_grad():
+            td_target = rewards + self.gamma * self.critic(next_states).view(num_steps, -1) * (1 - dones)
+            td_error = td_target - self.critic(states).view(num_steps, -1)
+            advantage = rl_utils.compute_advantage(self.gamma, self.lmbda, td_error, dones).view(-1, 1)
+            td_target = td_target.view(-1, 1)
+            old_log_probs = torch.log(self.actor(states).gather(1, actions))
 
+        batch_size = len(states)
+        minibatch_size = -(-batch_size // self.num_minibatches)  # 向上取整
         for _ in range(self.epochs):
-            log_probs = torch.log(self.actor(states).gather(1, actions))
-            ratio = torch.exp(log_probs - old_log_probs)
-            surr1 = ratio * advantage
-            surr2 = torch.clamp(ratio, 1 - self.eps, 1 + self.eps) * advantage  # 截断
-            actor_loss = torch.mean(-torch.min(surr1, surr2))  # PPO损失函数
-            critic_loss = torch.mean(F.mse_loss(self.critic(states), td_target.detach()))
-            self.actor_optimizer.zero_grad()
-            self.critic_optimizer.zero_grad()
-            actor_loss.backward()
-            critic_loss.backward()
-            self.actor_optimizer.step()
-            self.critic_optimizer.step()
+            stop = False
+            # 每轮把数据打乱后分成小批量,每个小批量只做一次前向和一次反向传播
+            for idx in torch.randperm(batch_size, device=self.device).split(minibatch_size):
+                log_probs = torch.log(self.actor(states[idx]).gather(1, actions[idx]))
+                log_ratio = log_probs - old_log_probs[idx]
+                ratio = torch.exp(log_ratio)
+                if self.target_kl is not None:
+                    # 近似KL散度 E[(ratio - 1) - log(ratio)],偏离旧策略太远就停止更新
+                    approx_kl = torch.mean((ratio - 1) - log_ratio).item()
+                    if approx_kl > self.target_kl:
+                        stop = True
+                        break
+                surr1 = ratio * advantage[idx]
+                surr2 = torch.clamp(ratio, 1 - self.eps, 1 + self.eps) * advantage[idx]  # 截断
+                actor_loss = torch.mean(-torch.min(surr1, surr2))  # PPO损失函数
+                critic_loss = torch.mean(F.mse_loss(self.critic(states[idx]), td_target[idx]))
+                self.actor_optimizer.zero_grad()
+                self.critic_optimizer.zero_grad()
+                # 两个网络没有共享参数,把损失加起来做一次反向传播,梯度和分别反向传播相同
+                (actor_loss + critic_loss).backward()
+                self.actor_optimizer.step()
+                self.critic_optimizer.step()
+            if stop:
+                break
 
 
 def main():
@@ -116,5 +148,127 @@ def main():
     plt.show()
 
 
+def main_vec():
+    actor_lr = 1e-3
+    critic_lr = 1e-2
+    num_episodes = 500
+    hidden_dim = 128
+    gamma = 0.98
+    lmbda = 0.95
+    epochs = 10
+    eps = 0.2
+    num_envs = 8  # 并行环境的数量
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    env_name = 'CartPole-v0'
+    # 环境数量较多、单步开销较大时可以换成rl_utils.SubprocVectorEnv
+    envs = rl_utils.SyncVectorEnv([functools.partial(gym.make, env_name) for _ in range(num_envs)])
+    envs.seed(0)
+    torch.manual_seed(0)
+    state_dim = envs.observation_space.shape[0]
+    action_dim = envs.action_space.n
+    agent = PPO(state_dim, hidden_dim, action_dim, actor_lr,
+                critic_lr, lmbda, epochs, eps, gamma, device)
+
+    return_list = rl_utils.train_on_policy_agent_vec(envs, agent, num_episodes)
+    envs.close()
+
+    episodes_list = list(range(len(return_list)))
+    mv_return = rl_utils.moving_average(return_list, 9)
+    plt.plot(episodes_list, mv_return)
+    plt.xlabel('Episodes')
+    plt.ylabel('Returns')
+    plt.title('PPO ({} envs) on {}'.format(num_envs, env_name))
+    plt.show()
+
+
+def main_rollout():
+    # 所有并行环境各采样num_steps步组成一批rollout,打乱后分成小批量训练,并按近似KL散度提前停止
+    actor_lr = 1e-3
+    critic_lr = 1e-2
+    num_episodes = 500
+    hidden_dim = 128
+    gamma = 0.98
+    lmbda = 0.95
+    epochs = 10
+    eps = 0.2
+    num_envs = 16  # 并行环境的数量
+    num_steps = 128  # 每个环境每次rollout采样的步数
+    num_minibatches = 8
+    target_kl = 0.02
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    env_name = 'CartPole-v0'
+    envs = rl_utils.SyncVectorEnv([functools.partial(gym.make, env_name) for _ in range(num_envs)])
+    envs.seed(0)
+    torch.manual_seed(0)
+    state_dim = envs.observation_space.shape[0]
+    action_dim = envs.action_space.n
+    agent = PPO(state_dim, hidden_dim, action_dim, actor_lr, critic_lr, lmbda,
+                epochs, eps, gamma, device, num_minibatches, target_kl)
+
+    return_list = rl_utils.train_on_policy_agent_rollout(envs, agent, num_episodes, num_steps)
+    envs.close()
+
+    episodes_list = list(range(len(return_list)))
+    mv_return = rl_utils.moving_average(return_list, 9)
+    plt.plot(episodes_list, mv_return)
+    plt.xlabel('Episodes')
+    plt.ylabel('Returns')
+    plt.title('PPO (rollout of {}x{} steps) on {}'.format(num_envs, num_steps, env_name))
+    plt.show()
+
+
+def compute_advantage_loop(gamma, lmbda, td_delta):
+    # 原来的实现:转到numpy上用Python循环逐步计算,再转回张量,用作对比
+    td_delta = td_delta.detach().cpu().numpy()
+    advantage_list = []
+    advantage = 0.0
+    for delta in td_delta[::-1]:
+        advantage = gamma * lmbda * advantage + delta
+        advantage_list.append(advantage)
+    advantage_list.reverse()
+    return torch.tensor(np.array(advantage_list), dtype=torch.float)
+
+
+def main_benchmark_gae():
+    gamma = 0.98
+    lmbda = 0.95
+    repeat = 20
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    torch.manual_seed(0)
+    for length in [200, 2000, 20000, 100000]:
+        td_delta = torch.randn(length, 1, device=device)
+        # 先确认两种实现的结果一致
+        max_error = (rl_utils.compute_advantage(gamma, lmbda, td_delta).cpu()
+                     - compute_advantage_loop(gamma, lmbda, td_delta)).abs().max().item()
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            compute_advantage_loop(gamma, lmbda, td_delta).to(device)
+        time_loop = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            advantage = rl_utils.compute_advantage(gamma, lmbda, td_delta)
+        advantage.sum().item()  # 等待设备上的计算完成
+        time_vec = (time.perf_counter() - start) / repeat
+        print(f"T = {length:6d}: loop {time_loop * 1e3:8.3f} ms, "
+              f"vectorized {time_vec * 1e3:8.3f} ms, "
+              f"speedup {time_loop / time_vec:6.1f}x, max error {max_error:.2e}")
+
+    # 多个并行环境(T x N)并且序列中途结束的情况
+    td_delta = torch.randn(2048, 64, device=device)
+    dones = (torch.rand(2048, 64, device=device) < 0.01).float()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        advantage = rl_utils.compute_advantage(gamma, lmbda, td_delta, dones)
+    advantage.sum().item()
+    print(f"T x N = 2048 x 64 with dones: {(time.perf_counter() - start) / repeat * 1e3:.3f} ms")
+
+
 if __name__ == '__main__':
     main()
+    # main_vec()
+    # main_rollout()
+    # main_benchmark_gae()
@@ -1,4 +1,5 @@
 import random
+import time
 import gym
 import numpy as np
 # from tqdm import tqdm
@@ -7,7 +8,7 @@ import torch
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
 # import HandsOnRL.rl_utils as rl_utils
-from HandsOnRL.rl_utils import ReplayBuffer, train_off_policy_agent, moving_average
+from HandsOnRL.rl_utils import ReplayBuffer, StateBuffer, SoftUpdater, train_off_policy_agent, moving_average
 
 
 class PolicyNet(torch.nn.Module):
@@ -53,19 +54,21 @@ class DDPG:
         self.gamma = gamma
         self.sigma = sigma  # 高斯噪声的标准差,均值直接设为0
         self.tau = tau  # 目标网络软更新参数
+        # 目标网络软更新,每次调用一次性更新所有参数
+        self.actor_soft_update = SoftUpdater(self.actor, self.target_actor, tau)
+        self.critic_soft_update = SoftUpdater(self.critic, self.target_critic, tau)
         self.action_dim = action_dim
         self.device = device
+        self.state_buffer = StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        action = self.actor(state).item()
-        # 给动作添加噪声，增加探索
-        action = action + self.sigma * np.random.randn(self.action_dim)
-        return action
+        return self.act_batch(np.array([state]))[0]
 
-    def soft_update(self, net, target_net):
-        for param_target, param in zip(target_net.parameters(), net.parameters()):
-            param_target.data.copy_(param_target.data * (1.0 - self.tau) + param.data * self.tau)
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            actions = self.actor(self.state_buffer(states)).cpu().numpy()
+        # 给动作添加噪声，增加探索
+        return actions + self.sigma * np.random.randn(*actions.shape)
 
     def update(self, transition_dict):
         states = torch.tensor(np.array(transition_dict['states']), dtype=torch.float).to(self.device)
@@ -86,8 +89,8 @@ class DDPG:
         actor_loss.backward()
         self.actor_optimizer.step()
 
-        self.soft_update(self.actor, self.target_actor)  # 软更新策略网络
-        self.soft_update(self.critic, self.target_critic)  # 软更新价值网络á
+        self.actor_soft_update()  # 软更新策略网络
+        self.critic_soft_update()  # 软更新价值网络
 
 
 def main():
@@ -134,5 +137,48 @@ def main():
     plt.show()
 
 
+def main_benchmark_soft_update():
+    # 比较逐个参数循环,torch._foreach_*多张量操作和展平后一次lerp_三种软更新的耗时
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    tau, num_iters = 0.005, 1000
+
+    def make_mlp(num_layers, hidden_dim):
+        layers = [torch.nn.Linear(3, hidden_dim), torch.nn.ReLU()]
+        for _ in range(num_layers - 1):
+            layers += [torch.nn.Linear(hidden_dim, hidden_dim), torch.nn.ReLU()]
+        return torch.nn.Sequential(*layers).to(device)
+
+    def loop_update(net, target_net):
+        for param_target, param in zip(target_net.parameters(), net.parameters()):
+            param_target.data.copy_(param_target.data * (1.0 - tau) + param.data * tau)
+
+    @torch.no_grad()
+    def foreach_update(net, target_net):
+        target_params = list(target_net.parameters())
+        torch._foreach_mul_(target_params, 1.0 - tau)
+        torch._foreach_add_(target_params, list(net.parameters()), alpha=tau)
+
+    def timeit(fn):
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return (time.perf_counter() - start) / num_iters * 1e6
+
+    for num_layers, hidden_dim in [(2, 64), (8, 256), (32, 256)]:
+        net, target_net = make_mlp(num_layers, hidden_dim), make_mlp(num_layers, hidden_dim)
+        time_loop = timeit(lambda: loop_update(net, target_net))
+        time_foreach = timeit(lambda: foreach_update(net, target_net))
+        soft_update = SoftUpdater(net, target_net, tau)
+        time_flat = timeit(soft_update)
+        print(f"{num_layers} layers x {hidden_dim}: loop {time_loop:.1f} us, foreach {time_foreach:.1f} us, "
+              f"flat lerp_ {time_flat:.1f} us")
+
+
 if __name__ == '__main__':
     main()
+    # main_benchmark_soft_update()
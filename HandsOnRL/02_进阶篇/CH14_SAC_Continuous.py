@@ -1,4 +1,6 @@
+import functools
 import random
+import time
 import gym
 import numpy as np
 import torch
@@ -31,6 +33,8 @@ class PolicyNetContinuous(torch.nn.Module):
 
 
 class QValueNetContinuous(torch.nn.Module):
+    # 单个Q网络,SAC中已经改用QValueNetContinuousEnsemble,只在main_benchmark_critic中作为对比保留
+
     def __init__(self, state_dim, hidden_dim, action_dim):
         super(QValueNetContinuous, self).__init__()
         self.fc1 = torch.nn.Linear(state_dim + action_dim, hidden_dim)
@@ -44,28 +48,42 @@ class QValueNetContinuous(torch.nn.Module):
         return self.fc_out(x)
 
 
+class QValueNetContinuousEnsemble(torch.nn.Module):
+    # num_critics个QValueNetContinuous组成的集成,一次前向传播得到形状为(num_critics, batch, 1)的所有Q值
+
+    def __init__(self, state_dim, hidden_dim, action_dim, num_critics=2):
+        super(QValueNetContinuousEnsemble, self).__init__()
+        self.fc1 = rl_utils.EnsembleLinear(num_critics, state_dim + action_dim, hidden_dim)
+        self.fc2 = rl_utils.EnsembleLinear(num_critics, hidden_dim, hidden_dim)
+        self.fc_out = rl_utils.EnsembleLinear(num_critics, hidden_dim, 1)
+
+    def forward(self, x, a):
+        cat = torch.cat([x, a], dim=-1)
+        x = F.relu(self.fc1(cat))
+        x = F.relu(self.fc2(x))
+        return self.fc_out(x)
+
+
 class SACContinuous:
     # 处理连续动作的SAC算法
 
     def __init__(self, state_dim, hidden_dim, action_dim, action_bound, actor_lr,
-                 critic_lr, alpha_lr, target_entropy, tau, gamma, device):
+                 critic_lr, alpha_lr, target_entropy, tau, gamma, device, num_critics=2, num_min=2):
         # 策略网络
         self.actor = PolicyNetContinuous(state_dim, hidden_dim, action_dim, action_bound).to(device)
-        # 第一个Q网络
-        self.critic_1 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        # 第二个Q网络
-        self.critic_2 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        # 第一个目标Q网络
-        self.target_critic_1 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        # 第二个目标Q网络
-        self.target_critic_2 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
+        # num_critics个Q网络,默认为两个
+        self.critic = QValueNetContinuousEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
+        # 目标Q网络
+        self.target_critic = QValueNetContinuousEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
         # 令目标Q网络的初始参数和Q网络一样
-        self.target_critic_1.load_state_dict(self.critic_1.state_dict())
-        self.target_critic_2.load_state_dict(self.critic_2.state_dict())
+        self.target_critic.load_state_dict(self.critic.state_dict())
 
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
-        self.critic_1_optimizer = torch.optim.Adam(self.critic_1.parameters(), lr=critic_lr)
-        self.critic_2_optimizer = torch.optim.Adam(self.critic_2.parameters(), lr=critic_lr)
+        # 所有Q网络共用一个优化器,Adam按元素更新,与每个Q网络单独一个优化器等价
+        self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=critic_lr)
+        self.num_critics = num_critics
+        # 计算目标Q值时取最小值的Q网络个数,小于num_critics时每次随机选取(REDQ)
+        self.num_min = num_min
         # 使用alpha的log值,可以使训练结果比较稳定
         self.log_alpha = torch.tensor(np.log(0.01), dtype=torch.float)
         # 可以对alpha求梯度
@@ -75,26 +93,29 @@ class SACContinuous:
         self.target_entropy = target_entropy
         self.gamma = gamma
         self.tau = tau
+        # 目标Q网络软更新,每次调用一次性更新所有参数
+        self.critic_soft_update = rl_utils.SoftUpdater(self.critic, self.target_critic, tau)
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        action = self.actor(state)[0]
-        return [action.item()]
+        return self.act_batch(np.array([state]))[0].tolist()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            actions = self.actor(self.state_buffer(states))[0]
+        return actions.cpu().numpy()
 
     def calc_target(self, rewards, next_states, dones):  # 计算目标Q值
         next_actions, log_prob = self.actor(next_states)
         entropy = -log_prob
-        q1_value = self.target_critic_1(next_states, next_actions)
-        q2_value = self.target_critic_2(next_states, next_actions)
-        next_value = torch.min(q1_value, q2_value) + self.log_alpha.exp() * entropy
+        q_values = self.target_critic(next_states, next_actions)
+        if self.num_min < self.num_critics:
+            q_values = q_values[torch.randperm(self.num_critics, device=q_values.device)[:self.num_min]]
+        next_value = q_values.min(dim=0)[0] + self.log_alpha.exp() * entropy
         td_target = rewards + self.gamma * next_value * (1 - dones)
         return td_target
 
-    def soft_update(self, net, target_net):
-        for param_target, param in zip(target_net.parameters(), net.parameters()):
-            param_target.data.copy_(param_target.data * (1.0 - self.tau) + param.data * self.tau)
-
     def update(self, transition_dict):
         states = torch.tensor(np.array(transition_dict['states']), dtype=torch.float).to(self.device)
         actions = torch.tensor(transition_dict['actions'], dtype=torch.float).view(-1, 1).to(self.device)
@@ -104,25 +125,22 @@ class SACContinuous:
         # 和之前章节一样,对倒立摆环境的奖励进行重塑以便训练
         rewards = (rewards + 8.0) / 8.0
 
-        # 更新两个Q网络
+        # 更新所有Q网络
         td_target = self.calc_target(rewards, next_states, dones)
-        critic_1_loss = torch.mean(F.mse_loss(self.critic_1(states, actions), td_target.detach()))
-        critic_2_loss = torch.mean(F.mse_loss(self.critic_2(states, actions), td_target.detach()))
-
-        self.critic_1_optimizer.zero_grad()
-        critic_1_loss.backward()
-        self.critic_1_optimizer.step()
-
-        self.critic_2_optimizer.zero_grad()
-        critic_2_loss.backward()
-        self.critic_2_optimizer.step()
+        q_values = self.critic(states, actions)
+        # 各Q网络均方误差之和,每个Q网络得到的梯度与单独计算时相同
+        critic_loss = F.mse_loss(q_values, td_target.detach().expand_as(q_values)) * self.num_critics
+        self.critic_optimizer.zero_grad()
+        critic_loss.backward()
+        self.critic_optimizer.step()
 
         # 更新策略网络
         new_actions, log_prob = self.actor(states)
         entropy = -log_prob
-        q1_value = self.critic_1(states, new_actions)
-        q2_value = self.critic_2(states, new_actions)
-        actor_loss = torch.mean(-self.log_alpha.exp() * entropy - torch.min(q1_value, q2_value))
+        q_values = self.critic(states, new_actions)
+        # 两个Q网络时取最小值;REDQ中策略网络使用所有Q网络的均值
+        q_value = q_values.min(dim=0)[0] if self.num_min == self.num_critics else q_values.mean(dim=0)
+        actor_loss = torch.mean(-self.log_alpha.exp() * entropy - q_value)
         self.actor_optimizer.zero_grad()
         actor_loss.backward()
         self.actor_optimizer.step()
@@ -133,8 +151,7 @@ class SACContinuous:
         alpha_loss.backward()
         self.log_alpha_optimizer.step()
 
-        self.soft_update(self.critic_1, self.target_critic_1)
-        self.soft_update(self.critic_2, self.target_critic_2)
+        self.critic_soft_update()
 
 
 def main():
@@ -183,5 +200,139 @@ def main():
     plt.show()
 
 
+def main_vec():
+    env_name = 'Pendulum-v0'
+    num_envs = 8  # 并行环境的数量
+    envs = rl_utils.SubprocVectorEnv([functools.partial(gym.make, env_name) for _ in range(num_envs)])
+    state_dim = envs.observation_space.shape[0]
+    action_dim = envs.action_space.shape[0]
+    action_bound = envs.action_space.high[0]  # 动作最大值
+    random.seed(0)
+    np.random.seed(0)
+    envs.seed(0)
+    torch.manual_seed(0)
+
+    actor_lr = 3e-4
+    critic_lr = 3e-3
+    alpha_lr = 3e-4
+    num_episodes = 100
+    hidden_dim = 128
+    gamma = 0.99
+    tau = 0.005  # 软更新参数
+    buffer_size = 100000
+    minimal_size = 1000
+    batch_size = 64
+    target_entropy = -envs.action_space.shape[0]
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    replay_buffer = rl_utils.ReplayBuffer(buffer_size)
+    agent = SACContinuous(state_dim, hidden_dim, action_dim, action_bound, actor_lr,
+                          critic_lr, alpha_lr, target_entropy, tau, gamma, device)
+
+    return_list = rl_utils.train_off_policy_agent_vec(
+        envs, agent, num_episodes, replay_buffer, minimal_size, batch_size)
+    envs.close()
+
+    episodes_list = list(range(len(return_list)))
+    mv_return = rl_utils.moving_average(return_list, 9)
+    plt.plot(episodes_list, mv_return)
+    plt.xlabel('Episodes')
+    plt.ylabel('Returns')
+    plt.title('SAC ({} envs) on {}'.format(num_envs, env_name))
+    plt.show()
+
+
+def main_async():
+    env_name = 'Pendulum-v0'
+    env_fn = functools.partial(gym.make, env_name)
+    env = env_fn()
+    state_dim = env.observation_space.shape[0]
+    action_dim = env.action_space.shape[0]
+    action_bound = env.action_space.high[0]  # 动作最大值
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    actor_lr = 3e-4
+    critic_lr = 3e-3
+    alpha_lr = 3e-4
+    num_episodes = 100
+    hidden_dim = 128
+    gamma = 0.99
+    tau = 0.005  # 软更新参数
+    buffer_size = 100000
+    minimal_size = 1000
+    batch_size = 64
+    num_collectors = 2  # 采样进程的数量
+    update_to_data = 1.0  # 每采样一步更新的次数
+    target_entropy = -env.action_space.shape[0]
+    device = torch.device("cpu")  # 采样进程中的智能体副本在CPU上选取动作
+
+    replay_buffer = rl_utils.ReplayBuffer(buffer_size)
+    agent = SACContinuous(state_dim, hidden_dim, action_dim, action_bound, actor_lr,
+                          critic_lr, alpha_lr, target_entropy, tau, gamma, device)
+
+    return_list = rl_utils.train_off_policy_agent_async(
+        env_fn, agent, num_episodes, replay_buffer, minimal_size, batch_size,
+        num_collectors=num_collectors, update_to_data=update_to_data)
+
+    episodes_list = list(range(len(return_list)))
+    mv_return = rl_utils.moving_average(return_list, 9)
+    plt.plot(episodes_list, mv_return)
+    plt.xlabel('Episodes')
+    plt.ylabel('Returns')
+    plt.title('SAC (async, {} collectors) on {}'.format(num_collectors, env_name))
+    plt.show()
+
+
+def main_benchmark_critic():
+    # 比较逐个更新多个Q网络和集成Q网络一次更新的耗时,包括前向传播,反向传播,优化器和软更新
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    state_dim, action_dim, hidden_dim, batch_size = 3, 1, 128, 256
+    num_iters, tau = 200, 0.005
+    torch.manual_seed(0)
+    states = torch.randn(batch_size, state_dim, device=device)
+    actions = torch.randn(batch_size, action_dim, device=device)
+    td_target = torch.randn(batch_size, 1, device=device)
+
+    def soft_update(net, target_net):
+        for param_target, param in zip(target_net.parameters(), net.parameters()):
+            param_target.data.copy_(param_target.data * (1.0 - tau) + param.data * tau)
+
+    for num_critics in [2, 10]:
+        critics = [QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device) for _ in range(num_critics)]
+        target_critics = [QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
+                          for _ in range(num_critics)]
+        optimizers = [torch.optim.Adam(critic.parameters(), lr=3e-3) for critic in critics]
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            for critic, target_critic, optimizer in zip(critics, target_critics, optimizers):
+                critic_loss = torch.mean(F.mse_loss(critic(states, actions), td_target))
+                optimizer.zero_grad()
+                critic_loss.backward()
+                optimizer.step()
+                soft_update(critic, target_critic)
+        time_loop = (time.perf_counter() - start) / num_iters
+
+        critic = QValueNetContinuousEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
+        target_critic = QValueNetContinuousEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
+        optimizer = torch.optim.Adam(critic.parameters(), lr=3e-3)
+        critic_soft_update = rl_utils.SoftUpdater(critic, target_critic, tau)
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            q_values = critic(states, actions)
+            critic_loss = F.mse_loss(q_values, td_target.expand_as(q_values)) * num_critics
+            optimizer.zero_grad()
+            critic_loss.backward()
+            optimizer.step()
+            critic_soft_update()
+        time_ensemble = (time.perf_counter() - start) / num_iters
+        print(f"{num_critics} critics: loop {time_loop * 1e3:.2f} ms/update, "
+              f"ensemble {time_ensemble * 1e3:.2f} ms/update, speedup {time_loop / time_ensemble:.1f}x")
+
+
 if __name__ == '__main__':
     main()
+    # main_vec()
+    # main_async()
+    # main_benchmark_critic()
@@ -18,13 +18,13 @@ class PolicyNet(torch.nn.Module):
         return F.softmax(self.fc2(x), dim=1)
 
 
-class QValueNet(torch.nn.Module):
-    # 只有一层隐藏层的Q网络
+class QValueNetEnsemble(torch.nn.Module):
+    # num_critics个只有一层隐藏层的Q网络组成的集成,一次前向传播得到形状为(num_critics, batch, action_dim)的所有Q值
 
-    def __init__(self, state_dim, hidden_dim, action_dim):
-        super(QValueNet, self).__init__()
-        self.fc1 = torch.nn.Linear(state_dim, hidden_dim)
-        self.fc2 = torch.nn.Linear(hidden_dim, action_dim)
+    def __init__(self, state_dim, hidden_dim, action_dim, num_critics=2):
+        super(QValueNetEnsemble, self).__init__()
+        self.fc1 = rl_utils.EnsembleLinear(num_critics, state_dim, hidden_dim)
+        self.fc2 = rl_utils.EnsembleLinear(num_critics, hidden_dim, action_dim)
 
     def forward(self, x):
         x = F.relu(self.fc1(x))
@@ -35,23 +35,20 @@ class SAC:
     # 处理离散动作的SAC算法
 
     def __init__(self, state_dim, hidden_dim, action_dim, actor_lr, critic_lr,
-                 alpha_lr, target_entropy, tau, gamma, device):
+                 alpha_lr, target_entropy, tau, gamma, device, num_critics=2, num_min=2):
         # 策略网络
         self.actor = PolicyNet(state_dim, hidden_dim, action_dim).to(device)
-        # 第一个Q网络
-        self.critic_1 = QValueNet(state_dim, hidden_dim, action_dim).to(device)
-        # 第二个Q网络
-        self.critic_2 = QValueNet(state_dim, hidden_dim, action_dim).to(device)
-        # 第一个目标Q网络
-        self.target_critic_1 = QValueNet(state_dim, hidden_dim, action_dim).to(device)
-        # 第二个目标Q网络
-        self.target_critic_2 = QValueNet(state_dim, hidden_dim, action_dim).to(device)
+        # num_critics个Q网络,默认为两个
+        self.critic = QValueNetEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
+        # 目标Q网络
+        self.target_critic = QValueNetEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
         # 令目标Q网络的初始参数和Q网络一样
-        self.target_critic_1.load_state_dict(self.critic_1.state_dict())
-        self.target_critic_2.load_state_dict(self.critic_2.state_dict())
+        self.target_critic.load_state_dict(self.critic.state_dict())
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
-        self.critic_1_optimizer = torch.optim.Adam(self.critic_1.parameters(), lr=critic_lr)
-        self.critic_2_optimizer = torch.optim.Adam(self.critic_2.parameters(), lr=critic_lr)
+        self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=critic_lr)
+        self.num_critics = num_critics
+        # 计算目标Q值时取最小值的Q网络个数,小于num_critics时每次随机选取(REDQ)
+        self.num_min = num_min
         # 使用alpha的log值,可以使训练结果比较稳定
         self.log_alpha = torch.tensor(np.log(0.01), dtype=torch.float)
         # 可以对alpha求梯度
@@ -61,31 +58,33 @@ class SAC:
         self.target_entropy = target_entropy
         self.gamma = gamma
         self.tau = tau
+        # 目标Q网络软更新,每次调用一次性更新所有参数
+        self.critic_soft_update = rl_utils.SoftUpdater(self.critic, self.target_critic, tau)
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        probs = self.actor(state)
-        action_dist = torch.distributions.Categorical(probs)
-        action = action_dist.sample()
-        return action.item()
+        return self.act_batch(np.array([state]))[0].item()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            probs = self.actor(self.state_buffer(states))
+            actions = torch.distributions.Categorical(probs).sample()
+        return actions.cpu().numpy()
 
     # 计算目标Q值,直接用策略网络的输出概率进行期望计算
     def calc_target(self, rewards, next_states, dones):
         next_probs = self.actor(next_states)
         next_log_probs = torch.log(next_probs + 1e-8)
         entropy = -torch.sum(next_probs * next_log_probs, dim=1, keepdim=True)
-        q1_value = self.target_critic_1(next_states)
-        q2_value = self.target_critic_2(next_states)
-        min_qvalue = torch.sum(next_probs * torch.min(q1_value, q2_value), dim=1, keepdim=True)
+        q_values = self.target_critic(next_states)
+        if self.num_min < self.num_critics:
+            q_values = q_values[torch.randperm(self.num_critics, device=q_values.device)[:self.num_min]]
+        min_qvalue = torch.sum(next_probs * q_values.min(dim=0)[0], dim=1, keepdim=True)
         next_value = min_qvalue + self.log_alpha.exp() * entropy
         td_target = rewards + self.gamma * next_value * (1 - dones)
         return td_target
 
-    def soft_update(self, net, target_net):
-        for param_target, param in zip(target_net.parameters(), net.parameters()):
-            param_target.data.copy_(param_target.data * (1.0 - self.tau) + param.data * self.tau)
-
     def update(self, transition_dict):
         states = torch.tensor(np.array(transition_dict['states']), dtype=torch.float).to(self.device)
         # 动作不再是float类型
@@ -94,28 +93,25 @@ class SAC:
         next_states = torch.tensor(np.array(transition_dict['next_states']), dtype=torch.float).to(self.device)
         dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(self.device)
 
-        # 更新两个Q网络
+        # 更新所有Q网络
         td_target = self.calc_target(rewards, next_states, dones)
-        critic_1_q_values = self.critic_1(states).gather(1, actions)
-        critic_1_loss = torch.mean(F.mse_loss(critic_1_q_values, td_target.detach()))
-        critic_2_q_values = self.critic_2(states).gather(1, actions)
-        critic_2_loss = torch.mean(F.mse_loss(critic_2_q_values, td_target.detach()))
-        self.critic_1_optimizer.zero_grad()
-        critic_1_loss.backward()
-        self.critic_1_optimizer.step()
-        self.critic_2_optimizer.zero_grad()
-        critic_2_loss.backward()
-        self.critic_2_optimizer.step()
+        critic_q_values = self.critic(states).gather(2, actions.expand(self.num_critics, -1, -1))
+        # 各Q网络均方误差之和,每个Q网络得到的梯度与单独计算时相同
+        critic_loss = F.mse_loss(critic_q_values, td_target.detach().expand_as(critic_q_values)) * self.num_critics
+        self.critic_optimizer.zero_grad()
+        critic_loss.backward()
+        self.critic_optimizer.step()
 
         # 更新策略网络
         probs = self.actor(states)
         log_probs = torch.log(probs + 1e-8)
         # 直接根据概率计算熵
         entropy = -torch.sum(probs * log_probs, dim=1, keepdim=True)  #
-        q1_value = self.critic_1(states)
-        q2_value = self.critic_2(states)
+        q_values = self.critic(states)
+        # 两个Q网络时取最小值;REDQ中策略网络使用所有Q网络的均值
+        q_value = q_values.min(dim=0)[0] if self.num_min == self.num_critics else q_values.mean(dim=0)
         # 直接根据概率计算期望
-        min_qvalue = torch.sum(probs * torch.min(q1_value, q2_value), dim=1, keepdim=True)
+        min_qvalue = torch.sum(probs * q_value, dim=1, keepdim=True)
         actor_loss = torch.mean(-self.log_alpha.exp() * entropy - min_qvalue)
         self.actor_optimizer.zero_grad()
         actor_loss.backward()
@@ -127,8 +123,7 @@ class SAC:
         alpha_loss.backward()
         self.log_alpha_optimizer.step()
 
-        self.soft_update(self.critic_1, self.target_critic_1)
-        self.soft_update(self.critic_2, self.target_critic_2)
+        self.critic_soft_update()
 
 
 def main():
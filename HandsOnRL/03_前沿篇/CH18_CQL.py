@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import gym
 from tqdm import tqdm
@@ -8,6 +9,10 @@ import torch.nn.functional as F
 from torch.distributions import Normal
 import matplotlib.pyplot as plt
 
+# 仓库根目录,离线数据集默认写在根目录的data/下,与当前工作目录无关
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_DATASET_PATH = os.path.join(REPO_ROOT, 'data', 'Pendulum-v0_SAC')
+
 
 class PolicyNetContinuous(torch.nn.Module):
     def __init__(self, state_dim, hidden_dim, action_dim, action_bound):
@@ -17,10 +22,14 @@ class PolicyNetContinuous(torch.nn.Module):
         self.fc_std = torch.nn.Linear(hidden_dim, action_dim)
         self.action_bound = action_bound
 
-    def forward(self, x):
+    def forward(self, x, num_samples=None):
         x = F.relu(self.fc1(x))
         mu = self.fc_mu(x)
         std = F.softplus(self.fc_std(x))
+        if num_samples is not None:
+            # 每个状态采样num_samples个动作,输出形状为(batch, num_samples, action_dim),状态只经过一次网络
+            mu = mu.unsqueeze(-2).expand(*mu.shape[:-1], num_samples, mu.shape[-1])
+            std = std.unsqueeze(-2).expand_as(mu)
         dist = Normal(mu, std)
         normal_sample = dist.rsample()  # rsample()是重参数化采样
         log_prob = dist.log_prob(normal_sample)
@@ -31,18 +40,30 @@ class PolicyNetContinuous(torch.nn.Module):
         return action, log_prob
 
 
-class QValueNetContinuous(torch.nn.Module):
-    def __init__(self, state_dim, hidden_dim, action_dim):
-        super(QValueNetContinuous, self).__init__()
-        self.fc1 = torch.nn.Linear(state_dim + action_dim, hidden_dim)
-        self.fc2 = torch.nn.Linear(hidden_dim, hidden_dim)
-        self.fc_out = torch.nn.Linear(hidden_dim, 1)
+class QValueNetContinuousEnsemble(torch.nn.Module):
+    # num_critics个有两层隐藏层的Q网络组成的集成,一次前向传播得到形状为(num_critics, batch, 1)的所有Q值
+
+    def __init__(self, state_dim, hidden_dim, action_dim, num_critics=2):
+        super(QValueNetContinuousEnsemble, self).__init__()
+        self.fc1 = rl_utils.EnsembleLinear(num_critics, state_dim + action_dim, hidden_dim)
+        self.fc2 = rl_utils.EnsembleLinear(num_critics, hidden_dim, hidden_dim)
+        self.fc_out = rl_utils.EnsembleLinear(num_critics, hidden_dim, 1)
 
     def forward(self, x, a):
-        cat = torch.cat([x, a], dim=1)
-        x = F.relu(self.fc1(cat))
-        x = F.relu(self.fc2(x))
-        return self.fc_out(x)
+        if a.dim() == 2:
+            cat = torch.cat([x, a], dim=-1)
+            x = F.relu(self.fc1(cat))
+            x = F.relu(self.fc2(x))
+            return self.fc_out(x)
+        # a的形状为(batch, num_actions, action_dim)时每个状态对应多个动作,输出形状为(num_critics, batch, num_actions, 1)
+        # 第一层按输入拆成状态和动作两部分,状态部分只计算一次,不需要把状态复制num_actions份
+        batch_size, num_actions, action_dim = a.shape
+        num_critics, state_dim = self.fc1.weight.shape[0], x.shape[-1]
+        h_state = torch.baddbmm(self.fc1.bias, x.expand(num_critics, -1, -1), self.fc1.weight[:, :state_dim])
+        h_action = torch.matmul(a.reshape(-1, action_dim), self.fc1.weight[:, state_dim:])
+        x = F.relu(h_action.view(num_critics, batch_size, num_actions, -1) + h_state.unsqueeze(2))
+        x = F.relu(self.fc2(x.flatten(1, 2)))
+        return self.fc_out(x).view(num_critics, batch_size, num_actions, 1)
 
 
 class SACContinuous:
@@ -51,23 +72,20 @@ class SACContinuous:
     """
 
     def __init__(self, state_dim, hidden_dim, action_dim, action_bound, actor_lr,
-                 critic_lr, alpha_lr, target_entropy, tau, gamma, device):
+                 critic_lr, alpha_lr, target_entropy, tau, gamma, device, num_critics=2, num_min=2):
         # 策略网络
         self.actor = PolicyNetContinuous(state_dim, hidden_dim, action_dim, action_bound).to(device)
-        # 第一个Q网络
-        self.critic_1 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        # 第二个Q网络
-        self.critic_2 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        # 第一个目标Q网络
-        self.target_critic_1 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        # 第二个目标Q网络
-        self.target_critic_2 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
+        # num_critics个Q网络,默认为两个
+        self.critic = QValueNetContinuousEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
+        # 目标Q网络
+        self.target_critic = QValueNetContinuousEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
         # 令目标Q网络的初始参数和Q网络一样
-        self.target_critic_1.load_state_dict(self.critic_1.state_dict())
-        self.target_critic_2.load_state_dict(self.critic_2.state_dict())
+        self.target_critic.load_state_dict(self.critic.state_dict())
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
-        self.critic_1_optimizer = torch.optim.Adam(self.critic_1.parameters(), lr=critic_lr)
-        self.critic_2_optimizer = torch.optim.Adam(self.critic_2.parameters(), lr=critic_lr)
+        self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=critic_lr)
+        self.num_critics = num_critics
+        # 计算目标Q值时取最小值的Q网络个数,小于num_critics时每次随机选取(REDQ)
+        self.num_min = num_min
         # 使用alpha的log值,可以使训练结果比较稳定
         self.log_alpha = torch.tensor(np.log(0.01), dtype=torch.float)
         self.log_alpha.requires_grad = True  # 对alpha求梯度
@@ -75,27 +93,29 @@ class SACContinuous:
         self.target_entropy = target_entropy  # 目标熵的大小
         self.gamma = gamma
         self.tau = tau
+        # 目标Q网络软更新,每次调用一次性更新所有参数
+        self.critic_soft_update = rl_utils.SoftUpdater(self.critic, self.target_critic, tau)
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        action = self.actor(state)[0]
-        return [action.item()]
+        return self.act_batch(np.array([state]))[0].tolist()
+
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            actions = self.actor(self.state_buffer(states))[0]
+        return actions.cpu().numpy()
 
     def calc_target(self, rewards, next_states, dones):  # 计算目标Q值
         next_actions, log_prob = self.actor(next_states)
         entropy = -log_prob
-        q1_value = self.target_critic_1(next_states, next_actions)
-        q2_value = self.target_critic_2(next_states, next_actions)
-        next_value = torch.min(q1_value, q2_value) + self.log_alpha.exp() * entropy
+        q_values = self.target_critic(next_states, next_actions)
+        if self.num_min < self.num_critics:
+            q_values = q_values[torch.randperm(self.num_critics, device=q_values.device)[:self.num_min]]
+        next_value = q_values.min(dim=0)[0] + self.log_alpha.exp() * entropy
         td_target = rewards + self.gamma * next_value * (1 - dones)
         return td_target
 
-    def soft_update(self, net, target_net):
-        for param_target, param in zip(target_net.parameters(), net.parameters()):
-            param_target.data.copy_(
-                param_target.data * (1.0 - self.tau) + param.data * self.tau)
-
     def update(self, transition_dict):
         states = torch.tensor(transition_dict['states'], dtype=torch.float).to(self.device)
         actions = torch.tensor(transition_dict['actions'], dtype=torch.float).view(-1, 1).to(self.device)
@@ -104,25 +124,22 @@ class SACContinuous:
         dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(self.device)
         rewards = (rewards + 8.0) / 8.0  # 对倒立摆环境的奖励进行重塑
 
-        # 更新两个Q网络
+        # 更新所有Q网络
         td_target = self.calc_target(rewards, next_states, dones)
-        critic_1_loss = torch.mean(
-            F.mse_loss(self.critic_1(states, actions), td_target.detach()))
-        critic_2_loss = torch.mean(
-            F.mse_loss(self.critic_2(states, actions), td_target.detach()))
-        self.critic_1_optimizer.zero_grad()
-        critic_1_loss.backward()
-        self.critic_1_optimizer.step()
-        self.critic_2_optimizer.zero_grad()
-        critic_2_loss.backward()
-        self.critic_2_optimizer.step()
+        q_values = self.critic(states, actions)
+        # 各Q网络均方误差之和,每个Q网络得到的梯度与单独计算时相同
+        critic_loss = F.mse_loss(q_values, td_target.detach().expand_as(q_values)) * self.num_critics
+        self.critic_optimizer.zero_grad()
+        critic_loss.backward()
+        self.critic_optimizer.step()
 
         # 更新策略网络
         new_actions, log_prob = self.actor(states)
         entropy = -log_prob
-        q1_value = self.critic_1(states, new_actions)
-        q2_value = self.critic_2(states, new_actions)
-        actor_loss = torch.mean(-self.log_alpha.exp() * entropy - torch.min(q1_value, q2_value))
+        q_values = self.critic(states, new_actions)
+        # 两个Q网络时取最小值;REDQ中策略网络使用所有Q网络的均值
+        q_value = q_values.min(dim=0)[0] if self.num_min == self.num_critics else q_values.mean(dim=0)
+        actor_loss = torch.mean(-self.log_alpha.exp() * entropy - q_value)
         self.actor_optimizer.zero_grad()
         actor_loss.backward()
         self.actor_optimizer.step()
@@ -133,43 +150,40 @@ class SACContinuous:
         alpha_loss.backward()
         self.log_alpha_optimizer.step()
 
-        self.soft_update(self.critic_1, self.target_critic_1)
-        self.soft_update(self.critic_2, self.target_critic_2)
+        self.critic_soft_update()
 
 
 class CQL:
     def __init__(self, state_dim, hidden_dim, action_dim, action_bound, actor_lr,
-                 critic_lr, alpha_lr, target_entropy, tau, gamma, device, beta, num_random):
+                 critic_lr, alpha_lr, target_entropy, tau, gamma, device, beta, num_random, num_critics=2):
         self.actor = PolicyNetContinuous(state_dim, hidden_dim, action_dim, action_bound).to(device)
-        self.critic_1 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        self.critic_2 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        self.target_critic_1 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        self.target_critic_2 = QValueNetContinuous(state_dim, hidden_dim, action_dim).to(device)
-        self.target_critic_1.load_state_dict(self.critic_1.state_dict())
-        self.target_critic_2.load_state_dict(self.critic_2.state_dict())
+        self.critic = QValueNetContinuousEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
+        self.target_critic = QValueNetContinuousEnsemble(state_dim, hidden_dim, action_dim, num_critics).to(device)
+        self.target_critic.load_state_dict(self.critic.state_dict())
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
-        self.critic_1_optimizer = torch.optim.Adam(self.critic_1.parameters(), lr=critic_lr)
-        self.critic_2_optimizer = torch.optim.Adam(self.critic_2.parameters(), lr=critic_lr)
+        self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=critic_lr)
+        self.num_critics = num_critics
         self.log_alpha = torch.tensor(np.log(0.01), dtype=torch.float)
         self.log_alpha.requires_grad = True  # 对alpha求梯度
         self.log_alpha_optimizer = torch.optim.Adam([self.log_alpha], lr=alpha_lr)
         self.target_entropy = target_entropy  # 目标熵的大小
         self.gamma = gamma
         self.tau = tau
+        # 目标Q网络软更新,每次调用一次性更新所有参数
+        self.critic_soft_update = rl_utils.SoftUpdater(self.critic, self.target_critic, tau)
 
         self.beta = beta  # CQL损失函数中的系数
         self.num_random = num_random  # CQL中的动作采样数
         self.device = device
+        self.state_buffer = rl_utils.StateBuffer(device)  # 选取动作时的输入缓冲区
 
     def take_action(self, state):
-        state = torch.tensor(np.array([state]), dtype=torch.float).to(self.device)
-        action = self.actor(state)[0]
-        return [action.item()]
+        return self.act_batch(np.array([state]))[0].tolist()
 
-    def soft_update(self, net, target_net):
-        for param_target, param in zip(target_net.parameters(), net.parameters()):
-            param_target.data.copy_(
-                param_target.data * (1.0 - self.tau) + param.data * self.tau)
+    def act_batch(self, states):  # 批量选取动作,可用于多个并行环境
+        with torch.inference_mode():
+            actions = self.actor(self.state_buffer(states))[0]
+        return actions.cpu().numpy()
 
     def update(self, transition_dict):
         states = torch.tensor(transition_dict['states'], dtype=torch.float).to(self.device)
@@ -179,83 +193,60 @@ class CQL:
         dones = torch.tensor(transition_dict['dones'], dtype=torch.float).view(-1, 1).to(self.device)
         rewards = (rewards + 8.0) / 8.0  # 对倒立摆环境的奖励进行重塑
 
-        next_actions, log_prob = self.actor(next_states)
-        entropy = -log_prob
-        q1_value = self.target_critic_1(next_states, next_actions)
-        q2_value = self.target_critic_2(next_states, next_actions)
-        next_value = torch.min(q1_value, q2_value) + self.log_alpha.exp() * entropy
-        td_target = rewards + self.gamma * next_value * (1 - dones)
-        critic_1_loss = torch.mean(
-            F.mse_loss(self.critic_1(states, actions), td_target.detach()))
-        critic_2_loss = torch.mean(
-            F.mse_loss(self.critic_2(states, actions), td_target.detach()))
-
-        # 以上与SAC相同,以下Q网络更新是CQL的额外部分
-        batch_size = states.shape[0]
-        random_unif_actions = torch.rand(
-            [batch_size * self.num_random, actions.shape[-1]],
-            dtype=torch.float).uniform_(-1, 1).to(self.device)
-        random_unif_log_pi = np.log(0.5 ** next_actions.shape[-1])
-        tmp_states = states.unsqueeze(1).repeat(1, self.num_random, 1).view(-1, states.shape[-1])
-        tmp_next_states = next_states.unsqueeze(1).repeat(1, self.num_random, 1).view(-1, next_states.shape[-1])
-        random_curr_actions, random_curr_log_pi = self.actor(tmp_states)
-        random_next_actions, random_next_log_pi = self.actor(tmp_next_states)
-        q1_unif = self.critic_1(tmp_states, random_unif_actions).view(-1, self.num_random, 1)
-        q2_unif = self.critic_2(tmp_states, random_unif_actions).view(-1, self.num_random, 1)
-        q1_curr = self.critic_1(tmp_states, random_curr_actions).view(-1, self.num_random, 1)
-        q2_curr = self.critic_2(tmp_states, random_curr_actions).view(-1, self.num_random, 1)
-        q1_next = self.critic_1(tmp_states, random_next_actions).view(-1, self.num_random, 1)
-        q2_next = self.critic_2(tmp_states, random_next_actions).view(-1, self.num_random, 1)
-        q1_cat = torch.cat([
-            q1_unif - random_unif_log_pi,
-            q1_curr - random_curr_log_pi.detach().view(-1, self.num_random, 1),
-            q1_next - random_next_log_pi.detach().view(-1, self.num_random, 1)
-        ],
-            dim=1)
-        q2_cat = torch.cat([
-            q2_unif - random_unif_log_pi,
-            q2_curr - random_curr_log_pi.detach().view(-1, self.num_random, 1),
-            q2_next - random_next_log_pi.detach().view(-1, self.num_random, 1)
-        ],
-            dim=1)
-
-        qf1_loss_1 = torch.logsumexp(q1_cat, dim=1).mean()
-        qf2_loss_1 = torch.logsumexp(q2_cat, dim=1).mean()
-        qf1_loss_2 = self.critic_1(states, actions).mean()
-        qf2_loss_2 = self.critic_2(states, actions).mean()
-        qf1_loss = critic_1_loss + self.beta * (qf1_loss_1 - qf1_loss_2)
-        qf2_loss = critic_2_loss + self.beta * (qf2_loss_1 - qf2_loss_2)
-
-        self.critic_1_optimizer.zero_grad()
-        qf1_loss.backward(retain_graph=True)
-        self.critic_1_optimizer.step()
-        self.critic_2_optimizer.zero_grad()
-        qf2_loss.backward(retain_graph=True)
-        self.critic_2_optimizer.step()
-
-        # 更新策略网络
+        # td_target和CQL正则项中采样的动作都不需要求梯度,不构建计算图
+        with torch.no_grad():
+            next_actions, log_prob = self.actor(next_states)
+            entropy = -log_prob
+            next_value = self.target_critic(next_states, next_actions).min(dim=0)[0] + self.log_alpha.exp() * entropy
+            td_target = rewards + self.gamma * next_value * (1 - dones)
+
+            # 以上与SAC相同,以下是CQL额外需要的动作采样,形状都是(batch_size, num_random, ...)
+            batch_size = states.shape[0]
+            random_unif_actions = torch.empty(
+                [batch_size, self.num_random, actions.shape[-1]], device=self.device).uniform_(-1, 1)
+            random_unif_log_pi = torch.full(
+                [batch_size, self.num_random, 1], np.log(0.5 ** actions.shape[-1]), device=self.device)
+            random_curr_actions, random_curr_log_pi = self.actor(states, self.num_random)
+            random_next_actions, random_next_log_pi = self.actor(next_states, self.num_random)
+            sampled_log_pi = torch.cat([random_unif_log_pi,
+                                        random_curr_log_pi.sum(dim=-1, keepdim=True),
+                                        random_next_log_pi.sum(dim=-1, keepdim=True)], dim=1)
+
+        # 数据集中的动作和所有采样的动作拼在一起,所有Q网络只前向传播一次
+        all_actions = torch.cat([actions.unsqueeze(1), random_unif_actions,
+                                 random_curr_actions, random_next_actions], dim=1)
+        q_all = self.critic(states, all_actions)  # (num_critics, batch_size, 1 + 3 * num_random, 1)
+        q_values = q_all[:, :, 0]
+        critic_loss = F.mse_loss(q_values, td_target.expand_as(q_values))
+        q_cat = q_all[:, :, 1:] - sampled_log_pi
+
+        qf_loss_1 = torch.logsumexp(q_cat, dim=2).mean()
+        qf_loss_2 = q_values.mean()
+        # 各Q网络损失之和,每个Q网络得到的梯度与单独计算时相同
+        qf_loss = (critic_loss + self.beta * (qf_loss_1 - qf_loss_2)) * self.num_critics
+
+        self.critic_optimizer.zero_grad()
+        qf_loss.backward()
+        self.critic_optimizer.step()
+
+        # 更新策略网络和alpha值
         new_actions, log_prob = self.actor(states)
         entropy = -log_prob
-        q1_value = self.critic_1(states, new_actions)
-        q2_value = self.critic_2(states, new_actions)
-        actor_loss = torch.mean(
-            -self.log_alpha.exp() * entropy - torch.min(q1_value, q2_value))
+        q_values = self.critic(states, new_actions)
+        alpha = self.log_alpha.exp()
+        actor_loss = torch.mean(-alpha.detach() * entropy - q_values.min(dim=0)[0])
+        alpha_loss = torch.mean((entropy - self.target_entropy).detach() * alpha)
+        # 两个损失的梯度互不影响,一次反向传播
         self.actor_optimizer.zero_grad()
-        actor_loss.backward()
-        self.actor_optimizer.step()
-
-        # 更新alpha值
-        alpha_loss = torch.mean(
-            (entropy - self.target_entropy).detach() * self.log_alpha.exp())
         self.log_alpha_optimizer.zero_grad()
-        alpha_loss.backward()
+        (actor_loss + alpha_loss).backward()
+        self.actor_optimizer.step()
         self.log_alpha_optimizer.step()
 
-        self.soft_update(self.critic_1, self.target_critic_1)
-        self.soft_update(self.critic_2, self.target_critic_2)
+        self.critic_soft_update()
 
 
-def main():
+def main(dataset_path=DEFAULT_DATASET_PATH):
     env_name = 'Pendulum-v0'
     env = gym.make(env_name)
     state_dim = env.observation_space.shape[0]
@@ -284,8 +275,10 @@ def main():
     agent = SACContinuous(state_dim, hidden_dim, action_dim, action_bound, actor_lr,
                           critic_lr, alpha_lr, target_entropy, tau, gamma, device)
 
-    return_list = rl_utils.train_off_policy_agent(
-        env, agent, num_episodes, replay_buffer, minimal_size, batch_size)
+    # SAC与环境交互得到的数据同时写入离线数据集,之后CQL只用这个数据集训练
+    with rl_utils.OfflineDatasetWriter(dataset_path, metadata={'env': env_name, 'agent': 'SAC'}) as dataset_writer:
+        return_list = rl_utils.train_off_policy_agent(
+            env, agent, num_episodes, replay_buffer, minimal_size, batch_size, dataset_writer)
 
     print("---------------------")
     episodes_list = list(range(len(return_list)))
@@ -295,73 +288,85 @@ def main():
     plt.title('SAC on {}'.format(env_name))
     plt.show()
 
-    def main_cql():
-        random.seed(num_seed)
-        np.random.seed(num_seed)
-        env.seed(num_seed)
-        torch.manual_seed(num_seed)
-
-        beta = 5.0
-        num_random = 5
-        num_epochs = 100
-        num_trains_per_epoch = 500
-
-        _agent = CQL(state_dim, hidden_dim, action_dim,
-                     action_bound, actor_lr, critic_lr,
-                     alpha_lr, target_entropy, tau, gamma, device, beta, num_random)
-
-        _return_list = []
-        for i in range(10):
-            with tqdm(total=int(num_epochs / 10), desc='Iteration %d' % i) as pbar:
-                for i_epoch in range(int(num_epochs / 10)):
-                    # 此处与环境交互只是为了评估策略,最后作图用,不会用于训练
-                    epoch_return = 0
-                    state = env.reset()
-                    done = False
-                    while not done:
-                        action = _agent.take_action(state)
-                        next_state, reward, done, _ = env.step(action)
-                        state = next_state
-                        epoch_return += reward
-                    _return_list.append(epoch_return)
-
-                    for _ in range(num_trains_per_epoch):
-                        b_s, b_a, b_r, b_ns, b_d = replay_buffer.sample(batch_size)
-                        transition_dict = {
-                            'states': b_s,
-                            'actions': b_a,
-                            'next_states': b_ns,
-                            'rewards': b_r,
-                            'dones': b_d
-                        }
-                        _agent.update(transition_dict)
-
-                    if (i_epoch + 1) % 10 == 0:
-                        pbar.set_postfix({
-                            'epoch':
-                                '%d' % (num_epochs / 10 * i + i_epoch + 1),
-                            'return':
-                                '%.3f' % np.mean(_return_list[-10:])
-                        })
-                    pbar.update(1)
-
-        print("---------------------")
-        epochs_list = list(range(len(_return_list)))
-        plt.plot(epochs_list, _return_list)
-        plt.xlabel('Epochs')
-        plt.ylabel('Returns')
-        plt.title('CQL on {}'.format(env_name))
-        plt.show()
-
-        mv_return = rl_utils.moving_average(_return_list, 9)
-        plt.plot(episodes_list, mv_return)
-        plt.xlabel('Episodes')
-        plt.ylabel('Returns')
-        plt.title('CQL on {}'.format(env_name))
-        plt.show()
-
-    main_cql()
+    main_cql(dataset_path)
+
+
+def main_cql(dataset_path=DEFAULT_DATASET_PATH):
+    # 从磁盘上的离线数据集训练CQL,数据集用内存映射读取,不需要整个读入内存
+    dataset = rl_utils.OfflineDataset(dataset_path)
+    env_name = dataset.metadata['env']
+    env = gym.make(env_name)
+    state_dim = env.observation_space.shape[0]
+    action_dim = env.action_space.shape[0]
+    action_bound = env.action_space.high[0]  # 动作最大值
+
+    num_seed = 0
+    random.seed(num_seed)
+    np.random.seed(num_seed)
+    env.seed(num_seed)
+    torch.manual_seed(num_seed)
+
+    actor_lr = 3e-4
+    critic_lr = 3e-3
+    alpha_lr = 3e-4
+    hidden_dim = 128
+    gamma = 0.99
+    tau = 0.005  # 软更新参数
+    batch_size = 64
+    target_entropy = -env.action_space.shape[0]
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    beta = 5.0
+    num_random = 5
+    num_epochs = 100
+    num_trains_per_epoch = 500
+
+    agent = CQL(state_dim, hidden_dim, action_dim, action_bound, actor_lr, critic_lr,
+                alpha_lr, target_entropy, tau, gamma, device, beta, num_random)
+
+    return_list = []
+    for i in range(10):
+        with tqdm(total=int(num_epochs / 10), desc='Iteration %d' % i) as pbar:
+            for i_epoch in range(int(num_epochs / 10)):
+                # 此处与环境交互只是为了评估策略,最后作图用,不会用于训练
+                epoch_return = 0
+                state = env.reset()
+                done = False
+                while not done:
+                    action = agent.take_action(state)
+                    next_state, reward, done, _ = env.step(action)
+                    state = next_state
+                    epoch_return += reward
+                return_list.append(epoch_return)
+
+                for _ in range(num_trains_per_epoch):
+                    rl_utils.update_from_buffer(agent, dataset, batch_size)
+
+                if (i_epoch + 1) % 10 == 0:
+                    pbar.set_postfix({
+                        'epoch':
+                            '%d' % (num_epochs / 10 * i + i_epoch + 1),
+                        'return':
+                            '%.3f' % np.mean(return_list[-10:])
+                    })
+                pbar.update(1)
+
+    print("---------------------")
+    epochs_list = list(range(len(return_list)))
+    plt.plot(epochs_list, return_list)
+    plt.xlabel('Epochs')
+    plt.ylabel('Returns')
+    plt.title('CQL on {}'.format(env_name))
+    plt.show()
+
+    mv_return = rl_utils.moving_average(return_list, 9)
+    plt.plot(epochs_list, mv_return)
+    plt.xlabel('Epochs')
+    plt.ylabel('Returns')
+    plt.title('CQL on {}'.format(env_name))
+    plt.show()
 
 
 if __name__ == '__main__':
     main()
+    # main_cql()
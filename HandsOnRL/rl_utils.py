@@ -1,32 +1,588 @@
+import os
+import json
+import mmap
+import queue
 from tqdm import tqdm
 import numpy as np
 import torch
-import collections
-import random
+import multiprocessing as mp
 
 
 class ReplayBuffer:
     """
     经验回放池
+    采用预先分配好的numpy数组作为环形缓冲区(每个字段一个预先分配的numpy数组),
+    避免每次采样时都要用zip(*transitions)和np.array重新拼接数据
     """
 
     def __init__(self, capacity):
-        # 队列,先进先出
-        self.buffer = collections.deque(maxlen=capacity)
+        self.capacity = capacity
+        self.ptr = 0  # 下一条数据写入的位置
+        self.count = 0  # 目前buffer中数据的数量
+        # 各字段的数组在第一次add时根据数据的形状再分配
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.next_states = None
+        self.dones = None
 
-    # 将数据加入buffer
+    def _allocate(self, state, action):
+        state = np.asarray(state)
+        action = np.asarray(action)
+        self.states = np.zeros((self.capacity,) + state.shape, dtype=np.float32)
+        self.next_states = np.zeros((self.capacity,) + state.shape, dtype=np.float32)
+        # 离散动作用int64保存(方便直接gather),连续动作用float32保存
+        if np.issubdtype(action.dtype, np.integer):
+            self.actions = np.zeros((self.capacity,) + action.shape, dtype=np.int64)
+        else:
+            self.actions = np.zeros((self.capacity,) + action.shape, dtype=np.float32)
+        self.rewards = np.zeros(self.capacity, dtype=np.float32)
+        self.dones = np.zeros(self.capacity, dtype=np.uint8)
+
+    # 将数据加入buffer,写满之后覆盖最早的数据(先进先出)
     def add(self, state, action, reward, next_state, done):
-        self.buffer.append((state, action, reward, next_state, done))
+        if self.states is None:
+            self._allocate(state, action)
+        self.states[self.ptr] = state
+        self.actions[self.ptr] = action
+        self.rewards[self.ptr] = reward
+        self.next_states[self.ptr] = next_state
+        self.dones[self.ptr] = done
+        self.ptr = (self.ptr + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    # 一次加入多条数据,例如多个并行环境同一时刻的数据
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        if self.states is None:
+            self._allocate(states[0], actions[0])
+        n = len(rewards)
+        idx = (self.ptr + np.arange(n)) % self.capacity
+        self.states[idx] = states
+        self.actions[idx] = actions
+        self.rewards[idx] = rewards
+        self.next_states[idx] = next_states
+        self.dones[idx] = dones
+        self.ptr = (self.ptr + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+        return idx
 
     # 从buffer中采样数据,数量为batch_size
     def sample(self, batch_size):
-        transitions = random.sample(self.buffer, batch_size)
-        state, action, reward, next_state, done = zip(*transitions)
-        return np.array(state), action, reward, np.array(next_state), done
+        # 一次性生成所有下标,再用花式索引取出整批数据;
+        # 注意这里是有放回采样,同一批中可能有重复的数据,原来的random.sample是无放回采样
+        idx = np.random.randint(0, self.count, size=batch_size)
+        return self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx], self.dones[idx]
+
+    # 目前buffer中数据的数量
+    def size(self):
+        return self.count
+
+
+class SegmentTree:
+    """
+    线段树,叶子节点保存每条数据的优先级,父节点保存两个子节点运算(求和或取最小)后的结果,
+    更新和查询都只需要O(log N),并且都对一整批下标做了向量化
+    """
+
+    def __init__(self, capacity, operation, neutral_element):
+        # 容量取不小于capacity的2的幂,方便用数组表示完全二叉树
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.operation = operation
+        # tree[1]是根节点,叶子节点位于[capacity, 2 * capacity)
+        self.tree = np.full(2 * self.capacity, neutral_element, dtype=np.float64)
+
+    def update(self, idx, values):
+        pos = np.asarray(idx) + self.capacity
+        self.tree[pos] = values
+        # 自底向上逐层更新父节点,同一层的节点一起计算
+        pos = np.unique(pos // 2)
+        while pos[0] >= 1:
+            self.tree[pos] = self.operation(self.tree[2 * pos], self.tree[2 * pos + 1])
+            pos = np.unique(pos // 2)
+
+    def __getitem__(self, idx):
+        return self.tree[np.asarray(idx) + self.capacity]
+
+    def root(self):
+        return self.tree[1]
+
+
+class SumTree(SegmentTree):
+    def __init__(self, capacity):
+        super(SumTree, self).__init__(capacity, np.add, 0.0)
+
+    def find_prefix_sum_idx(self, prefix_sum):
+        """
+        对每个prefix_sum找到最小的下标i,使得前i个叶子节点之和大于prefix_sum
+        """
+        prefix_sum = np.array(prefix_sum, dtype=np.float64)
+        pos = np.ones(prefix_sum.shape, dtype=np.int64)
+        while pos[0] < self.capacity:  # 所有下标同时往下走一层
+            left = 2 * pos
+            left_sum = self.tree[left]
+            go_right = prefix_sum >= left_sum
+            prefix_sum = np.where(go_right, prefix_sum - left_sum, prefix_sum)
+            pos = np.where(go_right, left + 1, left)
+        return pos - self.capacity
+
+
+class MinTree(SegmentTree):
+    def __init__(self, capacity):
+        super(MinTree, self).__init__(capacity, np.minimum, np.inf)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    优先经验回放池,按照优先级p_i^alpha成比例地采样,并返回重要性采样权重
+    """
+
+    def __init__(self, capacity, alpha=0.6, beta=0.4, beta_increment=1e-4, eps=1e-6):
+        super(PrioritizedReplayBuffer, self).__init__(capacity)
+        self.alpha = alpha  # 优先级的指数,为0时退化为均匀采样
+        self.beta = beta  # 重要性采样权重的指数,逐渐增大到1
+        self.beta_increment = beta_increment
+        self.eps = eps  # 防止TD误差为0的数据永远不会被采样
+        self.max_priority = 1.0  # 新数据使用目前最大的优先级,保证至少被采样一次
+        self.sum_tree = SumTree(capacity)
+        self.min_tree = MinTree(capacity)
+
+    def add(self, state, action, reward, next_state, done):
+        idx = self.ptr
+        super(PrioritizedReplayBuffer, self).add(state, action, reward, next_state, done)
+        priority = self.max_priority ** self.alpha
+        self.sum_tree.update(idx, priority)
+        self.min_tree.update(idx, priority)
+
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        idx = super(PrioritizedReplayBuffer, self).add_batch(states, actions, rewards, next_states, dones)
+        priority = self.max_priority ** self.alpha
+        self.sum_tree.update(idx, priority)
+        self.min_tree.update(idx, priority)
+        return idx
+
+    def sample(self, batch_size):
+        """
+        返回(states, actions, rewards, next_states, dones, weights, indices),
+        其中indices用于之后调用update_priorities写回新的优先级
+        """
+        total = self.sum_tree.root()
+        # 把总优先级分成batch_size段,每段内均匀采样一个前缀和(分层采样)
+        prefix_sum = (np.arange(batch_size) + np.random.rand(batch_size)) * (total / batch_size)
+        idx = self.sum_tree.find_prefix_sum_idx(prefix_sum)
+        idx = np.minimum(idx, self.count - 1)  # 防止浮点误差导致下标越界
+
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        probs = self.sum_tree[idx] / total
+        min_prob = self.min_tree.root() / total
+        # 用最大权重进行归一化,使权重不超过1
+        weights = (probs / min_prob) ** (-self.beta)
+        return (self.states[idx], self.actions[idx], self.rewards[idx], self.next_states[idx],
+                self.dones[idx], weights.astype(np.float32), idx)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)).reshape(-1) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.sum_tree.update(indices, priorities ** self.alpha)
+        self.min_tree.update(indices, priorities ** self.alpha)
+
+
+class FrameStackReplayBuffer:
+    """
+    叠帧状态(例如Atari的4x84x84画面)的经验回放池
+    状态由连续num_stack帧叠成,相邻状态之间只差一帧,所以每一帧只用uint8保存一次(环形缓冲区),
+    采样时再根据下标重新叠成state和next_state;与ReplayBuffer相比省去了每条数据重复保存的2*num_stack帧
+    和float32的4倍开销,100万条84x84的数据约7GB。
+    要求按时间顺序逐条add同一个环境的数据,且回合开始时的状态是第一帧重复num_stack次(与FrameStack一致)
+    """
+
+    def __init__(self, capacity, num_stack=4):
+        self.capacity = capacity
+        self.num_stack = num_stack
+        self.ptr = 0  # 下一条数据写入的位置
+        self.count = 0  # 目前buffer中数据的数量
+        self.new_episode = True  # 下一条数据是否是一个回合的开始
+        # 第i条数据的state是以frames[i]结尾的num_stack帧,next_state是以frames[i+1]结尾的num_stack帧
+        self.frames = None
+        self.firsts = np.zeros(capacity, dtype=np.bool_)  # frames[i]是否是回合的第一帧
+        self.actions = None
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=np.uint8)
+
+    def _allocate(self, state, action):
+        frame = np.asarray(state)[-1]
+        self.frames = np.zeros((self.capacity,) + frame.shape, dtype=np.uint8)
+        action = np.asarray(action)
+        if np.issubdtype(action.dtype, np.integer):
+            self.actions = np.zeros((self.capacity,) + action.shape, dtype=np.int64)
+        else:
+            self.actions = np.zeros((self.capacity,) + action.shape, dtype=np.float32)
+
+    # 只保存state和next_state的最后一帧;写满之后覆盖最早的数据
+    def add(self, state, action, reward, next_state, done):
+        if self.frames is None:
+            self._allocate(state, action)
+        nxt = (self.ptr + 1) % self.capacity
+        self.frames[self.ptr] = state[-1]
+        self.firsts[self.ptr] = self.new_episode
+        self.actions[self.ptr] = action
+        self.rewards[self.ptr] = reward
+        self.dones[self.ptr] = done
+        # 先写入next_state的最后一帧,同一回合的下一条数据会用同样的帧覆盖它
+        self.frames[nxt] = next_state[-1]
+        self.firsts[nxt] = False
+        self.new_episode = bool(done)
+        self.ptr = nxt
+        self.count = min(self.count + 1, self.capacity)
+
+    def _stack_indices(self, end):
+        idx = (end[:, None] + np.arange(1 - self.num_stack, 1)) % self.capacity
+        # 从后往前检查,某一帧是回合的第一帧时,更早的帧都用这一帧代替
+        for k in range(self.num_stack - 2, -1, -1):
+            mask = self.firsts[idx[:, k + 1]]
+            idx[mask, k] = idx[mask, k + 1]
+        return idx
+
+    def sample(self, batch_size):
+        if self.count < self.capacity:
+            idx = np.random.randint(0, self.count, size=batch_size)
+        else:
+            # frames[ptr]已经被最新的next_state覆盖,之后num_stack-1条数据的state会用到它,都不能采样
+            idx = (self.ptr + self.num_stack
+                   + np.random.randint(0, self.capacity - self.num_stack, size=batch_size)) % self.capacity
+        states = self.frames[self._stack_indices(idx)]
+        # 回合结束(done=1)时next_state不参与计算TD目标,其内容可能已属于下一个回合
+        next_states = self.frames[self._stack_indices(idx + 1)]
+        return states, self.actions[idx], self.rewards[idx], next_states, self.dones[idx]
 
     # 目前buffer中数据的数量
     def size(self):
-        return len(self.buffer)
+        return self.count
+
+
+class RolloutBuffer:
+    """
+    同策略算法的rollout存储
+    预先分配形状为(num_steps, num_envs, ...)的数组,所有并行环境每前进一步写入一行,
+    写满后用get()取出transition_dict交给agent.update,各字段都是按时间排列的数组
+    """
+
+    def __init__(self, num_steps, num_envs):
+        self.num_steps = num_steps
+        self.num_envs = num_envs
+        self.ptr = 0  # 下一步数据写入的位置
+        # 各字段的数组在第一次add时根据数据的形状再分配
+        self.states = None
+        self.actions = None
+        self.rewards = None
+        self.next_states = None
+        self.dones = None
+
+    def _allocate(self, state, action):
+        shape = (self.num_steps, self.num_envs)
+        state = np.asarray(state)
+        action = np.asarray(action)
+        self.states = np.zeros(shape + state.shape, dtype=np.float32)
+        self.next_states = np.zeros(shape + state.shape, dtype=np.float32)
+        if np.issubdtype(action.dtype, np.integer):
+            self.actions = np.zeros(shape + action.shape, dtype=np.int64)
+        else:
+            self.actions = np.zeros(shape + action.shape, dtype=np.float32)
+        self.rewards = np.zeros(shape, dtype=np.float32)
+        self.dones = np.zeros(shape, dtype=np.float32)
+
+    # 加入所有并行环境同一时刻的数据
+    def add(self, states, actions, rewards, next_states, dones):
+        if self.states is None:
+            self._allocate(states[0], np.asarray(actions)[0])
+        self.states[self.ptr] = states
+        self.actions[self.ptr] = actions
+        self.rewards[self.ptr] = rewards
+        self.next_states[self.ptr] = next_states
+        self.dones[self.ptr] = dones
+        self.ptr += 1
+
+    def full(self):
+        return self.ptr == self.num_steps
+
+    # 取出目前存储的数据并清空,返回的数组是buffer的视图,下一次add之前需要用完
+    def get(self):
+        transition_dict = {'states': self.states[:self.ptr], 'actions': self.actions[:self.ptr],
+                           'rewards': self.rewards[:self.ptr], 'next_states': self.next_states[:self.ptr],
+                           'dones': self.dones[:self.ptr]}
+        self.ptr = 0
+        return transition_dict
+
+
+class StateBuffer:
+    """
+    选取动作时的输入缓冲区,把numpy状态数组转成网络的输入张量
+    CPU上用torch.from_numpy直接共享内存,不再拷贝;
+    GPU上按形状缓存预先分配的锁页内存,先拷贝到锁页内存再异步传到显存
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.buffers = {}  # 形状 -> 锁页内存张量
+
+    def __call__(self, states):
+        states = torch.from_numpy(np.asarray(states, dtype=np.float32))
+        if self.device.type != 'cuda':
+            return states
+        host = self.buffers.get(states.shape)
+        if host is None:
+            host = self.buffers[states.shape] = torch.empty(states.shape, dtype=torch.float32, pin_memory=True)
+        host.copy_(states)
+        # act_batch最后的.cpu()会同步,下一次覆盖锁页内存之前这次的拷贝已经完成
+        return host.to(self.device, non_blocking=True)
+
+
+def flatten_parameters(module):
+    """
+    把module的所有参数拷贝到一块连续内存中,参数改为这块内存中对应位置的视图,返回这块内存;
+    之后优化器对参数的原地更新会直接写入这块内存,对它的一次操作就相当于对所有参数的操作。
+    所有参数的dtype和设备必须相同;之后再调用module.to()会让参数离开这块内存
+    """
+    params = list(module.parameters())
+    flat = torch.cat([param.detach().reshape(-1) for param in params])
+    offset = 0
+    for param in params:
+        param.data = flat[offset:offset + param.numel()].view_as(param)
+        offset += param.numel()
+    return flat
+
+
+class SoftUpdater:
+    """
+    目标网络的更新,每次调用一次性更新所有参数:
+    软更新(直接调用)target_net = (1 - tau) * target_net + tau * net,硬更新(hard_update)target_net = net,
+    硬更新代替target_net.load_state_dict(net.state_dict()),不需要构造state_dict再逐个张量拷贝。
+    参数能放进连续内存时(flatten_parameters)两个网络各有一块自己的内存,只需对整块内存做一次原地lerp_或copy_,
+    否则(例如各参数dtype或设备不同)用torch._foreach_*多张量操作,都不会为每个参数分配临时张量。
+    创建时检查两个网络没有共享参数,例如target_net = model.to(device)与net是同一个对象时目标网络形同虚设
+    """
+
+    def __init__(self, net, target_net, tau=1.0):
+        self.net = net
+        self.target_net = target_net
+        self.tau = tau
+        self.params = list(net.parameters())
+        self.target_params = list(target_net.parameters())
+        params_ptrs = {param.data_ptr() for param in self.params}
+        if net is target_net or any(param.data_ptr() in params_ptrs for param in self.target_params):
+            raise ValueError('目标网络与在线网络共享参数,目标网络需要是单独的副本(例如copy.deepcopy(net))')
+        self.flat = None
+        self.target_flat = None
+        if len({(param.dtype, param.device) for param in self.params + self.target_params}) == 1:
+            self._flatten()
+
+    def _flatten(self):
+        self.params = list(self.net.parameters())
+        self.target_params = list(self.target_net.parameters())
+        self.flat = flatten_parameters(self.net)
+        self.target_flat = flatten_parameters(self.target_net)
+
+    def _is_flat(self):
+        # 网络之后被.to()等操作移动过时,参数不再是连续内存的视图,需要重新展平
+        return (self.params[0].data_ptr() == self.flat.data_ptr()
+                and self.target_params[0].data_ptr() == self.target_flat.data_ptr())
+
+    @torch.no_grad()
+    def __call__(self):
+        if self.flat is not None:
+            if not self._is_flat():
+                self._flatten()
+            self.target_flat.lerp_(self.flat, self.tau)
+        elif hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(self.target_params, self.params, self.tau)
+        else:
+            torch._foreach_mul_(self.target_params, 1.0 - self.tau)
+            torch._foreach_add_(self.target_params, self.params, alpha=self.tau)
+
+    @torch.no_grad()
+    def hard_update(self):
+        if self.flat is not None:
+            if not self._is_flat():
+                self._flatten()
+            self.target_flat.copy_(self.flat)
+        elif hasattr(torch, '_foreach_copy_'):
+            torch._foreach_copy_(self.target_params, self.params)
+        else:
+            for target_param, param in zip(self.target_params, self.params):
+                target_param.copy_(param)
+        # 与load_state_dict一样同时拷贝buffer(例如BatchNorm的统计量)
+        for target_buffer, buffer in zip(self.target_net.buffers(), self.net.buffers()):
+            target_buffer.copy_(buffer)
+
+
+class EnsembleLinear(torch.nn.Module):
+    """
+    num_members个全连接层,权重堆叠成(num_members, in, out)的张量,用一次批量矩阵乘法同时计算,
+    用于SAC、CQL中多个Q网络组成的集成
+    """
+
+    def __init__(self, num_members, in_features, out_features):
+        super(EnsembleLinear, self).__init__()
+        self.weight = torch.nn.Parameter(torch.empty(num_members, in_features, out_features))
+        self.bias = torch.nn.Parameter(torch.empty(num_members, 1, out_features))
+        # 每个成员的初始化分布与torch.nn.Linear的默认初始化相同
+        bound = 1 / np.sqrt(in_features)
+        torch.nn.init.uniform_(self.weight, -bound, bound)
+        torch.nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        # x的形状为(batch, in)时所有成员共用同一个输入,为(num_members, batch, in)时各成员的输入不同
+        if x.dim() == 2:
+            x = x.expand(self.weight.shape[0], -1, -1)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+TRANSITION_COLUMNS = ('states', 'actions', 'rewards', 'next_states', 'dones')
+
+
+class OfflineDatasetWriter:
+    """
+    把交互得到的数据写成磁盘上的离线数据集,供CQL等离线强化学习算法使用
+    数据集是一个目录:每个字段按分块保存为.npy文件(例如states_00000.npy),另有manifest.json记录各分块的大小,
+    字段的dtype和形状以及metadata;内存中只保留一个分块,写满chunk_size条数据后落盘,
+    append为True时在目录中已有的数据集后追加新的分块,否则重新写一个数据集
+    """
+
+    def __init__(self, path, chunk_size=100000, metadata=None, append=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.buffer = ReplayBuffer(chunk_size)  # 当前分块的数据,预先分配的数组落盘后重复使用
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, 'manifest.json')
+        if append and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            if metadata is not None:
+                self.manifest['metadata'].update(metadata)
+        else:
+            self.manifest = {'version': 1, 'size': 0, 'chunks': [], 'columns': {}, 'metadata': metadata or {}}
+
+    def add(self, state, action, reward, next_state, done):
+        self.buffer.add(state, action, reward, next_state, done)
+        if self.buffer.size() == self.chunk_size:
+            self.flush()
+
+    # 一次写入多条数据,超出当前分块剩余空间的部分写入下一个分块
+    def add_batch(self, states, actions, rewards, next_states, dones):
+        start = 0
+        while start < len(rewards):
+            end = min(len(rewards), start + self.chunk_size - self.buffer.size())
+            self.buffer.add_batch(states[start:end], actions[start:end], rewards[start:end],
+                                  next_states[start:end], dones[start:end])
+            if self.buffer.size() == self.chunk_size:
+                self.flush()
+            start = end
+
+    # 把当前分块写入磁盘,并更新manifest.json
+    def flush(self):
+        count = self.buffer.size()
+        if count == 0:
+            return
+        index = len(self.manifest['chunks'])
+        for name in TRANSITION_COLUMNS:
+            column = getattr(self.buffer, name)[:count]
+            np.save(os.path.join(self.path, '%s_%05d.npy' % (name, index)), column)
+            self.manifest['columns'][name] = {'dtype': column.dtype.str, 'shape': list(column.shape[1:])}
+        self.manifest['chunks'].append(count)
+        self.manifest['size'] += count
+        # 先写临时文件再替换,中途退出时manifest.json仍然是完整的
+        tmp_path = os.path.join(self.path, 'manifest.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, 'manifest.json'))
+        self.buffer.ptr = 0
+        self.buffer.count = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _load_npy_random_access(filename):
+    """
+    以只读内存映射的方式读取.npy文件,效果与np.load(filename, mmap_mode='r')相同,
+    但映射由这里自己创建,可以调用madvise(MADV_RANDOM)关闭操作系统的预读,
+    否则随机采样时每读一行都会把相邻的几十KB一起读入内存;不支持madvise的平台(例如Windows)上只做内存映射
+    """
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        else:  # 其他版本的文件头交给np.load解析
+            return np.load(filename, mmap_mode='r')
+        offset = f.tell()
+        count = int(np.prod(shape))
+        if count == 0:  # 长度为0的文件无法内存映射
+            return np.empty(shape, dtype=dtype)
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # 关闭文件后映射仍然有效
+    if hasattr(mmap, 'MADV_RANDOM'):
+        try:
+            buffer.madvise(mmap.MADV_RANDOM)
+        except OSError:  # 只是性能上的建议,失败时保持默认的预读
+            pass
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+class OfflineDataset:
+    """
+    读取OfflineDatasetWriter写出的离线数据集
+    所有分块都用只读的内存映射读取(关闭了操作系统的预读),不会把整个数据集读入内存,采样时只读取用到的行;
+    提供与ReplayBuffer相同的size()和sample(),可以直接交给update_from_buffer
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.metadata = self.manifest['metadata']
+        num_chunks = len(self.manifest['chunks'])
+        self.columns = {name: [_load_npy_random_access(os.path.join(path, '%s_%05d.npy' % (name, k)))
+                               for k in range(num_chunks)] for name in TRANSITION_COLUMNS}
+        self.offsets = np.cumsum([0] + self.manifest['chunks'])  # 每个分块第一条数据的全局下标
+        self.count = int(self.offsets[-1])
+
+    # 从数据集中有放回地采样batch_size条数据,返回值与ReplayBuffer.sample相同
+    def sample(self, batch_size):
+        # 下标排序后同一分块的数据是连续的一段,每个分块只做一次花式索引,读取的磁盘页也更集中
+        idx = np.sort(np.random.randint(0, self.count, size=batch_size))
+        bounds = np.searchsorted(idx, self.offsets)
+        chunks = [k for k in range(len(self.offsets) - 1) if bounds[k] < bounds[k + 1]]
+        return tuple(np.concatenate([self.columns[name][k][idx[bounds[k]:bounds[k + 1]] - self.offsets[k]]
+                                     for k in chunks]) for name in TRANSITION_COLUMNS)
+
+    def size(self):
+        return self.count
+
+
+def update_from_buffer(agent, replay_buffer, batch_size):
+    """
+    从回放池中采样一批数据更新智能体;
+    如果是优先经验回放池,会把重要性采样权重传给agent.update,并用其返回的TD误差更新优先级
+    """
+    batch = replay_buffer.sample(batch_size)
+    b_s, b_a, b_r, b_ns, b_d = batch[:5]
+    transition_dict = {'states': b_s, 'actions': b_a, 'next_states': b_ns,
+                       'rewards': b_r, 'dones': b_d}
+    if isinstance(replay_buffer, PrioritizedReplayBuffer):
+        transition_dict['weights'] = batch[5]
+        td_errors = agent.update(transition_dict)
+        if td_errors is not None:
+            replay_buffer.update_priorities(batch[6], td_errors)
+    else:
+        agent.update(transition_dict)
 
 
 def moving_average(a, window_size):
@@ -66,7 +622,11 @@ def train_on_policy_agent(env, agent, num_episodes):
     return return_list
 
 
-def train_off_policy_agent(env, agent, num_episodes, replay_buffer, minimal_size, batch_size):
+def train_off_policy_agent(env, agent, num_episodes, replay_buffer, minimal_size, batch_size,
+                           dataset_writer=None):
+    """
+    异策略训练;给出dataset_writer(OfflineDatasetWriter)时,交互得到的数据同时写入离线数据集
+    """
     return_list = []
     for i in range(10):
         with tqdm(total=int(num_episodes / 10), desc='Iteration %d' % i) as pbar:
@@ -78,13 +638,12 @@ def train_off_policy_agent(env, agent, num_episodes, replay_buffer, minimal_size
                     action = agent.take_action(state)
                     next_state, reward, done, _ = env.step(action)
                     replay_buffer.add(state, action, reward, next_state, done)
+                    if dataset_writer is not None:
+                        dataset_writer.add(state, action, reward, next_state, done)
                     state = next_state
                     episode_return += reward
                     if replay_buffer.size() > minimal_size:
-                        b_s, b_a, b_r, b_ns, b_d = replay_buffer.sample(batch_size)
-                        transition_dict = {'states': b_s, 'actions': b_a, 'next_states': b_ns,
-                                           'rewards': b_r, 'dones': b_d}
-                        agent.update(transition_dict)
+                        update_from_buffer(agent, replay_buffer, batch_size)
                 return_list.append(episode_return)
                 if (i_episode + 1) % 10 == 0:
                     pbar.set_postfix({'episode': '%d' % (num_episodes / 10 * i + i_episode + 1),
@@ -93,12 +652,463 @@ def train_off_policy_agent(env, agent, num_episodes, replay_buffer, minimal_size
     return return_list
 
 
-def compute_advantage(gamma, lmbda, td_delta):
-    td_delta = td_delta.detach().numpy()
-    advantage_list = []
-    advantage = 0.0
-    for delta in td_delta[::-1]:
-        advantage = gamma * lmbda * advantage + delta
-        advantage_list.append(advantage)
-    advantage_list.reverse()
-    return torch.tensor(np.array(advantage_list), dtype=torch.float)
+def _subproc_worker(remote, parent_remote, env_fn):
+    parent_remote.close()
+    env = env_fn()
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                next_state, reward, done, info = env.step(data)
+                if done:  # 自动重置,真正的最后一个状态放在info中
+                    info['terminal_observation'] = next_state
+                    next_state = env.reset()
+                remote.send((next_state, reward, done, info))
+            elif cmd == 'reset':
+                remote.send(env.reset())
+            elif cmd == 'seed':
+                remote.send(env.seed(data))
+            elif cmd == 'spaces':
+                remote.send((env.observation_space, env.action_space))
+            elif cmd == 'close':
+                break
+    finally:
+        env.close()
+        remote.close()
+
+
+class SyncVectorEnv:
+    """
+    在同一个进程内按顺序运行多个环境的副本,所有环境同步(lockstep)前进一步。
+    某个环境结束时会自动重置,结束时的状态保存在info['terminal_observation']中
+    """
+
+    def __init__(self, env_fns):
+        self.envs = [fn() for fn in env_fns]
+        self.num_envs = len(self.envs)
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+
+    def seed(self, seed):
+        return [env.seed(seed + i) for i, env in enumerate(self.envs)]
+
+    def reset(self):
+        return np.stack([env.reset() for env in self.envs])
+
+    def step(self, actions):
+        next_states, rewards, dones, infos = [], [], [], []
+        for env, action in zip(self.envs, actions):
+            next_state, reward, done, info = env.step(action)
+            if done:
+                info['terminal_observation'] = next_state
+                next_state = env.reset()
+            next_states.append(next_state)
+            rewards.append(reward)
+            dones.append(done)
+            infos.append(info)
+        return np.stack(next_states), np.array(rewards, dtype=np.float32), np.array(dones), infos
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
+class SubprocVectorEnv:
+    """
+    每个环境运行在单独的子进程中,通过管道通信,适合单步开销较大的环境。
+    env_fns中的函数需要可以被pickle,例如functools.partial(gym.make, env_name)
+    """
+
+    def __init__(self, env_fns):
+        self.num_envs = len(env_fns)
+        self.remotes, work_remotes = zip(*[mp.Pipe() for _ in range(self.num_envs)])
+        self.processes = []
+        for work_remote, remote, env_fn in zip(work_remotes, self.remotes, env_fns):
+            process = mp.Process(target=_subproc_worker, args=(work_remote, remote, env_fn), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+        self.remotes[0].send(('spaces', None))
+        self.observation_space, self.action_space = self.remotes[0].recv()
+        self.closed = False
+
+    def seed(self, seed):
+        for i, remote in enumerate(self.remotes):
+            remote.send(('seed', seed + i))
+        return [remote.recv() for remote in self.remotes]
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        return np.stack([remote.recv() for remote in self.remotes])
+
+    def step(self, actions):
+        # 先把动作全部发出去,各子进程并行执行,再统一接收结果
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        results = [remote.recv() for remote in self.remotes]
+        next_states, rewards, dones, infos = zip(*results)
+        return np.stack(next_states), np.array(rewards, dtype=np.float32), np.array(dones), list(infos)
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
+
+
+def act_batch(agent, states):
+    # 智能体实现了act_batch时一次前向传播选取所有动作,否则逐个调用take_action
+    if hasattr(agent, 'act_batch'):
+        return agent.act_batch(states)
+    return [agent.take_action(state) for state in states]
+
+
+def train_on_policy_agent_vec(envs, agent, num_episodes):
+    """
+    使用多个并行环境采样的同策略训练,每个环境的一条序列结束后就用这条序列更新一次智能体
+    """
+    return_list = []
+    num_envs = envs.num_envs
+    states = envs.reset()
+    episode_returns = np.zeros(num_envs)
+    transition_dicts = [{'states': [], 'actions': [], 'next_states': [], 'rewards': [], 'dones': []}
+                        for _ in range(num_envs)]
+    for i in range(10):
+        with tqdm(total=int(num_episodes / 10), desc='Iteration %d' % i) as pbar:
+            i_episode = 0
+            while i_episode < int(num_episodes / 10):
+                actions = act_batch(agent, states)
+                next_states, rewards, dones, infos = envs.step(actions)
+                for j in range(num_envs):
+                    next_state = infos[j]['terminal_observation'] if dones[j] else next_states[j]
+                    transition_dict = transition_dicts[j]
+                    transition_dict['states'].append(states[j])
+                    transition_dict['actions'].append(actions[j])
+                    transition_dict['next_states'].append(next_state)
+                    transition_dict['rewards'].append(rewards[j])
+                    transition_dict['dones'].append(dones[j])
+                    episode_returns[j] += rewards[j]
+                    if dones[j]:
+                        return_list.append(episode_returns[j])
+                        agent.update(transition_dict)
+                        episode_returns[j] = 0
+                        transition_dicts[j] = {'states': [], 'actions': [], 'next_states': [],
+                                               'rewards': [], 'dones': []}
+                        i_episode += 1
+                        if i_episode % 10 == 0:
+                            pbar.set_postfix({'episode': '%d' % (num_episodes / 10 * i + i_episode),
+                                              'return': '%.3f' % np.mean(return_list[-10:])})
+                        pbar.update(1)
+                states = next_states
+    return return_list
+
+
+def train_on_policy_agent_rollout(envs, agent, num_episodes, num_steps):
+    """
+    使用多个并行环境采样的同策略训练,所有环境各前进num_steps步后用这一整批rollout更新一次智能体,
+    序列可以跨越两次更新,rollout末尾没有结束的序列由价值网络自举
+    """
+    return_list = []
+    num_envs = envs.num_envs
+    rollout = RolloutBuffer(num_steps, num_envs)
+    states = envs.reset()
+    episode_returns = np.zeros(num_envs)
+    for i in range(10):
+        with tqdm(total=int(num_episodes / 10), desc='Iteration %d' % i) as pbar:
+            i_episode = 0
+            while i_episode < int(num_episodes / 10):
+                actions = act_batch(agent, states)
+                next_states, rewards, dones, infos = envs.step(actions)
+                real_next_states = next_states.copy()
+                for j in np.flatnonzero(dones):
+                    real_next_states[j] = infos[j]['terminal_observation']
+                rollout.add(states, actions, rewards, real_next_states, dones)
+                if rollout.full():
+                    agent.update(rollout.get())
+                states = next_states
+                episode_returns += rewards
+                for j in np.flatnonzero(dones):
+                    return_list.append(episode_returns[j])
+                    episode_returns[j] = 0
+                    i_episode += 1
+                    if i_episode % 10 == 0:
+                        pbar.set_postfix({'episode': '%d' % (num_episodes / 10 * i + i_episode),
+                                          'return': '%.3f' % np.mean(return_list[-10:])})
+                    pbar.update(1)
+    return return_list
+
+
+def train_off_policy_agent_vec(envs, agent, num_episodes, replay_buffer, minimal_size, batch_size,
+                               num_updates=1, dataset_writer=None):
+    """
+    使用多个并行环境采样的异策略训练,所有环境每同步前进一步,智能体更新num_updates次;
+    给出dataset_writer时,交互得到的数据同时写入离线数据集
+    """
+    return_list = []
+    num_envs = envs.num_envs
+    states = envs.reset()
+    episode_returns = np.zeros(num_envs)
+    for i in range(10):
+        with tqdm(total=int(num_episodes / 10), desc='Iteration %d' % i) as pbar:
+            i_episode = 0
+            while i_episode < int(num_episodes / 10):
+                actions = act_batch(agent, states)
+                next_states, rewards, dones, infos = envs.step(actions)
+                real_next_states = next_states.copy()
+                for j in np.flatnonzero(dones):
+                    real_next_states[j] = infos[j]['terminal_observation']
+                replay_buffer.add_batch(states, np.asarray(actions), rewards, real_next_states, dones)
+                if dataset_writer is not None:
+                    dataset_writer.add_batch(states, np.asarray(actions), rewards, real_next_states, dones)
+                states = next_states
+                episode_returns += rewards
+                if replay_buffer.size() > minimal_size:
+                    for _ in range(num_updates):
+                        update_from_buffer(agent, replay_buffer, batch_size)
+                for j in np.flatnonzero(dones):
+                    return_list.append(episode_returns[j])
+                    episode_returns[j] = 0
+                    i_episode += 1
+                    if i_episode % 10 == 0:
+                        pbar.set_postfix({'episode': '%d' % (num_episodes / 10 * i + i_episode),
+                                          'return': '%.3f' % np.mean(return_list[-10:])})
+                    pbar.update(1)
+    return return_list
+
+
+class SharedTransitionSlots:
+    """
+    采样进程向学习进程传递数据的共享内存,共num_slots个槽,每个槽存放slot_size条数据。
+    采样进程从free队列取一个空槽,写满后把(槽编号, 期间结束的回合的回报)放入full队列;
+    学习进程把槽中的数据拷贝进经验回放池后,再把槽编号放回free队列。队列中只传递很小的消息,
+    空槽用完时采样进程会等待,学习进程落后时采样进程不会无限制地向前跑
+    """
+
+    def __init__(self, num_slots, slot_size, observation_space, action_space):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        # 离散动作用int64保存,连续动作用float32保存,与ReplayBuffer一致
+        action_dtype = np.int64 if np.issubdtype(action_space.dtype, np.integer) else np.float32
+        self.specs = {'states': (observation_space.shape, np.float32), 'actions': (action_space.shape, action_dtype),
+                      'rewards': ((), np.float32), 'next_states': (observation_space.shape, np.float32),
+                      'dones': ((), np.uint8)}
+        self.raw = {name: mp.RawArray('b', num_slots * slot_size * int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                    for name, (shape, dtype) in self.specs.items()}
+        self.free = mp.Queue()
+        self.full = mp.Queue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+        self._arrays = None
+
+    # 共享内存上的numpy数组,形状为(num_slots, slot_size, ...),在每个进程中第一次使用时创建
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {name: np.frombuffer(self.raw[name], dtype=dtype).reshape(
+                (self.num_slots, self.slot_size) + tuple(shape)) for name, (shape, dtype) in self.specs.items()}
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+
+def _agent_tensors(agent):
+    # 智能体中所有网络的参数和buffer,按属性名排序,保证学习进程和采样进程中的顺序一致
+    tensors = []
+    for name in sorted(vars(agent)):
+        value = getattr(agent, name)
+        if isinstance(value, torch.nn.Module):
+            tensors += [tensor.data for tensor in value.state_dict(keep_vars=True).values()]
+    return tensors
+
+
+def _publish_agent(snapshot, tensors, version, lock):
+    # 学习进程把当前参数整体写入共享内存中的快照,版本号加一
+    with lock:
+        torch.cat([tensor.reshape(-1).float() for tensor in tensors], out=snapshot)
+        version.value += 1
+
+
+def _collector_worker(agent, env_fn, slots, snapshot, version, lock, stop, seed):
+    torch.set_num_threads(1)  # 采样进程和学习进程共用CPU,每个采样进程只用一个线程
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    env = env_fn()
+    env.seed(seed)
+    arrays = slots.arrays()
+    tensors = _agent_tensors(agent)
+    snapshot = torch.from_numpy(np.frombuffer(snapshot, dtype=np.float32))
+    local_version = -1
+    state = env.reset()
+    episode_return = 0
+    try:
+        while not stop.is_set():
+            try:
+                slot = slots.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            returns = []
+            for k in range(slots.slot_size):
+                if version.value != local_version:  # 学习进程发布了新参数,整体拷贝到本进程的智能体副本中
+                    with lock:
+                        local_version = version.value
+                        offset = 0
+                        for tensor in tensors:
+                            tensor.copy_(snapshot[offset:offset + tensor.numel()].view_as(tensor))
+                            offset += tensor.numel()
+                action = agent.take_action(state)
+                next_state, reward, done, _ = env.step(action)
+                arrays['states'][slot, k] = state
+                arrays['actions'][slot, k] = action
+                arrays['rewards'][slot, k] = reward
+                arrays['next_states'][slot, k] = next_state
+                arrays['dones'][slot, k] = done
+                state = next_state
+                episode_return += reward
+                if done:
+                    returns.append(episode_return)
+                    episode_return = 0
+                    state = env.reset()
+            slots.full.put((slot, returns))
+    finally:
+        env.close()
+
+
+def train_off_policy_agent_async(env_fn, agent, num_episodes, replay_buffer, minimal_size, batch_size,
+                                 num_collectors=2, update_to_data=1.0, sync_interval=50, slot_size=50, seed=0):
+    """
+    actor-learner异步的异策略训练,采样和反向传播在不同的进程中同时进行,只需要单机CPU
+    num_collectors个采样进程各自运行一个环境,用智能体的副本选取动作,数据经共享内存(SharedTransitionSlots)
+    交给学习进程(当前进程)放入经验回放池;学习进程不停地更新智能体,更新次数与采样步数之比保持为update_to_data,
+    每更新sync_interval次把参数发布到共享内存中的快照,采样进程发现新版本后整体拷贝。
+    env_fn需要可以被pickle,例如functools.partial(gym.make, env_name);智能体在CPU上选取动作
+    """
+    env = env_fn()
+    slots = SharedTransitionSlots(4 * num_collectors, slot_size, env.observation_space, env.action_space)
+    env.close()
+    arrays = slots.arrays()
+    tensors = _agent_tensors(agent)
+    snapshot_raw = mp.RawArray('f', sum(tensor.numel() for tensor in tensors))
+    snapshot = torch.from_numpy(np.frombuffer(snapshot_raw, dtype=np.float32))
+    version = mp.RawValue('l', 0)
+    lock = mp.Lock()
+    stop = mp.Event()
+    _publish_agent(snapshot, tensors, version, lock)
+    processes = [mp.Process(target=_collector_worker, daemon=True,
+                            args=(agent, env_fn, slots, snapshot_raw, version, lock, stop, seed + i))
+                 for i in range(num_collectors)]
+    for process in processes:
+        process.start()
+
+    return_list = []
+    pending_returns = []  # 一个槽中可能有多个回合结束,还没有计入进度条的回合回报
+    num_steps = 0
+    num_updates = 0
+    try:
+        for i in range(10):
+            with tqdm(total=int(num_episodes / 10), desc='Iteration %d' % i) as pbar:
+                i_episode = 0
+                while i_episode < int(num_episodes / 10):
+                    if pending_returns:
+                        return_list.append(pending_returns.pop(0))
+                        i_episode += 1
+                        if i_episode % 10 == 0:
+                            pbar.set_postfix({'episode': '%d' % (num_episodes / 10 * i + i_episode),
+                                              'return': '%.3f' % np.mean(return_list[-10:])})
+                        pbar.update(1)
+                    # 更新次数没有达到update_to_data规定的比例时一直更新,此时采样进程在继续写其他的槽;
+                    # 达到之后再取出一个写满的槽(没有时等待)
+                    elif replay_buffer.size() > minimal_size and \
+                            num_updates < update_to_data * (num_steps - minimal_size):
+                        update_from_buffer(agent, replay_buffer, batch_size)
+                        num_updates += 1
+                        if num_updates % sync_interval == 0:
+                            _publish_agent(snapshot, tensors, version, lock)
+                    else:
+                        slot, returns = slots.full.get()
+                        replay_buffer.add_batch(arrays['states'][slot], arrays['actions'][slot],
+                                                arrays['rewards'][slot], arrays['next_states'][slot],
+                                                arrays['dones'][slot])
+                        slots.free.put(slot)
+                        num_steps += slot_size
+                        pending_returns += returns
+    finally:
+        stop.set()
+        for process in processes:
+            # 采样进程退出前要把full队列中的消息全部送出,这里一边取出一边等待
+            while process.is_alive():
+                try:
+                    while True:
+                        slots.full.get_nowait()
+                except queue.Empty:
+                    pass
+                process.join(timeout=0.1)
+    return return_list
+
+
+def _reverse_discounted_cumsum(x, done, coef, chunk_size):
+    """
+    y_t = x_t + coef * (1 - done_t) * y_{t+1}, x和done的形状为(T, N)
+    """
+    length, num_envs = x.shape
+    # 把时间维切成长度为chunk_size的块,末尾补0(补的步视为结束,不会影响前面的结果)
+    num_chunks = (length + chunk_size - 1) // chunk_size
+    pad = num_chunks * chunk_size - length
+    if pad > 0:
+        x = torch.cat([x, x.new_zeros(pad, num_envs)])
+        done = torch.cat([done, done.new_ones(pad, num_envs)])
+    # (C, N, B)
+    x = x.view(num_chunks, chunk_size, num_envs).permute(0, 2, 1)
+    done = done.view(num_chunks, chunk_size, num_envs).permute(0, 2, 1)
+
+    # seg[t]表示块内t之前结束了几条序列,t和k(k>=t)之间没有结束的序列当且仅当seg[t] == seg[k]
+    seg = torch.cumsum(done, dim=-1) - done
+    steps = torch.arange(chunk_size, device=x.device)
+    diff = (steps.view(1, -1) - steps.view(-1, 1)).float()  # diff[t, k] = k - t
+    discount = torch.where(diff >= 0, coef ** diff.clamp(min=0), torch.zeros_like(diff))
+    same_episode = (seg.unsqueeze(-1) == seg.unsqueeze(-2)).float()  # (C, N, B, B)
+    # 块内部分: y_t = sum_k coef^(k-t) * x_k,只累加同一条序列中的k
+    y = torch.einsum('cntk,cnk->cnt', same_episode * discount, x)
+
+    if num_chunks > 1:
+        # 每块第一步的完整结果满足同样形式的递推,系数变为coef^B,块内有序列结束则不再传递
+        chunk_done = (done.sum(dim=-1) > 0).float()  # (C, N)
+        head = _reverse_discounted_cumsum(y[:, :, 0], chunk_done, coef ** chunk_size, chunk_size)
+        next_head = torch.cat([head[1:], head.new_zeros(1, num_envs)]).unsqueeze(-1)  # (C, N, 1)
+        # 块之间的传递: y_t += coef^(B-t) * (下一块第一步的结果),要求t到块末尾之间序列没有结束
+        seg_end = seg[..., -1:] + done[..., -1:]
+        carry = torch.where(seg == seg_end, coef ** (chunk_size - steps).float(), torch.zeros_like(seg))
+        y = y + carry * next_head
+    return y.permute(0, 2, 1).reshape(-1, num_envs)[:length]
+
+
+def compute_advantage(gamma, lmbda, td_delta, dones=None, chunk_size=32):
+    """
+    广义优势估计(GAE): A_t = delta_t + gamma * lmbda * (1 - done_t) * A_{t+1}
+    td_delta的形状为(T,)、(T, 1)或(T, N),N为并行环境数,dones的形状与之相同(可选),
+    计算全程在td_delta所在的设备上完成,返回与td_delta形状相同的张量
+    """
+    delta = td_delta.detach()
+    shape = delta.shape
+    delta = delta.reshape(shape[0], -1).float()
+    if dones is None:
+        done = torch.zeros_like(delta)
+    else:
+        done = torch.as_tensor(dones, device=delta.device).reshape(delta.shape).float()
+    advantage = _reverse_discounted_cumsum(delta, done, gamma * lmbda, chunk_size)
+    return advantage.reshape(shape)
+
+
+def compute_gae(gamma, lmbda, rewards, values, next_values, dones):
+    """
+    一次性计算优势和回报(用作价值网络的目标), 所有张量形状为(T, 1)或(T, N)
+    """
+    td_delta = rewards + gamma * next_values * (1 - dones) - values
+    advantage = compute_advantage(gamma, lmbda, td_delta, dones)
+    returns = advantage + values.detach()
+    return advantage, returns